@@ -0,0 +1,239 @@
+# align.py
+
+# Aligns topics across MCMC samples, or across separate runs, so
+# that topic 17 in one means topic 17 in all of them.
+
+# Each model's topic-word counts are normalized to a distribution per
+# topic and then to unit length, so one matrix product against the
+# reference gives the cosine similarity of every pair of topics. We
+# then match themes to themes and roles to roles by Hungarian
+# assignment (scipy's linear_sum_assignment), maximizing the total
+# similarity. If vocabularies differ, only shared words are compared.
+
+# The first model is the reference. For every model we write its
+# doc-topic counts and twmatrix with the columns permuted into the
+# reference order, and for every reference topic a stability score:
+# the mean cosine similarity of the topics matched to it. A reference
+# topic that a smaller model can't match gets a column of zeros (and
+# -1 in the saved permutation). Topics a larger model has beyond the
+# reference go at the end of their own level, so the aligned columns
+# are the reference's themes, the model's extra themes, the
+# reference's roles and the model's extra roles, and the saved
+# numthemes counts the extra themes.
+
+#     python3 align.py -models "sixthsample*.npz" -output aligned
+
+# Models can be the _doctopics.npz files mcmc_sample.py writes, or
+# pickles written by infer_roles.py.
+
+import csv, glob, os, pickle, sys
+import evaluate
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+def topic_word_matrix(booklist, numwords, numtopics):
+    '''
+    Counts every (word, topic) pair in one bincount, rather than
+    token by token as infer_roles.recreate_matrix does.
+    '''
+
+    words = np.concatenate([char.wordtypes for book in booklist for char in book.characters])
+    topics = np.concatenate([char.topicassigns for book in booklist for char in book.characters])
+
+    counts = np.bincount(words.astype('int64') * numtopics + topics, minlength = numwords * numtopics)
+    return counts.reshape(numwords, numtopics).astype('int32')
+
+def load_model(path):
+    '''
+    Returns the arrays of evaluate.arrays_from_books, with
+    'twmatrix' and 'vocabulary' as well.
+    '''
+
+    if path.endswith('.npz'):
+        arrays = evaluate.load_arrays(path)
+        if 'twmatrix' not in arrays:
+            raise ValueError(path + ' has no twmatrix; it was saved before align.py existed.')
+        return arrays
+
+    with open(path, 'rb') as f:
+        savedmodel = pickle.load(f)
+
+    numthemes, numtopics = savedmodel['constants'][0 : 2]
+    vocabulary_list = savedmodel['vocabulary_list']
+
+    arrays = evaluate.arrays_from_books(savedmodel['booklist'], numthemes, numtopics)
+    arrays['twmatrix'] = topic_word_matrix(savedmodel['booklist'], len(vocabulary_list), numtopics)
+    arrays['vocabulary'] = np.array(vocabulary_list)
+
+    return arrays
+
+def unit_topics(twmatrix, rows = None):
+    '''
+    Columns of twmatrix as probability distributions over words,
+    scaled to unit length. rows, if given, selects the words to use.
+    '''
+
+    if rows is not None:
+        twmatrix = twmatrix[rows, : ]
+
+    topics = twmatrix.astype('float64')
+    topics = topics / np.maximum(np.sum(topics, axis = 0), 1)
+    return topics / np.maximum(np.linalg.norm(topics, axis = 0), 1e-12)
+
+def shared_rows(reference, arrays):
+    '''
+    Row indices into each twmatrix for the words both vocabularies
+    share, in the same order.
+    '''
+
+    if 'vocabulary' not in reference or 'vocabulary' not in arrays:
+        return None, None
+
+    refvocab = reference['vocabulary']
+    vocab = arrays['vocabulary']
+    if len(refvocab) == len(vocab) and np.array_equal(refvocab, vocab):
+        return None, None
+
+    shared, refrows, rows = np.intersect1d(refvocab, vocab, return_indices = True)
+    return refrows, rows
+
+def match_level(similarity, refslice, slice_):
+    '''
+    Hungarian matching within one level. Returns, for each reference
+    topic in refslice, the matched topic (or -1) and its similarity.
+    '''
+
+    block = similarity[refslice, slice_]
+
+    matched = np.full(block.shape[0], -1, dtype = 'int64')
+    scores = np.zeros(block.shape[0])
+    if block.size == 0:
+        return matched, scores
+
+    refindex, index = linear_sum_assignment(block, maximize = True)
+    matched[refindex] = index + slice_.start
+    scores[refindex] = block[refindex, index]
+
+    return matched, scores
+
+def align(reference, arrays):
+    '''
+    Returns a permutation of arrays' topics into reference order,
+    the number of themes in that order, and the similarity of each
+    reference topic to its match (0 if it has none). For each level
+    the permutation has one entry per reference topic, -1 where the
+    model has no topic to match it, followed by the model's unmatched
+    topics of that level; themes come before roles.
+    '''
+
+    refthemes = int(reference['numthemes'])
+    numthemes = int(arrays['numthemes'])
+    reftopics = reference['twmatrix'].shape[1]
+    numtopics = arrays['twmatrix'].shape[1]
+
+    refrows, rows = shared_rows(reference, arrays)
+    similarity = unit_topics(reference['twmatrix'], refrows).T @ unit_topics(arrays['twmatrix'], rows)
+
+    permutation = []
+    levelsizes = []
+    scores = []
+
+    for refslice, slice_ in [(slice(0, refthemes), slice(0, numthemes)),
+        (slice(refthemes, reftopics), slice(numthemes, numtopics))]:
+        matched, levelscores = match_level(similarity, refslice, slice_)
+        matchedset = set(matched)
+        extras = [t for t in range(slice_.start, slice_.stop) if t not in matchedset]
+        permutation.extend(matched)
+        permutation.extend(extras)
+        levelsizes.append(len(matched) + len(extras))
+        scores.append(levelscores)
+
+    return np.array(permutation, dtype = 'int64'), levelsizes[0], np.concatenate(scores)
+
+def permute_columns(matrix, permutation):
+    '''
+    The columns of matrix in the order of permutation, with a column
+    of zeros wherever permutation is -1.
+    '''
+
+    permuted = np.zeros((matrix.shape[0], len(permutation)), dtype = matrix.dtype)
+    present = permutation >= 0
+    permuted[ : , present] = matrix[ : , permutation[present]]
+    return permuted
+
+def align_models(paths, outdir):
+    '''
+    Aligns every model in paths to the first. Writes the permuted
+    arrays and stability.tsv to outdir, and returns the stability
+    score of each reference topic.
+    '''
+
+    os.makedirs(outdir, exist_ok = True)
+
+    reference = load_model(paths[0])
+    allscores = []
+
+    for path in paths:
+        arrays = dict(reference) if path == paths[0] else load_model(path)
+        permutation, alignedthemes, scores = align(reference, arrays)
+        allscores.append(scores)
+
+        # Theme t is reference theme t, and role r is reference role r,
+        # for every one the reference has; topics the reference lacks
+        # come after those of their level.
+
+        arrays['counts'] = permute_columns(arrays['counts'], permutation)
+        arrays['twmatrix'] = permute_columns(arrays['twmatrix'], permutation)
+        arrays['permutation'] = permutation
+        arrays['numthemes'] = np.array(alignedthemes)
+
+        name = os.path.basename(path).replace('.pickle', '').replace('.npz', '')
+        np.savez_compressed(os.path.join(outdir, name + '_aligned.npz'), **arrays)
+        print(path + ': mean similarity to reference ' + str(round(np.mean(scores), 4)))
+
+    # Skip the reference, which matches itself perfectly.
+
+    others = np.array(allscores[1 : ]) if len(allscores) > 1 else np.array(allscores)
+    stability = np.mean(others, axis = 0)
+    worst = np.min(others, axis = 0)
+    numthemes = int(reference['numthemes'])
+
+    with open(os.path.join(outdir, 'stability.tsv'), mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.writer(f, delimiter = '\t')
+        writer.writerow(['topic', 'kind', 'meansimilarity', 'minsimilarity'])
+        for t in range(len(stability)):
+            kind = 'theme' if t < numthemes else 'role'
+            writer.writerow([t, kind, round(stability[t], 5), round(worst[t], 5)])
+
+    return stability
+
+if __name__ == '__main__':
+
+    # Pickles written by infer_roles.py as a script refer to
+    # __main__.Book and __main__.Character.
+
+    from infer_roles import Book, Character
+
+    args = sys.argv
+
+    paths = []
+    outdir = 'aligned'
+
+    for odd in range(1, len(args), 2):
+        even = odd + 1
+        if args[odd] == '-models':
+            for pattern in args[even].split(','):
+                paths.extend(sorted(glob.glob(pattern)))
+
+        elif args[odd] == '-output':
+            outdir = args[even]
+
+        else:
+            print("I don't recognize the option " + args[odd])
+
+    if len(paths) == 0:
+        print('Usage: python3 align.py -models "sample*.npz" [-output directory]')
+        sys.exit(1)
+
+    stability = align_models(paths, outdir)
+    print('Mean topic stability: ' + str(round(np.mean(stability), 4)))
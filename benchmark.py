@@ -0,0 +1,138 @@
+# benchmark.py
+
+# A small harness for timing variants of the Gibbs kernel against
+# each other on the same data. It loads a corpus once, then for each
+# variant restores an identical copy of the starting state, runs a
+# few sweeps through gibbs.onepass in this process, and reports
+# tokens per second and the log-likelihood reached.
+
+# For instance
+#
+#     python3 benchmark.py -source bestfic.txt -maxlines 20000 -themes 60 -roles 180 -words 72000 -sweeps 3
+#
+# Variants are just dictionaries of settings for gibbs.onepass; add
+# new ones to VARIANTS as the kernel grows new options.
+
+import pickle, sys, time
+import gibbs
+import infer_roles
+import numpy as np
+
+VARIANTS = dict()
+VARIANTS['baseline'] = dict()
+VARIANTS['wordorder'] = {'wordorder': True}
+VARIANTS['skipstable'] = {'skipstable': (1, 0.1)}
+
+# With -themes 0 or -roles 0 the baseline takes the one-level fast
+# path (see gibbs.sweep_one_level); this forces the general kernel.
+
+VARIANTS['twolevel'] = {'onelevel': False}
+
+def run_variant(name, settings, startstate, constants, numsweeps, seed):
+    '''
+    Runs numsweeps sweeps from a fresh copy of startstate, which is
+    a pickled (booklist, twmatrix) pair. Returns a dictionary of
+    results.
+    '''
+
+    booklist, twmatrix = pickle.loads(startstate)
+    numthemes = constants[0]
+
+    numtokens = 0
+    for book in booklist:
+        numtokens += book.totalwords
+
+    elapsed = 0
+    skipped = 0
+    for i in range(numsweeps):
+        start = time.perf_counter()
+        changematrix, booklist, changeratio, workerstats = gibbs.onepass((booklist,
+            twmatrix, constants, seed + i, settings))
+        elapsed += time.perf_counter() - start
+        skipped += workerstats['skipped'].get('skipped', 0)
+
+    result = dict()
+    result['variant'] = name
+    result['seconds'] = elapsed
+    result['tokenspersec'] = numtokens * numsweeps / elapsed
+    result['loglikelihood'] = infer_roles.get_loglikelihood(booklist, twmatrix, numthemes)
+    result['skipped'] = skipped / (numtokens * numsweeps)
+
+    return result
+
+def print_results(results):
+    baseline = results[0]['tokenspersec']
+
+    print()
+    print('variant\tseconds\ttokens/sec\tspeedup\tlog-likelihood\tskipped')
+    for r in results:
+        print(r['variant'] + '\t' + str(round(r['seconds'], 2)) + '\t' +
+            str(int(r['tokenspersec'])) + '\t' + str(round(r['tokenspersec'] / baseline, 2)) +
+            '\t' + str(round(r['loglikelihood'], 4)) + '\t' + str(round(r['skipped'], 3)))
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    numthemes = 60
+    numroles = 180
+    numwords = 72000
+    alphamean = 0.0005
+    maxlines = 20000
+    numsweeps = 3
+    seed = 1
+    variants = list(VARIANTS.keys())
+
+    for odd in range(1, len(args), 2):
+        even = odd + 1
+        if args[odd] == '-themes':
+            numthemes = int(args[even])
+
+        elif args[odd] == '-roles':
+            numroles = int(args[even])
+
+        elif args[odd] == '-words':
+            numwords = int(args[even])
+
+        elif args[odd] == '-alpha':
+            alphamean = float(args[even])
+
+        elif args[odd] == '-source':
+            sourcepath = args[even]
+
+        elif args[odd] == '-maxlines':
+            maxlines = int(args[even])
+
+        elif args[odd] == '-sweeps':
+            numsweeps = int(args[even])
+
+        elif args[odd] == '-seed':
+            seed = int(args[even])
+
+        elif args[odd] == '-variants':
+            variants = args[even].split(',')
+
+        else:
+            print("I don't recognize the option " + args[odd])
+
+    numtopics = numthemes + numroles
+    alpha = np.array([alphamean] * numtopics)
+    constants = (numthemes, numtopics, alpha, 0.1)
+
+    vocabulary_list, lexicon = infer_roles.get_vocab(sourcepath, numwords, maxlines)
+    allbooks, twmatrix = infer_roles.load_characters(sourcepath, lexicon, numthemes,
+        numroles, maxlines)
+    booklist = list(allbooks.values())
+
+    # Every variant starts from exactly this state.
+
+    startstate = pickle.dumps((booklist, twmatrix))
+    del allbooks, booklist
+
+    results = []
+    for name in variants:
+        print('Running ' + name + ' ...')
+        results.append(run_variant(name, VARIANTS[name], startstate, constants,
+            numsweeps, seed))
+
+    print_results(results)
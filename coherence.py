@@ -0,0 +1,134 @@
+# coherence.py
+
+# Topic coherence (NPMI and UMass) for every theme and role, so we
+# don't have to judge topics by eyeballing their keys.
+
+# Both measures need, for the top words of each topic, how many
+# characters contain each word and each pair of words. We build a
+# sparse character-by-word incidence matrix once, when the corpus is
+# loaded. At each checkpoint we take the union of all topics' top
+# words, slice those columns out, and get every pairwise co-document
+# count from one sparse product. With 240 topics and 10 words each
+# that is at most a 2400 x 2400 matrix, so this is cheap enough to
+# run whenever keys are printed.
+
+# With -coherence 10, infer_roles.py reports the top 10 words of each
+# topic at every key-printing checkpoint and writes
+# modelname_coherence.tsv at the end.
+
+import csv
+import numpy as np
+from scipy import sparse
+
+class CoherenceIndex:
+    '''
+    A character-by-word incidence matrix, stored as booleans by column
+    so that slicing out a few thousand words is fast.
+    '''
+
+    def __init__(self, booklist, numwords):
+        rows = []
+        cols = []
+        numchars = 0
+
+        for book in booklist:
+            for char in book.characters:
+                words = np.unique(char.wordtypes)
+                rows.append(np.full(len(words), numchars, dtype = 'int32'))
+                cols.append(words.astype('int32'))
+                numchars += 1
+
+        rows = np.concatenate(rows) if numchars > 0 else np.zeros(0, dtype = 'int32')
+        cols = np.concatenate(cols) if numchars > 0 else np.zeros(0, dtype = 'int32')
+
+        self.numdocs = numchars
+        self.incidence = sparse.csc_matrix((np.ones(len(rows), dtype = 'bool'), (rows, cols)),
+            shape = (numchars, numwords))
+
+    def cooccurrence(self, words):
+        '''
+        For a sorted array of word ids, returns the number of
+        characters containing each word and each pair of words.
+        '''
+
+        columns = self.incidence[ : , words].astype('int32')
+        docfreq = np.asarray(columns.sum(axis = 0)).ravel()
+        codocfreq = (columns.T @ columns).toarray()
+
+        return docfreq, codocfreq
+
+    def score(self, twmatrix, topn = 10):
+        '''
+        Returns arrays of NPMI and UMass coherence, one value per
+        topic, over each topic's topn most frequent words.
+        '''
+
+        numtopics = twmatrix.shape[1]
+        topn = min(topn, twmatrix.shape[0])
+
+        top = np.argpartition(twmatrix, -topn, axis = 0)[-topn : , : ].T
+        counts = np.take_along_axis(twmatrix.T, top, axis = 1).astype('int64')
+        order = np.argsort(-counts, axis = 1, kind = 'stable')
+        top = np.take_along_axis(top, order, axis = 1)
+
+        union, position = np.unique(top, return_inverse = True)
+        position = position.reshape(numtopics, topn)
+        docfreq, codocfreq = self.cooccurrence(union)
+
+        df = docfreq[position].astype('float64')
+        codf = codocfreq[position[ : , : , np.newaxis], position[ : , np.newaxis, : ]].astype('float64')
+
+        # pairs (l, m) with l ranked above m
+
+        pairs = np.triu(np.ones((topn, topn), dtype = 'bool'), k = 1)
+        numpairs = max(np.sum(pairs), 1)
+
+        # UMass: log((D(w_m, w_l) + 1) / D(w_l)), l ranked above m
+
+        umass = np.log((codf + 1) / np.maximum(df[ : , : , np.newaxis], 1))
+        umass = np.sum(np.where(pairs, umass, 0), axis = (1, 2)) / numpairs
+
+        # NPMI, with pairs that never co-occur scored -1
+
+        n = max(self.numdocs, 1)
+        pjoint = codf / n
+        pindependent = (df[ : , : , np.newaxis] / n) * (df[ : , np.newaxis, : ] / n)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            pmi = np.log(pjoint / pindependent)
+            npmi = pmi / -np.log(pjoint)
+        npmi = np.where(pjoint > 0, npmi, -1.0)
+        npmi = np.where(pjoint >= 1, 1.0, npmi)
+        npmi = np.sum(np.where(pairs, npmi, 0), axis = (1, 2)) / numpairs
+
+        return npmi, umass
+
+    def report(self, twmatrix, numthemes, topn = 10, numworst = 5):
+        '''
+        Prints mean coherence for themes and for roles, and the least
+        coherent topics. Returns (npmi, umass).
+        '''
+
+        npmi, umass = self.score(twmatrix, topn)
+
+        for label, levelslice in [('themes', slice(0, numthemes)),
+            ('roles', slice(numthemes, len(npmi)))]:
+            if len(npmi[levelslice]) == 0:
+                continue
+            print('Coherence of ' + label + ': mean NPMI ' +
+                str(round(np.mean(npmi[levelslice]), 4)) + ', mean UMass ' +
+                str(round(np.mean(umass[levelslice]), 4)))
+
+        worst = np.argsort(npmi)[ : numworst]
+        print('Least coherent topics by NPMI: ' + ', '.join([str(t) + ' (' +
+            str(round(npmi[t], 3)) + ')' for t in worst]))
+        print()
+
+        return npmi, umass
+
+def write_coherence(npmi, umass, modelname, numthemes):
+    with open(modelname + '_coherence.tsv', mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.writer(f, delimiter = '\t')
+        writer.writerow(['topic', 'kind', 'npmi', 'umass'])
+        for t in range(len(npmi)):
+            kind = 'theme' if t < numthemes else 'role'
+            writer.writerow([t, kind, round(npmi[t], 5), round(umass[t], 5)])
@@ -0,0 +1,110 @@
+# convergence.py
+
+# Decides when to stop sampling, instead of trusting -iterations.
+
+# With -plateau 0.02 we stop once the ratio of changed to unchanged
+# assignments has flattened out: the mean ratio over the last
+# -plateauwindow iterations is within 2% of the mean over the window
+# before it. If we have scored the log-likelihood at least twice, its
+# last gain per token must also be below -lltolerance.
+
+# With -timebudget 8h (or 90m, or a number of seconds) we stop before
+# starting an iteration that would, at the average pace so far, run
+# past the budget.
+
+# Either way the loop just ends early, so the usual outputs and the
+# pickled state are written as after a full run. -iterations remains
+# the upper limit.
+
+import time
+import numpy as np
+
+def parse_seconds(text):
+    '''
+    Reads durations like "8h", "90m", "45s" or a plain number of
+    seconds.
+    '''
+
+    multipliers = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400}
+    text = text.strip().upper()
+
+    if text[-1] in multipliers:
+        return float(text[ : -1]) * multipliers[text[-1]]
+    else:
+        return float(text)
+
+class StoppingRule:
+    '''
+    Lives in the coordinator. The loop reports each iteration's
+    change ratio and any log-likelihood it computes, and asks
+    should_stop at the end of the iteration.
+
+    plateau: relative tolerance for the change ratio; None turns
+        the plateau criterion off
+    window: number of iterations averaged on each side of the
+        comparison
+    lltolerance: largest gain in log-likelihood per token that still
+        counts as a plateau
+    timebudget: wall-clock limit in seconds, or None
+    '''
+
+    def __init__(self, plateau = None, window = 20, lltolerance = 0.001, timebudget = None):
+        self.plateau = plateau
+        self.window = window
+        self.lltolerance = lltolerance
+        self.timebudget = timebudget
+
+        self.ratios = []
+        self.likelihoods = []
+        self.starttime = time.time()
+        self.iterations = 0
+        self.reason = None
+
+    def record_ratio(self, ratio):
+        self.ratios.append(ratio)
+
+    def record_likelihood(self, loglikelihood):
+        self.likelihoods.append(loglikelihood)
+
+    def plateaued(self):
+        if self.plateau is None or len(self.ratios) < 2 * self.window:
+            return False
+
+        recent = np.mean(self.ratios[-self.window : ])
+        previous = np.mean(self.ratios[-2 * self.window : -self.window])
+
+        if abs(previous - recent) > self.plateau * previous:
+            return False
+
+        if len(self.likelihoods) >= 2:
+            if self.likelihoods[-1] - self.likelihoods[-2] > self.lltolerance:
+                return False
+
+        return True
+
+    def out_of_time(self):
+        if self.timebudget is None or self.iterations == 0:
+            return False
+
+        elapsed = time.time() - self.starttime
+        periteration = elapsed / self.iterations
+
+        return elapsed + periteration > self.timebudget
+
+    def should_stop(self, iteration):
+        '''
+        Call once at the end of each iteration. Returns True if the
+        loop should end, and prints why.
+        '''
+
+        self.iterations = iteration + 1
+
+        if self.plateaued():
+            self.reason = 'change ratio plateaued at ' + str(round(self.ratios[-1], 5))
+        elif self.out_of_time():
+            self.reason = 'time budget of ' + str(round(self.timebudget)) + ' seconds reached'
+        else:
+            return False
+
+        print('Stopping after ' + str(self.iterations) + ' iterations: ' + self.reason + '.')
+        return True
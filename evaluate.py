@@ -0,0 +1,266 @@
+# evaluate.py
+
+# Tests how well character roles separate labelled groups of
+# characters, for many models or MCMC samples in one run.
+
+# Each line of the source gives a character's label in its second
+# field; load_characters now keeps it as char.label. A hypothesis is
+# a set of labels, say "m,f". For each model we take the characters
+# with those labels, normalize their role vectors to sum to one,
+# optionally subtract the centroid of their book, and ask a
+# nearest-centroid classifier, under cross-validation by book, to
+# recover the labels. Classes are balanced by sampling, so chance
+# is 1 / (number of labels).
+
+# A model can be a pickle written by infer_roles.py, or the
+# _doctopics.npz that mcmc_sample.py writes for every sample, which
+# is far quicker to read than the _doctopics.tsv. Models saved before
+# characters kept their labels can take them from -source.
+
+#     python3 evaluate.py -models "sixthmodel.pickle,sixthsample*.npz" -hypothesis m,f -output accuracy.tsv
+
+import csv, glob, pickle, sys
+import sources
+import numpy as np
+
+def arrays_from_books(booklist, numthemes, numtopics):
+    '''
+    Returns a dictionary of arrays with one row per character:
+    'names', 'labels', 'books' (an index into 'booknames') and
+    'counts', the number of words in each topic.
+    '''
+
+    names = []
+    labels = []
+    books = []
+    booknames = []
+    counts = []
+
+    for i, book in enumerate(booklist):
+        booknames.append(book.name)
+        for char in book.characters:
+            names.append(char.name)
+            labels.append(getattr(char, 'label', ''))
+            books.append(i)
+            counts.append(np.bincount(char.topicassigns, minlength = numtopics))
+
+    arrays = dict()
+    arrays['names'] = np.array(names)
+    arrays['labels'] = np.array(labels)
+    arrays['books'] = np.array(books, dtype = 'int32')
+    arrays['booknames'] = np.array(booknames)
+    arrays['counts'] = np.array(counts, dtype = 'int32').reshape(len(counts), numtopics)
+    arrays['numthemes'] = np.array(numthemes)
+
+    return arrays
+
+def save_arrays(path, booklist, numthemes, numtopics, twmatrix = None, vocabulary_list = None):
+    '''
+    Saves the arrays of arrays_from_books, and optionally the
+    topic-word matrix and vocabulary too (see align.py).
+    '''
+
+    arrays = arrays_from_books(booklist, numthemes, numtopics)
+    if twmatrix is not None:
+        arrays['twmatrix'] = twmatrix
+    if vocabulary_list is not None:
+        arrays['vocabulary'] = np.array(vocabulary_list)
+
+    np.savez_compressed(path, **arrays)
+
+def load_arrays(path):
+    '''
+    Reads a model pickle or a saved .npz into the arrays of
+    arrays_from_books.
+    '''
+
+    if path.endswith('.npz'):
+        with np.load(path) as saved:
+            return {key: saved[key] for key in saved.files}
+
+    with open(path, 'rb') as f:
+        savedmodel = pickle.load(f)
+
+    numthemes, numtopics = savedmodel['constants'][0 : 2]
+    return arrays_from_books(savedmodel['booklist'], numthemes, numtopics)
+
+def read_labels(path):
+    labels = dict()
+    for line in sources.read_lines(path):
+        fields = line.split(maxsplit = 2)
+        if len(fields) > 1:
+            labels[fields[0]] = fields[1]
+    return labels
+
+def role_vectors(arrays, subtract_centroids = False):
+    '''
+    Role counts normalized to sum to one for each character. If
+    subtract_centroids is True, the mean vector of each book's
+    characters is subtracted from them.
+    '''
+
+    roles = arrays['counts'][ : , int(arrays['numthemes']) : ].astype('float64')
+    totals = np.sum(roles, axis = 1, keepdims = True)
+    vectors = np.divide(roles, totals, out = np.zeros_like(roles), where = totals > 0)
+
+    if subtract_centroids:
+        books = arrays['books']
+        numbooks = np.max(books, initial = -1) + 1
+        sums = np.zeros((numbooks, vectors.shape[1]))
+        np.add.at(sums, books, vectors)
+        sizes = np.bincount(books, minlength = numbooks)
+        vectors = vectors - sums[books] / sizes[books, np.newaxis]
+
+    return vectors
+
+def balance(labels, hypothesis, rng):
+    '''
+    Indices of an equal number of characters with each label in the
+    hypothesis, drawn at random.
+    '''
+
+    groups = [np.flatnonzero(labels == label) for label in hypothesis]
+    smallest = min([len(g) for g in groups])
+
+    return np.sort(np.concatenate([rng.choice(g, smallest, replace = False) for g in groups]))
+
+def crossvalidate(vectors, classes, books, numclasses, folds, rng):
+    '''
+    Nearest-centroid classification, with books assigned at random to
+    folds so a book's characters are never split between training and
+    test. Returns the fraction of characters classed correctly.
+    '''
+
+    uniquebooks, bookindex = np.unique(books, return_inverse = True)
+    foldofbook = rng.permutation(len(uniquebooks)) % folds
+    foldof = foldofbook[bookindex]
+
+    correct = 0
+
+    for fold in range(folds):
+        train = foldof != fold
+        test = ~train
+        if np.sum(test) == 0:
+            continue
+
+        centroids = np.zeros((numclasses, vectors.shape[1]))
+        np.add.at(centroids, classes[train], vectors[train])
+        centroids = centroids / np.maximum(np.bincount(classes[train],
+            minlength = numclasses), 1)[ : , np.newaxis]
+
+        distances = np.sum(vectors[test] ** 2, axis = 1)[ : , np.newaxis] - \
+            2 * vectors[test] @ centroids.T + np.sum(centroids ** 2, axis = 1)
+        correct += np.sum(np.argmin(distances, axis = 1) == classes[test])
+
+    return correct / len(classes)
+
+def test_hypothesis(arrays, hypothesis, subtract_centroids = False, folds = 5, seed = 0):
+    '''
+    Returns (number of characters tested, accuracy) for one model.
+    '''
+
+    rng = np.random.default_rng(seed)
+    labels = arrays['labels']
+
+    chosen = balance(labels, hypothesis, rng)
+    if len(chosen) == 0:
+        return 0, float('nan')
+
+    vectors = role_vectors(arrays, subtract_centroids)[chosen]
+    classes = np.zeros(len(chosen), dtype = 'int64')
+    for i, label in enumerate(hypothesis):
+        classes[labels[chosen] == label] = i
+
+    accuracy = crossvalidate(vectors, classes, arrays['books'][chosen], len(hypothesis),
+        folds, rng)
+
+    return len(chosen), accuracy
+
+def evaluate_models(paths, hypotheses, centroids = (False, True), folds = 5, seed = 0,
+    labels = None):
+    '''
+    Tests every hypothesis on every model, with and without
+    subtracting book centroids. labels, if given, maps character
+    names to labels for models that lack them. Returns a list of
+    result dictionaries.
+    '''
+
+    results = []
+
+    for path in paths:
+        arrays = load_arrays(path)
+        if labels is not None:
+            arrays['labels'] = np.array([labels.get(name, '') for name in arrays['names']])
+
+        for hypothesis in hypotheses:
+            for subtract in centroids:
+                n, accuracy = test_hypothesis(arrays, hypothesis, subtract, folds, seed)
+                result = dict()
+                result['model'] = path
+                result['hypothesis'] = ','.join(hypothesis)
+                result['centroids'] = 'subtracted' if subtract else 'kept'
+                result['characters'] = n
+                result['accuracy'] = round(accuracy, 4)
+                result['chance'] = round(1 / len(hypothesis), 4)
+                results.append(result)
+                print(path + '\t' + result['hypothesis'] + '\t' + result['centroids'] +
+                    '\t' + str(n) + '\t' + str(result['accuracy']))
+
+    return results
+
+if __name__ == '__main__':
+
+    # Pickles written by infer_roles.py as a script refer to
+    # __main__.Book and __main__.Character.
+
+    from infer_roles import Book, Character
+
+    args = sys.argv
+
+    paths = []
+    hypotheses = []
+    centroids = (False, True)
+    folds = 5
+    seed = 0
+    sourcepath = None
+    outpath = 'accuracy.tsv'
+
+    for odd in range(1, len(args), 2):
+        even = odd + 1
+        if args[odd] == '-models':
+            for pattern in args[even].split(','):
+                paths.extend(sorted(glob.glob(pattern)))
+
+        elif args[odd] == '-hypothesis':
+            hypotheses.append(args[even].split(','))
+
+        elif args[odd] == '-centroids':
+            centroids = {'kept': (False, ), 'subtracted': (True, ), 'both': (False, True)}[args[even]]
+
+        elif args[odd] == '-folds':
+            folds = int(args[even])
+
+        elif args[odd] == '-seed':
+            seed = int(args[even])
+
+        elif args[odd] == '-source':
+            sourcepath = args[even]
+
+        elif args[odd] == '-output':
+            outpath = args[even]
+
+        else:
+            print("I don't recognize the option " + args[odd])
+
+    labels = None
+    if sourcepath is not None:
+        labels = read_labels(sourcepath)
+
+    results = evaluate_models(paths, hypotheses, centroids, folds, seed, labels)
+
+    fields = ['model', 'hypothesis', 'centroids', 'characters', 'accuracy', 'chance']
+    with open(outpath, mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames = fields, delimiter = '\t')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
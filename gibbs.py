@@ -1,18 +1,183 @@
 # gibbs.py
 
+import time
 import numpy as np
+import memprofile, profiling, hyperopt
+
+# The sampler draws its uniforms from the worker's generator this
+# many at a time.
+
+UNIFORM_BATCH = 65536
+
+# The spawn key of the initialization stream; see init_generator.
+
+INIT_STREAM = 2 ** 32 - 1
+
+def spawn_states(runseed, n):
+    '''
+    Spawns n independent PCG64 streams from one run seed, and
+    returns their states. Each worker keeps one stream for the whole
+    run, carrying its state from pass to pass (see onepass), so no
+    two workers or iterations ever share a seed.
+    '''
+
+    children = np.random.SeedSequence(runseed).spawn(n)
+    return [np.random.PCG64(child).state for child in children]
+
+def init_generator(runseed):
+    '''
+    The stream that makes a model's random initial assignments. It is
+    spawned from the run seed apart from the workers' streams (its
+    spawn key is one spawn_states never reaches), so a seeded run is
+    reproducible from loading on.
+    '''
+
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(runseed,
+        spawn_key = (INIT_STREAM, ))))
+
+def make_generator(seed):
+    '''
+    seed can be a PCG64 state from spawn_states or from an earlier
+    pass, or anything SeedSequence accepts, such as an int.
+    '''
+
+    if isinstance(seed, dict):
+        bitgen = np.random.PCG64()
+        bitgen.state = seed
+    else:
+        bitgen = np.random.PCG64(seed)
+
+    return np.random.Generator(bitgen)
 
 def onepass(quadruplet):
-    booksequence, twmatrix, constants, theseed = quadruplet
+    '''
+    The function we map across a Pool. The quadruplet is
+    (booksequence, twmatrix, constants, theseed), optionally
+    followed by a dictionary of settings. theseed is normally the
+    state of this worker's random stream (see spawn_states).
+
+    The settings are:
+
+    changedtype: dtype of the changematrix (default int16); see
+        memplan.py for how to choose one that can't overflow
+    wordorder: if True, visit each character's tokens grouped by
+        word id rather than in text order (see sweep)
+    profile: if True, run the sweep under cProfile and return the
+        stats with the worker statistics (see profiling.py)
+    histograms: if True, also return the theme and role count
+        histograms of these books, for optimizing alpha (see
+        hyperopt.py)
+    skipstable: (k, p) to resample tokens that have kept their topic
+        for k sweeps only with probability p (see sweep)
+    revisit: if True, resample every token this time regardless
+
+    Returns the changematrix, the books, the ratio of changed to
+    unchanged assignments, and a dictionary of statistics about
+    this worker (its memory, see memprofile.py, under 'rngstate'
+    the state of its stream to pass in next time, under 'skipped'
+    the counts from sweep's tally, and under 'seconds' the time
+    the sweep took).
+    '''
+
+    booksequence, twmatrix, constants, theseed = quadruplet[0 : 4]
+
+    if len(quadruplet) > 4:
+        settings = quadruplet[4]
+    else:
+        settings = dict()
+
+    rng = make_generator(theseed)
+
+    changematrix = np.zeros(twmatrix.shape, dtype = settings.get('changedtype', 'int16'))
+    tally = dict()
+    start = time.perf_counter()
+
+    if settings.get('profile', False):
+        changeratio, profile = profiling.run_profiled(sweep, booksequence, twmatrix,
+            changematrix, constants, settings, 0, None, rng, tally)
+    else:
+        changeratio = sweep(booksequence, twmatrix, changematrix, constants, settings,
+            rng = rng, tally = tally)
+        profile = None
+
+    workerstats = memprofile.worker_memory()
+    workerstats['rngstate'] = rng.bit_generator.state
+    workerstats['skipped'] = tally
+    workerstats['seconds'] = time.perf_counter() - start
+    if profile is not None:
+        workerstats['profile'] = profile
+    if settings.get('histograms', False):
+        workerstats['histograms'] = hyperopt.count_histograms(booksequence)
+
+    return changematrix, booksequence, changeratio, workerstats
+
+def sweep(booksequence, twmatrix, changematrix, constants, settings = None,
+    syncevery = 0, sync = None, rng = None, tally = None):
+    '''
+    One Gibbs pass over a sequence of books. Reassignments are made
+    in place on the books and on twmatrix, and also recorded in
+    changematrix so they can be merged with other workers' changes.
+
+    Within a character the order of updates is arbitrary. If
+    settings['wordorder'] is True we visit tokens grouped by word id,
+    so the same row of twmatrix stays in cache across repeated words.
+    Whatever the order, when a token has the same word as the token
+    before it we reuse the (wordarray + beta) / topicnormalizer vector,
+    updating only the two entries that changed.
+
+    If syncevery is positive, sync(changematrix) is called after every
+    syncevery tokens. It is expected to publish and reset changematrix
+    and to return a refreshed twmatrix; see the asynchronous mode in
+    paramserver.py.
+
+    Topics are drawn by inverting the cumulative distribution with
+    uniforms from rng, a numpy Generator, which are drawn in batches
+    of UNIFORM_BATCH. Without rng we use fresh entropy.
+
+    If settings['skipstable'] is (k, p), each character keeps a
+    uint8 array, stability, counting the sweeps for which each token
+    has kept its topic. A token with a count of k or more is
+    resampled only with probability p, unless settings['revisit']
+    is True. If tally is a dictionary we record in it how many
+    tokens were 'visited' and how many 'skipped'.
+
+    When the model has only one level (no themes, as in plain LDA, or
+    no roles) and skipstable is off, the pass goes to sweep_one_level
+    instead, unless settings['onelevel'] is False.
 
-    np.random.seed(theseed)
+    Returns the ratio of changed to unchanged assignments.
+    '''
 
-    changematrix = np.zeros(twmatrix.shape, dtype = 'int16')
+    if settings is None:
+        settings = dict()
+
+    wordorder = settings.get('wordorder', False)
+    skipstable = settings.get('skipstable', None)
+
+    numthemes, numtopics = constants[0 : 2]
+    if (numthemes == 0 or numthemes == numtopics) and skipstable is None and \
+        settings.get('onelevel', True):
+        return sweep_one_level(booksequence, twmatrix, changematrix, constants, wordorder,
+            syncevery, sync, rng, tally)
+
+    if skipstable is not None:
+        skipafter, skipprob = skipstable
+        if settings.get('revisit', False):
+            skipafter = 256
 
     numthemes, numtopics, alpha, beta = constants
 
+    if rng is None:
+        rng = np.random.default_rng()
+
+    uniforms = rng.random(UNIFORM_BATCH)
+    position = 0
+
     same = 0
     different = 0
+    skipped = 0
+    sincesync = 0
+    lastword = -1
 
     topicnormalizer = np.sum(twmatrix, axis = 0, dtype = 'int64')
 
@@ -20,7 +185,29 @@ def onepass(quadruplet):
 
         for char in book.characters:
 
-            for idx in range(char.numwords):
+            if wordorder:
+                order = np.argsort(char.wordtypes, kind = 'stable')
+            else:
+                order = range(char.numwords)
+
+            if skipstable is not None:
+                stability = getattr(char, 'stability', None)
+                if stability is None or len(stability) != char.numwords:
+                    stability = np.zeros(char.numwords, dtype = 'uint8')
+                    char.stability = stability
+
+            for idx in order:
+
+                if skipstable is not None and stability[idx] >= skipafter:
+                    if position == UNIFORM_BATCH:
+                        uniforms = rng.random(UNIFORM_BATCH)
+                        position = 0
+
+                    position += 1
+                    if uniforms[position - 1] >= skipprob:
+                        skipped += 1
+                        continue
+
                 w = char.wordtypes[idx]
                 z = char.topicassigns[idx]
                 themearray = book.themecounts.copy()
@@ -47,21 +234,40 @@ def onepass(quadruplet):
                 wordarray = twmatrix[w, : ]
                 wordarray[z] = wordarray[z] - 1
                 topicnormalizer[z] = topicnormalizer[z] - 1
-                thiswordintopics = (wordarray + beta) / topicnormalizer
+
+                if w == lastword:
+                    thiswordintopics[z] = (wordarray[z] + beta) / topicnormalizer[z]
+                else:
+                    thiswordintopics = (wordarray + beta) / topicnormalizer
 
                 distribution = (topicarray + alpha) * thiswordintopics
-                probabilities = distribution / np.sum(distribution)
+                cumulative = np.cumsum(distribution)
+
+                if position == UNIFORM_BATCH:
+                    uniforms = rng.random(UNIFORM_BATCH)
+                    position = 0
 
-                chosentopic = np.random.choice(numtopics, size = 1, p = probabilities)
+                chosentopic = int(np.searchsorted(cumulative, uniforms[position] * cumulative[-1],
+                    side = 'right'))
+                chosentopic = min(chosentopic, numtopics - 1)
+                position += 1
 
                 if chosentopic == z:
                     same += 1
                 else:
                     different += 1
 
+                if skipstable is not None:
+                    if chosentopic == z:
+                        stability[idx] = min(stability[idx] + 1, 255)
+                    else:
+                        stability[idx] = 0
+
                 char.assignword(idx, chosentopic)
                 twmatrix[w, chosentopic] = twmatrix[w, chosentopic] + 1
                 topicnormalizer[chosentopic] = topicnormalizer[chosentopic] + 1
+                thiswordintopics[chosentopic] = (wordarray[chosentopic] + beta) / topicnormalizer[chosentopic]
+                lastword = w
 
                 changematrix[w, z] = changematrix[w, z] - 1
                 changematrix[w, chosentopic] = changematrix[w, chosentopic] + 1
@@ -73,7 +279,185 @@ def onepass(quadruplet):
                 # by subtraction at the end. This requires only one int32 and one
                 # int16 matrix.
 
+                if syncevery > 0:
+                    sincesync += 1
+                    if sincesync == syncevery:
+                        twmatrix = sync(changematrix)
+                        topicnormalizer = np.sum(twmatrix, axis = 0, dtype = 'int64')
+                        sincesync = 0
+                        lastword = -1
+
     changeratio = (different + 1) / (same + 1)
     del twmatrix, topicnormalizer
 
-    return changematrix, booksequence, changeratio
+    if tally is not None:
+        tally['visited'] = tally.get('visited', 0) + same + different + skipped
+        tally['skipped'] = tally.get('skipped', 0) + skipped
+
+    return changeratio
+
+def sweep_one_level(booksequence, twmatrix, changematrix, constants, wordorder = False,
+    syncevery = 0, sync = None, rng = None, tally = None):
+    '''
+    The same pass as sweep, for a model with only roles (numthemes
+    is 0) or only themes (numthemes is numtopics). Either way topic
+    numbers index the one counts array directly, so we update
+    char.rolecounts or book.themecounts in place and skip
+    assignword, the copies and np.append.
+
+    Since (counts / length + alpha) is proportional to
+    (counts + length * alpha), we scale alpha once per document
+    rather than dividing the counts for every token.
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+    themesonly = (numthemes == numtopics)
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    uniforms = rng.random(UNIFORM_BATCH)
+    position = 0
+
+    same = 0
+    different = 0
+    sincesync = 0
+    lastword = -1
+
+    topicnormalizer = np.sum(twmatrix, axis = 0, dtype = 'int64')
+
+    for book in booksequence:
+
+        if themesonly:
+            counts = book.themecounts
+            scaledalpha = alpha * book.totalwords
+
+        for char in book.characters:
+
+            if not themesonly:
+                counts = char.rolecounts
+                scaledalpha = alpha * char.numwords
+
+            if wordorder:
+                order = np.argsort(char.wordtypes, kind = 'stable')
+            else:
+                order = range(char.numwords)
+
+            assigns = char.topicassigns
+
+            for idx in order:
+                w = char.wordtypes[idx]
+                z = assigns[idx]
+
+                counts[z] = counts[z] - 1
+                wordarray = twmatrix[w, : ]
+                wordarray[z] = wordarray[z] - 1
+                topicnormalizer[z] = topicnormalizer[z] - 1
+
+                if w == lastword:
+                    thiswordintopics[z] = (wordarray[z] + beta) / topicnormalizer[z]
+                else:
+                    thiswordintopics = (wordarray + beta) / topicnormalizer
+
+                cumulative = np.cumsum((counts + scaledalpha) * thiswordintopics)
+
+                if position == UNIFORM_BATCH:
+                    uniforms = rng.random(UNIFORM_BATCH)
+                    position = 0
+
+                chosentopic = int(np.searchsorted(cumulative, uniforms[position] * cumulative[-1],
+                    side = 'right'))
+                chosentopic = min(chosentopic, numtopics - 1)
+                position += 1
+
+                if chosentopic == z:
+                    same += 1
+                else:
+                    different += 1
+
+                assigns[idx] = chosentopic
+                counts[chosentopic] = counts[chosentopic] + 1
+                wordarray[chosentopic] = wordarray[chosentopic] + 1
+                topicnormalizer[chosentopic] = topicnormalizer[chosentopic] + 1
+                thiswordintopics[chosentopic] = (wordarray[chosentopic] + beta) / topicnormalizer[chosentopic]
+                lastword = w
+
+                changematrix[w, z] = changematrix[w, z] - 1
+                changematrix[w, chosentopic] = changematrix[w, chosentopic] + 1
+
+                if syncevery > 0:
+                    sincesync += 1
+                    if sincesync == syncevery:
+                        twmatrix = sync(changematrix)
+                        topicnormalizer = np.sum(twmatrix, axis = 0, dtype = 'int64')
+                        sincesync = 0
+                        lastword = -1
+
+    if tally is not None:
+        tally['visited'] = tally.get('visited', 0) + same + different
+        tally['skipped'] = tally.get('skipped', 0)
+
+    return (different + 1) / (same + 1)
+
+def report_skipped(allstats):
+    '''
+    Sums the 'skipped' tallies in a list of worker statistics and
+    prints them, if any tokens were skipped. Returns (skipped, visited).
+    '''
+
+    skipped = sum([x.get('skipped', dict()).get('skipped', 0) for x in allstats])
+    visited = sum([x.get('skipped', dict()).get('visited', 0) for x in allstats])
+
+    if skipped > 0:
+        print('Skipped ' + str(skipped) + ' of ' + str(visited) + ' tokens as stable (' +
+            str(round(100 * skipped / visited, 1)) + '%).')
+
+    return skipped, visited
+
+def foldin(characters, twmatrix, constants, rng = None, positions = None):
+    '''
+    Initializes new characters against a trained model instead of
+    at random. Each word in turn is drawn from the same conditional
+    that sweep uses, given the counts so far (including the words of
+    this character already placed), and then added to the counts.
+
+    The characters must have been created with randomize = False and
+    already accepted by their books. twmatrix is updated in place.
+
+    If positions is given, it holds for each character the indices
+    of the words still to be placed; the others already count toward
+    their topics (see warmstart.py).
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    topicnormalizer = np.sum(twmatrix, axis = 0, dtype = 'int64')
+
+    for i, char in enumerate(characters):
+        book = char.book
+
+        if positions is None:
+            order = range(char.numwords)
+        else:
+            order = positions[i]
+
+        for idx in order:
+            w = char.wordtypes[idx]
+
+            themearray = book.themecounts / book.totalwords
+            rolearray = char.rolecounts / char.numwords
+            topicarray = np.append(themearray, rolearray)
+
+            thiswordintopics = (twmatrix[w, : ] + beta) / topicnormalizer
+
+            distribution = (topicarray + alpha) * thiswordintopics
+            probabilities = distribution / np.sum(distribution)
+
+            chosentopic = rng.choice(numtopics, p = probabilities)
+
+            char.placeword(idx, chosentopic)
+            twmatrix[w, chosentopic] = twmatrix[w, chosentopic] + 1
+            topicnormalizer[chosentopic] = topicnormalizer[chosentopic] + 1
@@ -0,0 +1,155 @@
+# hyperopt.py
+
+# Optimizes an asymmetric alpha, separately for themes and roles.
+
+# In the Gibbs conditional alpha is added to the fraction of a book
+# (or character) in each topic, so a document of length N in effect
+# has a Dirichlet prior with parameters N * alpha. Minka's fixed-point
+# update for a Dirichlet-multinomial, written with that scaling, is
+#
+#     a_k <- a_k * sum_d N_d [psi(n_dk + N_d a_k) - psi(N_d a_k)]
+#                / sum_d N_d [psi(n_d + N_d A) - psi(N_d A)]
+#
+# where n_dk is the count of topic k in document d, n_d the count of
+# all topics at that level, and A the sum of a. Books are the
+# documents for themes (with themecounts), and characters for roles
+# (with rolecounts).
+
+# The update only needs to know how many documents share each
+# combination of (N_d, k, n_dk), and each (N_d, n_d); zero counts
+# contribute nothing to the numerator. So, as in Wallach's histogram
+# method, workers reduce their books to those histograms at the end
+# of a sweep (see gibbs.onepass), and the coordinator merges them and
+# runs the fixed point on a few thousand distinct rows.
+
+import numpy as np
+from scipy.special import psi
+
+# Keeps any topic from being switched off entirely.
+
+MINALPHA = 0.00001
+
+def histogram(counts, lengths):
+    '''
+    counts: documents x topics
+    lengths: the length N_d of each document
+
+    Returns (rows, weights, totals, totalweights): the distinct
+    (N_d, k, n_dk) rows with nonzero n_dk and how many documents have
+    each, and the distinct (N_d, n_d) rows with their counts.
+    '''
+
+    counts = counts.astype('int64')
+    lengths = lengths.astype('int64')
+
+    docs, topics = np.nonzero(counts)
+    rows = np.stack([lengths[docs], topics, counts[docs, topics]], axis = 1)
+    rows, weights = np.unique(rows, axis = 0, return_counts = True)
+
+    totals = np.stack([lengths, np.sum(counts, axis = 1)], axis = 1)
+    totals, totalweights = np.unique(totals, axis = 0, return_counts = True)
+
+    return rows, weights, totals, totalweights
+
+def count_histograms(booksequence):
+    '''
+    Called in a worker: the theme histogram of its books and the
+    role histogram of their characters.
+    '''
+
+    themecounts = []
+    booklengths = []
+    rolecounts = []
+    charlengths = []
+
+    for book in booksequence:
+        themecounts.append(book.themecounts)
+        booklengths.append(book.totalwords)
+        for char in book.characters:
+            rolecounts.append(char.rolecounts)
+            charlengths.append(char.numwords)
+
+    histograms = dict()
+    histograms['themes'] = histogram(np.array(themecounts), np.array(booklengths))
+    histograms['roles'] = histogram(np.array(rolecounts), np.array(charlengths))
+
+    return histograms
+
+def merge_rows(rows, weights):
+    rows = np.concatenate(rows)
+    weights = np.concatenate(weights)
+
+    rows, inverse = np.unique(rows, axis = 0, return_inverse = True)
+    weights = np.bincount(inverse.reshape(-1), weights = weights)
+
+    return rows, weights
+
+def merge_histograms(histogramlist):
+    '''
+    Merges the histograms returned by several workers.
+    '''
+
+    merged = dict()
+
+    for level in ['themes', 'roles']:
+        parts = [h[level] for h in histogramlist]
+        rows, weights = merge_rows([p[0] for p in parts], [p[1] for p in parts])
+        totals, totalweights = merge_rows([p[2] for p in parts], [p[3] for p in parts])
+        merged[level] = (rows, weights, totals, totalweights)
+
+    return merged
+
+def fixed_point(alpha, hist, iterations = 50, tolerance = 0.000001):
+    '''
+    Minka's fixed-point iteration for one level, vectorized over the
+    rows of its histogram. Returns the new alpha for that level.
+    '''
+
+    rows, weights, totals, totalweights = hist
+    alpha = np.array(alpha, dtype = 'float64')
+
+    if len(alpha) == 0 or len(rows) == 0:
+        return alpha
+
+    lengths, topics, counts = rows[ : , 0], rows[ : , 1], rows[ : , 2]
+    totallengths, totalcounts = totals[ : , 0], totals[ : , 1]
+
+    for i in range(iterations):
+        x = lengths * alpha[topics]
+        numerator = np.bincount(topics, weights = weights * lengths * (psi(counts + x) - psi(x)),
+            minlength = len(alpha))
+
+        scaled = totallengths * np.sum(alpha)
+        denominator = np.sum(totalweights * totallengths * (psi(totalcounts + scaled) - psi(scaled)))
+
+        newalpha = np.maximum(alpha * numerator / denominator, MINALPHA)
+        change = np.max(np.abs(newalpha - alpha))
+        alpha = newalpha
+
+        if change < tolerance:
+            break
+
+    return alpha
+
+def update_alpha(alpha, numthemes, histograms):
+    '''
+    Returns a new alpha array, with themes and roles optimized
+    separately.
+    '''
+
+    newalpha = np.array(alpha, dtype = 'float64')
+    newalpha[ : numthemes] = fixed_point(newalpha[ : numthemes], histograms['themes'])
+    newalpha[numthemes : ] = fixed_point(newalpha[numthemes : ], histograms['roles'])
+
+    return newalpha
+
+def describe(alpha, numthemes):
+    themes, roles = alpha[ : numthemes], alpha[numthemes : ]
+    line = 'Alpha: '
+    if len(themes) > 0:
+        line += 'themes ' + str(round(np.min(themes), 6)) + ' to ' + str(round(np.max(themes), 6))
+        line += ' (mean ' + str(round(np.mean(themes), 6)) + ')'
+    if len(roles) > 0:
+        line += ', roles ' + str(round(np.min(roles), 6)) + ' to ' + str(round(np.max(roles), 6))
+        line += ' (mean ' + str(round(np.mean(roles), 6)) + ')'
+    return line
@@ -0,0 +1,247 @@
+# hypersweep.py
+
+# Runs a grid of model configurations on one corpus, instead of the
+# hand-run series of infer_roles.py commands in labnotebook.md.
+
+# The corpus is read and tokenized once, into the memory-mapped
+# token arrays of outofcore.py. Every configuration keeps its own
+# topic assignments in a directory of its own but maps the same
+# read-only tokens, so the page cache holds one copy however many
+# models are running. Configurations run concurrently, each with
+# -processes workers, as many at a time as fit in -cores.
+
+# Grid options take comma-separated lists:
+#
+#     python3 hypersweep.py -source bestfic.txt -words 72000 -maxlines 500000 -themes 40,60 -roles 120,180 -alpha .0003,.0005 -iterations 250 -cores 36 -processes 9 -name gridA
+#
+# Each configuration writes the usual keys and doctopics, and a log
+# of its output, in the directory gridA/. At the end we write
+# gridA/summary.tsv with the final log-likelihood per token, time
+# and memory of each configuration.
+
+import csv, itertools, os, pickle, sys, time
+import gibbs, infer_roles, memplan, memprofile, outofcore, profiling, trainer
+import numpy as np
+from multiprocessing import Process
+from multiprocessing.connection import wait
+
+def parse_list(text, kind):
+    return [kind(x) for x in text.split(',') if x.strip()]
+
+def config_name(config):
+    return ('t' + str(config['themes']) + '_r' + str(config['roles']) + '_a' +
+        str(config['alpha']) + '_i' + str(config['iterations']))
+
+def make_grid(grid):
+    '''
+    Every combination of the values in grid, a dictionary of lists.
+    '''
+
+    keys = list(grid.keys())
+    configs = []
+
+    for values in itertools.product(*[grid[k] for k in keys]):
+        configs.append(dict(zip(keys, values)))
+
+    return configs
+
+def run_config(config, tokendir, stats, numprocesses, runseed, configseed, outdir):
+    '''
+    Runs one configuration from random initialization to the end,
+    inside its own process. Its output goes to a log file, and its
+    results to result.pickle in its state directory.
+    '''
+
+    name = config_name(config)
+    statedir = os.path.join(outdir, name + '_state')
+    modelname = os.path.join(outdir, name)
+
+    sys.stdout = open(modelname + '.log', mode = 'w', encoding = 'utf-8', buffering = 1)
+    sys.stderr = sys.stdout
+
+    start = time.time()
+
+    # We were forked from the sweep, so the pages we share with it
+    # count toward our RSS, by the same amount in every configuration.
+    # Record only what this configuration adds to the RSS it started
+    # with, so peaks can be compared across configurations.
+
+    startrss = memprofile.current_rss()
+
+    numthemes, numroles = config['themes'], config['roles']
+    numtopics = numthemes + numroles
+    constants = (numthemes, numtopics, np.array([config['alpha']] * numtopics), 0.1)
+    dtypes = memplan.plan_dtypes(stats, numthemes, numroles)
+
+    twmatrix = outofcore.init_state(tokendir, statedir, constants, dtypes, [runseed, configseed])
+    corpus = outofcore.ShardedCorpus(tokendir, statedir)
+
+    settings = trainer.worker_settings(twmatrix)
+
+    rngstates = gibbs.spawn_states([runseed, configseed], numprocesses + 1)
+    workerstates = rngstates[ : -1]
+    shufflerng = gibbs.make_generator(rngstates[-1])
+
+    monitor = memprofile.MemoryMonitor(verbose = False)
+    collector = profiling.ProfileCollector(modelname, set())
+
+    twmatrix = outofcore.train(corpus, twmatrix, config['iterations'], numprocesses,
+        settings, monitor, collector, workerstates, shufflerng)
+
+    result = dict(config)
+    result['name'] = name
+    result['loglikelihood'] = outofcore.loglikelihood(corpus, twmatrix)
+    result['seconds'] = time.time() - start
+    result['peakrss'] = max(memprofile.peak_rss() - startrss, 0)
+    result['workerpeak'] = max([r['workerpeak'] for r in monitor.records], default = 0)
+
+    infer_roles.write_outputs(corpus.iterbooks(), twmatrix, corpus.vocabulary_list,
+        modelname, numthemes, numtopics)
+    outofcore.save_rngstates(statedir, workerstates + [shufflerng.bit_generator.state])
+
+    with open(os.path.join(statedir, 'result.pickle'), 'wb') as f:
+        pickle.dump(result, f)
+
+def schedule(configs, tokendir, stats, cores, numprocesses, runseed, outdir):
+    '''
+    Keeps as many configurations running as fit in the core budget,
+    starting the next as soon as one finishes. Returns the results of
+    the configurations that finished.
+    '''
+
+    slots = max(cores // numprocesses, 1)
+    pending = list(enumerate(configs))
+    running = dict()
+    results = []
+
+    while len(pending) > 0 or len(running) > 0:
+
+        while len(pending) > 0 and len(running) < slots:
+            configseed, config = pending.pop(0)
+            p = Process(target = run_config, args = (config, tokendir, stats, numprocesses,
+                runseed, configseed, outdir))
+            p.start()
+            running[p.sentinel] = (p, config)
+            print('Started ' + config_name(config) + '.')
+
+        for sentinel in wait(list(running.keys())):
+            p, config = running.pop(sentinel)
+            p.join()
+
+            name = config_name(config)
+            resultpath = os.path.join(outdir, name + '_state', 'result.pickle')
+
+            if p.exitcode == 0 and os.path.exists(resultpath):
+                with open(resultpath, 'rb') as f:
+                    results.append(pickle.load(f))
+                print('Finished ' + name + '.')
+            else:
+                print(name + ' failed; see ' + os.path.join(outdir, name + '.log'))
+
+    return results
+
+def write_summary(results, outdir):
+    fields = ['name', 'themes', 'roles', 'alpha', 'iterations', 'loglikelihood', 'seconds',
+        'peakrss', 'workerpeak']
+
+    results = sorted(results, key = lambda r: r['loglikelihood'], reverse = True)
+
+    with open(os.path.join(outdir, 'summary.tsv'), mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames = fields, delimiter = '\t', extrasaction = 'ignore')
+        writer.writeheader()
+        for r in results:
+            writer.writerow(r)
+
+    print()
+    print('configuration\tlog-likelihood\tminutes\tpeak RSS added\tlargest worker')
+    for r in results:
+        print(r['name'] + '\t' + str(round(r['loglikelihood'], 4)) + '\t' +
+            str(round(r['seconds'] / 60, 1)) + '\t' + memplan.format_bytes(r['peakrss']) +
+            '\t' + memplan.format_bytes(r['workerpeak']))
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    modelname = 'noneyet'
+    maxlines = 500000
+    numwords = 72000
+    cores = os.cpu_count()
+    numprocesses = 4
+    blockwords = 1000000
+    runseed = None
+
+    grid = dict()
+    grid['themes'] = [60]
+    grid['roles'] = [180]
+    grid['alpha'] = [0.0005]
+    grid['iterations'] = [250]
+
+    for odd in range(1, len(args), 2):
+        even = odd + 1
+        if args[odd] == '-themes':
+            grid['themes'] = parse_list(args[even], int)
+
+        elif args[odd] == '-roles':
+            grid['roles'] = parse_list(args[even], int)
+
+        elif args[odd] == '-alpha':
+            grid['alpha'] = parse_list(args[even], float)
+
+        elif args[odd] == '-iterations':
+            grid['iterations'] = parse_list(args[even], int)
+
+        elif args[odd] == '-words':
+            numwords = int(args[even])
+
+        elif args[odd] == '-source':
+            sourcepath = args[even]
+
+        elif args[odd] == '-name':
+            modelname = args[even]
+
+        elif args[odd] == '-maxlines':
+            maxlines = int(args[even])
+
+        elif args[odd] == '-cores':
+            cores = int(args[even])
+
+        elif args[odd] == '-processes':
+            numprocesses = int(args[even])
+
+        elif args[odd] == '-blockwords':
+            blockwords = int(args[even])
+
+        elif args[odd] == '-seed':
+            runseed = int(args[even])
+
+        else:
+            print("I don't recognize the option " + args[odd])
+
+    if runseed is None:
+        runseed = np.random.SeedSequence().entropy
+        print('Run seed: ' + str(runseed))
+
+    configs = make_grid(grid)
+    print(str(len(configs)) + ' configurations, ' + str(max(cores // numprocesses, 1)) +
+        ' at a time with ' + str(numprocesses) + ' processes each.')
+
+    # Read and tokenize the corpus once. Each configuration chooses
+    # its own dtypes from the same survey.
+
+    outdir = modelname
+    tokendir = os.path.join(outdir, 'tokens')
+
+    survey = memplan.CorpusSurvey()
+    vocabulary_list, lexicon = infer_roles.get_vocab(sourcepath, numwords, maxlines, survey)
+    stats = survey.stats(lexicon)
+    del survey
+    tokendtypes = memplan.plan_dtypes(stats, max(grid['themes']), max(grid['roles']))
+
+    print('Writing up to ' + str(stats['totalwords']) + ' tokens to ' + tokendir + ' ...')
+    outofcore.write_tokens(sourcepath, lexicon, vocabulary_list, maxlines, tokendir,
+        tokendtypes, blockwords)
+    del lexicon
+
+    results = schedule(configs, tokendir, stats, cores, numprocesses, runseed, outdir)
+    write_summary(results, outdir)
@@ -0,0 +1,184 @@
+# incremental.py
+
+# Adds newly arriving characters to a saved model, so we don't have
+# to retrain from scratch every time bestfic.txt grows.
+
+# The vocabulary is extended, but existing word ids are preserved,
+# so the trained twmatrix just gets new rows. New characters are not
+# initialized at random: each of their words is folded in with the
+# conditional from gibbs.sweep, given the trained counts. Then a few
+# sweeps over the new characters alone settle them before the usual
+# global sweeps. The cost is proportional to the new data plus
+# however many global sweeps are asked for with -iterations.
+
+# Used through infer_roles.py:
+#
+#     python3 infer_roles.py -savedmodel sixthmodel.pickle -addsource newfic.txt -iterations 10 -numprocesses 18
+
+import gibbs, memplan, infer_roles, sources
+import numpy as np
+from collections import Counter
+
+class NewCharacters:
+    '''
+    Stands in for a Book in gibbs.sweep, covering only the book's
+    new characters. It shares the real book's themecounts array, and
+    the characters still belong to the real book, so every update
+    lands where it should.
+    '''
+
+    def __init__(self, book, characters):
+        self.name = book.name
+        self.themecounts = book.themecounts
+        self.totalwords = book.totalwords
+        self.characters = characters
+
+def existing_names(booklist):
+    names = set()
+    for book in booklist:
+        for char in book.characters:
+            names.add(char.name)
+    return names
+
+def extend_vocabulary(vocabulary_list, path, maxwords, maxlines, skipnames):
+    '''
+    Appends the most common new words in path to the vocabulary,
+    until it holds maxwords words. As in get_vocab, words are counted
+    once per character. Existing ids don't change.
+
+    Returns the extended vocabulary_list and a lexicon.
+    '''
+
+    lexicon = dict()
+    for idx, val in enumerate(vocabulary_list):
+        lexicon[val] = idx
+
+    newvocab = Counter()
+
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        if fields[0] in skipnames:
+            continue
+
+        for w in set(fields[2 : ]):
+            if w not in lexicon:
+                newvocab[w] += 1
+
+    vocabulary_list = list(vocabulary_list)
+    for w, count in newvocab.most_common(max(maxwords - len(vocabulary_list), 0)):
+        lexicon[w] = len(vocabulary_list)
+        vocabulary_list.append(w)
+
+    return vocabulary_list, lexicon
+
+def add_characters(booklist, path, lexicon, constants, maxlines, skipnames):
+    '''
+    Reads the new characters in path (skipping names the model already
+    has) and attaches them to their books, creating books as needed.
+    Their words are left unassigned for gibbs.foldin.
+
+    Returns the list of new characters.
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+    numroles = numtopics - numthemes
+
+    allbooks = dict()
+    for book in booklist:
+        allbooks[book.name] = book
+
+    # New characters use the dtypes of the saved model, widened if
+    # the vocabulary has outgrown them.
+
+    dtypes = dict()
+    example = booklist[0].characters[0]
+    dtypes['wordtypes'] = np.promote_types(example.wordtypes.dtype,
+        memplan.smallest_unsigned(len(lexicon) - 1)).name
+    dtypes['topicassigns'] = example.topicassigns.dtype.name
+    dtypes['themecounts'] = booklist[0].themecounts.dtype.name
+
+    newchars = []
+
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        charname = fields[0]
+        if charname in skipnames:
+            continue
+
+        wordtypes = [lexicon[w] for w in fields[2 : ] if w in lexicon]
+
+        # the same rules as load_characters
+
+        if len(wordtypes) > 32700 or len(wordtypes) < 10:
+            continue
+
+        bookname = charname.split('|')[0]
+        if bookname not in allbooks:
+            thisbook = infer_roles.Book(bookname, numthemes, numroles, numtopics, dtypes)
+            allbooks[bookname] = thisbook
+            booklist.append(thisbook)
+        else:
+            thisbook = allbooks[bookname]
+
+        thischaracter = infer_roles.Character(charname, wordtypes, thisbook, numthemes, numroles,
+            numtopics, dtypes, randomize = False, label = fields[1])
+        thisbook.accept_character(thischaracter)
+        newchars.append(thischaracter)
+
+    # Books that grew may need wider theme counts.
+
+    for book in booklist:
+        needed = memplan.smallest_signed(book.totalwords)
+        if np.promote_types(book.themecounts.dtype, needed) != book.themecounts.dtype:
+            book.themecounts = book.themecounts.astype(needed)
+
+    return newchars
+
+def group_by_book(newchars):
+    groups = dict()
+    for char in newchars:
+        if char.book.name not in groups:
+            groups[char.book.name] = (char.book, [])
+        groups[char.book.name][1].append(char)
+
+    return [NewCharacters(book, chars) for book, chars in groups.values()]
+
+def grow_model(booklist, twmatrix, constants, vocabulary_list, path, maxwords,
+    maxlines, foldinsweeps, rng = None):
+    '''
+    Adds the new characters in path to a saved model and folds them in.
+
+    maxwords: size of the extended vocabulary
+    foldinsweeps: sweeps over the new characters alone, after fold-in
+    rng: a numpy Generator for the fold-in and those sweeps
+
+    Returns booklist, twmatrix and vocabulary_list.
+    '''
+
+    skipnames = existing_names(booklist)
+
+    vocabulary_list, lexicon = extend_vocabulary(vocabulary_list, path, maxwords,
+        maxlines, skipnames)
+    print('Vocabulary extended to ' + str(len(vocabulary_list)) + ' words.')
+
+    newrows = np.zeros((len(vocabulary_list) - twmatrix.shape[0], twmatrix.shape[1]),
+        dtype = twmatrix.dtype)
+    twmatrix = np.concatenate([twmatrix, newrows])
+
+    newchars = add_characters(booklist, path, lexicon, constants, maxlines, skipnames)
+    newwords = sum([char.numwords for char in newchars])
+    print('Adding ' + str(len(newchars)) + ' characters with ' + str(newwords) + ' words.')
+
+    gibbs.foldin(newchars, twmatrix, constants, rng)
+
+    # Now settle the new characters with a few sweeps that touch
+    # nothing else. Sweeping in place means twmatrix is already
+    # up to date; the changematrix just gets thrown away.
+
+    newgroups = group_by_book(newchars)
+    for i in range(foldinsweeps):
+        changematrix = np.zeros(twmatrix.shape, dtype = 'int32')
+        changeratio = gibbs.sweep(newgroups, twmatrix, changematrix, constants, rng = rng)
+        print('Fold-in sweep ' + str(i) + ', ratio of changed to unchanged: ', changeratio)
+
+    return booklist, twmatrix, vocabulary_list
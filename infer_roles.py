@@ -12,13 +12,13 @@
 # is done inside the module "gibbs."
 
 import random, csv, pickle, math, sys
-import gibbs
+import paramserver, memplan, memprofile, profiling, outofcore, snapshots
+import convergence, coherence, progress, sources, trainer
 import pandas as pd
 import numpy as np
 from collections import Counter
-from multiprocessing import Pool
 
-def get_vocab(vocabpath, maxwords, maxlines):
+def get_vocab(vocabpath, maxwords, maxlines, survey = None):
     '''
     Makes a pass through the data to create a vocabulary.
     The vocabulary is limited to maxwords.
@@ -26,6 +26,9 @@ def get_vocab(vocabpath, maxwords, maxlines):
     running the script in a small-scale test way on large
     files.
 
+    If survey, a memplan.CorpusSurvey, is given, every line is
+    counted in it too.
+
     Returns a vocabulary_list that contains the words in order
     of frequency, and a "lexicon"--a dictionary that rapidly
     hash-maps each word to its index in the list.
@@ -33,21 +36,17 @@ def get_vocab(vocabpath, maxwords, maxlines):
 
     vocab = Counter()
 
-    sofar = 0
-
-    with open(vocabpath, encoding = 'utf-8') as f:
-        for line in f:
-            sofar += 1
-            if sofar > maxlines:
-                break
+    for line in sources.read_lines(vocabpath, maxlines):
+        fields = line.strip().split()
+        charid = fields[0]
+        label = fields[1]
+        words = fields[2 : ]
+        for w in set(words):
+            vocab[w] += 1
+            # notice adding only once per character
 
-            fields = line.strip().split()
-            charid = fields[0]
-            label = fields[1]
-            words = fields[2 : ]
-            for w in set(words):
-                vocab[w] += 1
-                # notice adding only once per character
+        if survey is not None:
+            survey.add(charid, words)
 
     selected_vocab = vocab.most_common(maxwords)
     with open('selectedvocab.txt', mode = 'w', encoding = 'utf-8') as f:
@@ -62,7 +61,8 @@ def get_vocab(vocabpath, maxwords, maxlines):
     return vocabulary_list, lexicon
 
 class Character:
-    def __init__(self, charname, wordseq, book, numthemes, numroles, numtopics):
+    def __init__(self, charname, wordseq, book, numthemes, numroles, numtopics, dtypes = None,
+        randomize = True, label = '', rng = None):
 
         '''
         I organize data hierarchically in "Character" objects that are owned by
@@ -84,30 +84,60 @@ class Character:
 
         The ordinality of a topic determines whether it is a role or theme. Topics
         up to "numthemes" are themes; beyond that they are interpreted as roles.
+
+        If dtypes is given (see memplan.py), it decides the dtypes of the arrays;
+        rolecounts still get the smallest dtype that fits this character's words.
+
+        If randomize is False, words are left unassigned and the caller is
+        expected to place each of them with placeword (see gibbs.foldin).
+
+        label is the second field of the character's line in the source,
+        kept for evaluation (see evaluate.py).
+
+        If rng, a numpy Generator, is given, it draws the random initial
+        topics; otherwise they come from the random module.
         '''
 
         self.name = charname
+        self.label = label
         self.numwords = len(wordseq)
-        self.wordtypes = np.zeros(self.numwords, dtype = 'int32')
 
-        if numtopics < 251:
-            self.topicassigns = np.zeros(self.numwords, dtype = 'uint8')
-        else:
-            self.topicassigns = np.zeros(self.numwords, dtype = 'int16')
+        if dtypes is not None:
+            self.wordtypes = np.zeros(self.numwords, dtype = dtypes['wordtypes'])
+            self.topicassigns = np.zeros(self.numwords, dtype = dtypes['topicassigns'])
+            self.rolecounts = np.zeros(numroles, dtype = memplan.smallest_unsigned(self.numwords))
 
-        if self.numwords < 251:
-            self.rolecounts = np.zeros(numroles, dtype = 'uint8')
         else:
-            self.rolecounts = np.zeros(numroles, dtype = 'int16')
+            self.wordtypes = np.zeros(self.numwords, dtype = 'int32')
+
+            if numtopics < 251:
+                self.topicassigns = np.zeros(self.numwords, dtype = 'uint8')
+            else:
+                self.topicassigns = np.zeros(self.numwords, dtype = 'int16')
+
+            if self.numwords < 251:
+                self.rolecounts = np.zeros(numroles, dtype = 'uint8')
+            else:
+                self.rolecounts = np.zeros(numroles, dtype = 'int16')
 
         self.book = book
         self.numthemes = numthemes
 
+        if not randomize:
+            self.wordtypes[ : ] = wordseq
+            return
+
         topicroulette = [x for x in range(numtopics)]
 
+        if rng is not None:
+            topics = rng.integers(numtopics, size = self.numwords)
+
         for idx, wordid in enumerate(wordseq):
             self.wordtypes[idx] = wordid
-            topic = random.sample(topicroulette, 1)[0]
+            if rng is None:
+                topic = random.sample(topicroulette, 1)[0]
+            else:
+                topic = int(topics[idx])
             self.topicassigns[idx] = topic
 
             if topic < self.numthemes:
@@ -116,6 +146,20 @@ class Character:
                 rolenum = topic - self.numthemes
                 self.rolecounts[rolenum] += 1
 
+    def placeword(self, wordidx, topicnum):
+        '''
+        Assigns a word that doesn't yet count toward any topic,
+        as when a new character is folded into a trained model.
+        Unlike assignword, nothing is decremented.
+        '''
+
+        self.topicassigns[wordidx] = topicnum
+
+        if topicnum < self.numthemes:
+            self.book.increment_decrement(topicnum, 1)
+        else:
+            rolenum = topicnum - self.numthemes
+            self.rolecounts[rolenum] = self.rolecounts[rolenum] + 1
 
     def assignword(self, wordidx, newtopicnum):
         '''
@@ -150,10 +194,14 @@ class Book:
     in all the characters that belong to it.
     '''
 
-    def __init__(self, bookname, numthemes, numroles, numtopics):
+    def __init__(self, bookname, numthemes, numroles, numtopics, dtypes = None):
         self.name = bookname
         self.numthemes = numthemes
-        self.themecounts = np.zeros(self.numthemes, dtype = 'int32')
+
+        if dtypes is not None:
+            self.themecounts = np.zeros(self.numthemes, dtype = dtypes['themecounts'])
+        else:
+            self.themecounts = np.zeros(self.numthemes, dtype = 'int32')
 
         for i in range(numthemes):
             self.themecounts[i] = 0
@@ -169,7 +217,7 @@ class Book:
     def increment_decrement(self, topicnum, change):
         self.themecounts[topicnum] = self.themecounts[topicnum] + change
 
-def load_characters(path, lexicon, numthemes, numroles, maxlines):
+def load_characters(path, lexicon, numthemes, numroles, maxlines, dtypes = None, rng = None):
     '''
     Initializes the data for LDA:
 
@@ -178,57 +226,56 @@ def load_characters(path, lexicon, numthemes, numroles, maxlines):
     numthemes: number of book-level "themes"
     numroles: number of character-level "roles"
     maxlines: how far to read into the data file
+    dtypes: optional dictionary of dtypes planned by memplan.plan
+    rng: optional numpy Generator for the initial topics
 
     Returns a dictionary of books and a topic-word matrix.
     '''
 
     numtopics = numthemes + numroles
 
-    twmatrix = np.zeros((len(lexicon), numtopics), dtype = 'int32')
+    if dtypes is not None:
+        twmatrix = np.zeros((len(lexicon), numtopics), dtype = dtypes['twmatrix'])
+    else:
+        twmatrix = np.zeros((len(lexicon), numtopics), dtype = 'int32')
 
     allbooks = dict()
 
-    sofar = 0
-
-    with open(path, encoding = 'utf-8') as f:
-        for line in f:
-            sofar += 1
-            if sofar > maxlines:
-                break
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        charname = fields[0]
 
-            fields = line.strip().split()
-            charname = fields[0]
+        label = fields[1]
+        words = fields[2 : ]
+        wordtypes = []
 
-            label = fields[1]
-            words = fields[2 : ]
-            wordtypes = []
+        for w in words:
+            if w in lexicon:
+                wordtypes.append(lexicon[w])
 
-            for w in words:
-                if w in lexicon:
-                    wordtypes.append(lexicon[w])
+        if len(wordtypes) > 32700:
+            print("Skipping ", charname, " because too long.")
+            # I'm using int16, so numbers above 32767 would be problematic
 
-            if len(wordtypes) > 32700:
-                print("Skipping ", charname, " because too long.")
-                # I'm using int16, so numbers above 32767 would be problematic
+        elif len(wordtypes) > 9:
 
-            elif len(wordtypes) > 9:
+            bookname = charname.split('|')[0]
 
-                bookname = charname.split('|')[0]
+            if bookname not in allbooks:
+                thisbook = Book(bookname, numthemes, numroles, numtopics, dtypes)
+                allbooks[bookname] = thisbook
 
-                if bookname not in allbooks:
-                    thisbook = Book(bookname, numthemes, numroles, numtopics)
-                    allbooks[bookname] = thisbook
-
-                else:
-                    thisbook = allbooks[bookname]
+            else:
+                thisbook = allbooks[bookname]
 
-                thischaracter = Character(charname, wordtypes, thisbook, numthemes, numroles, numtopics)
-                thisbook.accept_character(thischaracter)
+            thischaracter = Character(charname, wordtypes, thisbook, numthemes, numroles,
+                numtopics, dtypes, label = label, rng = rng)
+            thisbook.accept_character(thischaracter)
 
-                # Build the topic-word matrix.
+            # Build the topic-word matrix.
 
-                for wordtype, topic in zip(thischaracter.wordtypes, thischaracter.topicassigns):
-                    twmatrix[wordtype, topic] += 1
+            for wordtype, topic in zip(thischaracter.wordtypes, thischaracter.topicassigns):
+                twmatrix[wordtype, topic] += 1
 
     return allbooks, twmatrix
 
@@ -256,72 +303,6 @@ def recreate_matrix(booklist, numwords, numtopics):
     return newmat
 
 
-def onepass(allbooks, twmatrix, constants):
-    '''
-    This is getting toward being deprecated, but I'm keeping
-    it for now. Basically, a local version of the code in the
-    gibbs module for the case where we run sampling without
-    multiprocessing.
-    '''
-    numthemes, numtopics, alpha, beta = constants
-
-    topicroulette  = [int(x) for x in range(numtopics)]
-
-    same = 0
-    different = 0
-
-    for bookname, book in allbooks.items():
-
-        topicnormalizer = np.sum(twmatrix, axis = 0)
-        # I should technically update this after each iteration
-        # but that seems likely to slow things
-
-        for char in book.characters:
-
-            for idx in range(char.numwords):
-                w = char.wordtypes[idx]
-                z = char.topicassigns[idx]
-                themearray = book.themecounts.copy()
-                rolearray = char.rolecounts.copy()
-
-                # Decrement the existing topic for this word
-                # whether it be a theme or role
-
-                if z < numthemes:
-                    themearray[z] = themearray[z] - 1
-                else:
-                    rolenum = z - numthemes
-                    rolearray[rolenum] = rolearray[rolenum] - 1
-
-                rolearray = rolearray / char.numwords
-                themearray = themearray / book.totalwords
-
-                topicarray = np.append(themearray, rolearray)
-
-                # Also decrement the wordarray.
-                # Note that numpy slices are mutable so this also changes
-                # the original twmatrix.
-
-                wordarray = twmatrix[w, : ]
-                wordarray[z] -= 1
-                topicnormalizer[z] -= 1
-                thiswordintopics = (wordarray + beta) / topicnormalizer
-
-                distribution = (topicarray + alpha) * thiswordintopics
-                probabilities = distribution / np.sum(distribution)
-                choice = np.random.choice(topicroulette, p = probabilities)
-
-                if choice == z:
-                    same += 1
-                else:
-                    different += 1
-
-                char.assignword(idx, choice)
-                twmatrix[w, choice] += 1
-                topicnormalizer[choice] += 1
-
-    print(different / same)
-
 def print_topicwords(twmatrix, r, vocabulary_list, n):
     '''
     Simply a function that prints the top n words in a topic.
@@ -333,13 +314,17 @@ def print_topicwords(twmatrix, r, vocabulary_list, n):
     line = str(r) + ': ' + ' '.join(topn) + "   " + str(np.sum(twmatrix[ : , r]))
     print(line)
 
-def shuffledivide(booklist, n):
+def shuffledivide(booklist, n, rng = None):
     '''
     After each iteration, we reshuffle and divide the
-    list of Books into n (numprocesses) chunks.
+    list of Books into n (numprocesses) chunks. If a
+    numpy Generator is given, it does the shuffling.
     '''
 
-    random.shuffle(booklist)
+    if rng is None:
+        random.shuffle(booklist)
+    else:
+        rng.shuffle(booklist)
 
     booksequences = [booklist[i::n] for i in range(n)]
 
@@ -381,6 +366,64 @@ def get_loglikelihood(booklist, twmatrix, numthemes):
 
     return logsum / n
 
+def write_doctopics(booklist, modelname, numthemes, numtopics):
+    '''
+    Writes the number of words each character (and each book) has
+    in each topic. booklist can be any iterable of Books.
+    '''
+
+    outfields = ['bookorchar', 'docid', 'fraction']
+    outfields.extend(["theme" + str(i) for i in range(0, numthemes)])
+    outfields.extend(["role" + str(i) for i in range(numthemes, numtopics)])
+
+    print()
+    print('Writing doctopics ...')
+    with open(modelname + "_doctopics.tsv", mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames = outfields, delimiter = '\t')
+        writer.writeheader()
+        for book in booklist:
+            charvectors = []
+            for char in book.characters:
+                vector = np.zeros(numtopics)
+                for assign in char.topicassigns:
+                    vector[assign] += 1
+                out = dict()
+                out['bookorchar'] = 'char'
+                out['docid'] = char.name
+                for i in range(numthemes):
+                    out['theme' + str(i)] = vector[i]
+                for i in range(numthemes, numtopics):
+                    out['role' + str(i)] = vector[i]
+                writer.writerow(out)
+                charvectors.append(vector)
+
+            bookvector = np.sum(charvectors, axis = 0)
+            out = dict()
+            out['bookorchar'] = 'book'
+            out['docid'] = book.name
+            for i in range(0, numthemes):
+                out['theme' + str(i)] = bookvector[i]
+            for i in range(numthemes, numtopics):
+                out['role' + str(i)] = bookvector[i]
+            writer.writerow(out)
+
+def write_keys(twmatrix, vocabulary_list, modelname, numtopics):
+    print()
+    print('Writing keys ...')
+    with open(modelname + '_keys.tsv', mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.writer(f, delimiter = '\t')
+        for r in range(numtopics):
+            alltopiccounts = list(twmatrix[ : , r])
+            decorated = [x for x in zip(alltopiccounts, vocabulary_list)]
+            decorated.sort(reverse = True)
+            topn = [x[1] for x in decorated[0: 100]]
+            line = str(r) + '\t' + str(np.sum(twmatrix[ : , r])) + '\t' + '\t'.join(topn) + '\n'
+            f.write(line)
+
+def write_outputs(booklist, twmatrix, vocabulary_list, modelname, numthemes, numtopics):
+    write_doctopics(booklist, modelname, numthemes, numtopics)
+    write_keys(twmatrix, vocabulary_list, modelname, numtopics)
+
 def load_model(modelpath):
     f = open(modelpath, 'rb')
     savedmodel = pickle.load(f)
@@ -393,29 +436,10 @@ def load_model(modelpath):
     numwords = len(vocabulary_list)
     twmatrix = recreate_matrix(booklist, numwords, numtopics)
 
-    return booklist, constants, vocabulary_list, twmatrix
-
-def get_size(obj, seen=None):
-    """Recursively finds size of objects"""
-    # from https://goshippo.com/blog/measure-real-size-any-python-object/
-
-    size = sys.getsizeof(obj)
-    if seen is None:
-        seen = set()
-    obj_id = id(obj)
-    if obj_id in seen:
-        return 0
-    # Important mark as seen *before* entering recursion to gracefully handle
-    # self-referential objects
-    seen.add(obj_id)
-    if isinstance(obj, dict):
-        size += sum([get_size(v, seen) for v in obj.values()])
-        size += sum([get_size(k, seen) for k in obj.keys()])
-    elif hasattr(obj, '__dict__'):
-        size += get_size(obj.__dict__, seen)
-    elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
-        size += sum([get_size(i, seen) for i in obj])
-    return size
+    # models saved before we kept random streams have none
+    rngstates = savedmodel.get('rngstates', None)
+
+    return booklist, constants, vocabulary_list, twmatrix, rngstates
 
 if __name__ == '__main__':
 
@@ -428,10 +452,41 @@ if __name__ == '__main__':
     # some default settings
 
     savedmodel = False
+    numthemes = None
+    numroles = None
     numprocesses = 18
     numiterations = 300
     modelname = 'noneyet'
     maxlines = 500000
+    numwords = None
+    distributed = 0
+    address = None
+    authkey = b'roles'
+    syncevery = 0
+    staleness = 1
+    membudget = None
+    tracememory = False
+    profileiterations = set()
+    wordorder = False
+    addsource = None
+    foldinsweeps = 2
+    shardpath = None
+    blockwords = 1000000
+    runseed = None
+    rngstates = None
+    optimizeevery = 0
+    optimizeafter = 20
+    plateau = None
+    plateauwindow = 20
+    lltolerance = 0.001
+    timebudget = None
+    skipafter = 0
+    skipprob = 0.1
+    revisitevery = 10
+    coherencewords = 0
+    metricsport = None
+    numthreads = 0
+    splitwords = 0
 
     for odd in range(1, len(args), 2):
         even = odd + 1
@@ -466,189 +521,275 @@ if __name__ == '__main__':
             modelpath = args[even]
             savedmodel = True
 
+        elif args[odd] == '-distributed':
+            distributed = int(args[even])
+
+        elif args[odd] == '-address':
+            address = args[even]
+
+        elif args[odd] == '-authkey':
+            authkey = args[even].encode('utf-8')
+
+        elif args[odd] == '-syncevery':
+            syncevery = int(args[even])
+
+        elif args[odd] == '-staleness':
+            staleness = int(args[even])
+
+        elif args[odd] == '-membudget':
+            membudget = memplan.parse_bytes(args[even])
+
+        elif args[odd] == '-memprofile':
+            tracememory = args[even].lower() in ['true', 'yes', '1']
+
+        elif args[odd] == '-profile':
+            profileiterations = profiling.parse_iterations(args[even])
+
+        elif args[odd] == '-addsource':
+            addsource = args[even]
+
+        elif args[odd] == '-foldin':
+            foldinsweeps = int(args[even])
+
+        elif args[odd] == '-wordorder':
+            wordorder = args[even].lower() in ['true', 'yes', '1']
+
+        elif args[odd] == '-seed':
+            runseed = int(args[even])
+
+        elif args[odd] == '-shards':
+            shardpath = args[even]
+
+        elif args[odd] == '-blockwords':
+            blockwords = int(args[even])
+
+        elif args[odd] == '-optimize':
+            optimizeevery = int(args[even])
+
+        elif args[odd] == '-optimizeafter':
+            optimizeafter = int(args[even])
+
+        elif args[odd] == '-plateau':
+            plateau = float(args[even])
+
+        elif args[odd] == '-plateauwindow':
+            plateauwindow = int(args[even])
+
+        elif args[odd] == '-lltolerance':
+            lltolerance = float(args[even])
+
+        elif args[odd] == '-timebudget':
+            timebudget = convergence.parse_seconds(args[even])
+
+        elif args[odd] == '-skipafter':
+            skipafter = int(args[even])
+
+        elif args[odd] == '-skipprob':
+            skipprob = float(args[even])
+
+        elif args[odd] == '-revisitevery':
+            revisitevery = int(args[even])
+
+        elif args[odd] == '-coherence':
+            coherencewords = int(args[even])
+
+        elif args[odd] == '-metricsport':
+            metricsport = int(args[even])
+
+        elif args[odd] == '-threads':
+            numthreads = int(args[even])
+
+        elif args[odd] == '-splitwords':
+            splitwords = int(args[even])
+
         else:
             print("I don't recognize the option " + args[odd])
 
-    if savedmodel:
-        booklist, constants, vocabulary_list, twmatrix = load_model(modelpath)
-        numthemes = constants[0]
-        numtopics = constants[1]
-        alpha = constants[2]
-        beta = constants[3]
+    if revisitevery < 1:
+        print('-revisitevery must be at least 1.')
+        sys.exit(1)
+
+    # The memory plan is made while a source is read (see memplan.py).
+    # A saved model keeps the dtypes it was trained with, and an
+    # out-of-core run holds only a block in memory at a time, so
+    # neither can be held to a budget.
+
+    if membudget is not None and (savedmodel or shardpath is not None):
+        print('-membudget only applies to runs that read a -source into memory.')
+        sys.exit(1)
+
+    # Everything random in the run follows from one seed; print it
+    # so the run can be repeated with -seed.
+
+    if runseed is None:
+        runseed = np.random.SeedSequence().entropy
+        print('Run seed: ' + str(runseed))
+
+    random.seed(runseed)
+    np.random.seed(runseed % 2 ** 32)
+
+    # Records RSS at each phase of the run; with -memprofile true it
+    # also takes tracemalloc snapshots and prints every checkpoint.
+
+    monitor = memprofile.MemoryMonitor(tracing = tracememory, verbose = tracememory)
+
+    if syncevery > 0 and distributed == 0:
+        # asynchronous updates need the coordinator, so run it with local workers
+        distributed = numprocesses
+
+    if shardpath is not None:
+
+        # Out-of-core: the corpus lives in memory-mapped arrays on disk
+        # and is paged in a block of books at a time; see outofcore.py.
+        # If the directory already exists we resume from it.
+
+        if outofcore.exists(shardpath):
+            print('Resuming from ' + shardpath + '.')
+            corpus = outofcore.ShardedCorpus(shardpath)
+            twmatrix = corpus.recreate_matrix()
+            rngstates = outofcore.load_rngstates(shardpath)
+        else:
+            numtopics = numthemes + numroles
+            constants = (numthemes, numtopics, np.array([alphamean] * numtopics), 0.1)
+            corpus, twmatrix = outofcore.prepare(shardpath, sourcepath, numwords, constants,
+                maxlines, blockwords, runseed)
+
+        constants = corpus.constants
+        vocabulary_list = corpus.vocabulary_list
+        booklist = None
+        monitor.checkpoint('load', twmatrix)
+
+    elif savedmodel:
+
+        # If -themes or -roles differ from the saved model, its
+        # assignments are carried over into the new topic space; with
+        # -addsource, new characters are folded in. See trainer.py.
+
         if 'II' not in modelpath:
             modelname = modelpath.replace('.pickle', 'II')
         else:
             modelname = modelpath.replace('II.pickle', 'III')
         print("Model name: " + modelname)
 
+        booklist, twmatrix, constants, vocabulary_list, rngstates = trainer.load_saved(modelpath,
+            numthemes, numroles, addsource, numwords, maxlines, foldinsweeps, runseed, monitor)
+
     else:
-        numtopics = numthemes + numroles
-        beta = 0.1
-        alpha = np.array([alphamean] * numtopics)
+        # sourcepath = '../biographies/topicmodel/data/malletficchars.txt'
 
-        constants = (numthemes, numtopics, alpha, beta)
+        booklist, twmatrix, constants, vocabulary_list = trainer.load_source(sourcepath,
+            numthemes, numroles, numwords, alphamean, maxlines, membudget,
+            max(numprocesses, distributed, numthreads), monitor, runseed)
 
-        # sourcepath = '../biographies/topicmodel/data/malletficchars.txt'
+    numthemes, numtopics = constants[0 : 2]
 
-        vocabulary_list, lexicon = get_vocab(sourcepath,numwords, maxlines)
+    # -iterations is an upper limit; with -plateau or -timebudget we
+    # may stop sooner. See convergence.py.
 
-        allbooks, twmatrix = load_characters(sourcepath, lexicon,
-            numthemes, numroles, maxlines)
+    stopper = convergence.StoppingRule(plateau, plateauwindow, lltolerance, timebudget)
 
-        booklist = []
-        for bookname, book in allbooks.items():
-            booklist.append(book)
+    if shardpath is None and distributed == 0:
 
-    if numprocesses > 1:
-        booksequences = shuffledivide(booklist, numprocesses)
-        print("Sequences: ", len(booksequences))
+        # The books are sampled in this process, with a Pool, with
+        # -threads (see threadsweep.py), or alone; see trainer.py.
 
-    for iteration in range(numiterations):
-        print("ITERATION: " + str(iteration))
+        model = trainer.Trainer(booklist, twmatrix, constants, vocabulary_list,
+            modelname = modelname, numprocesses = numprocesses, numthreads = numthreads,
+            splitwords = splitwords, seed = runseed, rngstates = rngstates,
+            wordorder = wordorder, skipafter = skipafter, skipprob = skipprob,
+            revisitevery = revisitevery, optimizeevery = optimizeevery,
+            optimizeafter = optimizeafter, coherencewords = coherencewords,
+            profileiterations = profileiterations, stopper = stopper,
+            numiterations = numiterations, metricsport = metricsport, monitor = monitor)
 
-        if iteration % 50 == 10:
-            for r in range(numtopics):
-                print_topicwords(twmatrix, r, vocabulary_list, 16)
-            print()
+        model.train(numiterations)
 
-            # Possibility to optimize alpha:
-            # if iteration > 99 and iteration % 20 == 0:
-
-            #     newalpha = np.sum(twmatrix, axis = 0)
-            #     newalpha = newalpha / np.mean(newalpha)
-            #     for idx in range(len(newalpha)):
-            #         if newalpha[idx] > 2:
-            #             newalpha[idx] = 2
-            #         elif newalpha[idx] < 0.5:
-            #             newalpha[idx] = 0.5
-            #     alpha = newalpha * alphamean
-            #     print(alpha)
-
-            #     constants = (numthemes, numtopics, alpha, beta)
-
-        if numprocesses > 1:
-
-            quadruplets = []
-            random_seeds = [((i + 1) * (iteration + 1)) for i in range(numprocesses)]
-            for i in range(numprocesses):
-                random_seeds[i] = (random_seeds[i] + random.choice([0, 100, 200, 300, 400])) % 499
-            print(random_seeds)
-            # create a different random state for each process
-
-            for seq, seed in zip(booksequences, random_seeds):
-                # matrixcopy = twmatrix.copy()
-                # deep copy, no data sharing!
-                # otherwise parallelism does bad things
-                quadruplets.append((seq, twmatrix, constants, seed))
-
-            print('Multiprocessing ...')
-            pool = Pool(processes = numprocesses)
-            res = pool.map_async(gibbs.onepass, quadruplets)
-            res.wait()
-            resultlist = res.get()
-            pool.close()
-            pool.join()
-
-            booklist = []
-            changeratios = []
-            for changematrix, bookseq, changeratio in resultlist:
-                # twmatrix = twmatrix + changematrix
-                booklist.extend(bookseq)
-                twmatrix = twmatrix + changematrix
-                changeratios.append(changeratio)
-
-            print('Ratio of changed to unchanged topic assignments: ', np.mean(changeratios))
-
-            booksequences = shuffledivide(booklist, numprocesses)
-
-            # if iteration % 100 == 1:
-            #     altmatrix = recreate_matrix(booklist, twmatrix)
-            #     assert np.array_equal(altmatrix, twmatrix)
-            #     print(twmatrix.dtype)
-                # This should do nothing at all, if my math is working
-                # correctly. It's just a sanity check.
+        # We have completed all iterations. Stop the progress server and
+        # any threads first, so a forked child can write the outputs;
+        # see snapshots.py.
 
+        model.close()
+        model.save()
+
+        twmatrix = model.twmatrix
+        collector = model.collector
+
+    else:
+        if numthreads > 0 or splitwords > 0:
+            print('Threads and split books only replace local multiprocessing; ' +
+                'ignoring -threads and -splitwords.')
+        if optimizeevery > 0:
+            print('Alpha optimization only runs with local multiprocessing; ignoring -optimize.')
+
+        # With -coherence n, score the top n words of every topic against
+        # a word-by-character index built now; see coherence.py.
+
+        coherenceindex = None
+        if coherencewords > 0 and booklist is not None:
+            coherenceindex = coherence.CoherenceIndex(booklist, len(vocabulary_list))
+            monitor.checkpoint('coherence index', twmatrix)
+        elif coherencewords > 0:
+            print('Coherence needs the books in memory; ignoring -coherence with -shards.')
+
+        settings = trainer.worker_settings(twmatrix, wordorder, skipafter, skipprob,
+            revisitevery, profileiterations)
+        collector = profiling.ProfileCollector(modelname, profileiterations)
+
+        workerstates, shufflerng = trainer.random_streams(runseed,
+            max(numprocesses, distributed), rngstates)
+
+        # With -metricsport, progress is served over HTTP for Prometheus;
+        # see progress.py.
+
+        if shardpath is not None:
+            numtokens = int(corpus.charstarts[-1])
         else:
+            numtokens = sum([book.totalwords for book in booklist])
 
-            onepass(allbooks, twmatrix, constants)
+        tracker = progress.Progress(modelname, numiterations, numtokens, metricsport)
 
-        if iteration % 20 == 1:
-            loglikelihood = get_loglikelihood(booklist, twmatrix, numthemes)
-            print("Log-likelihood per token: ", loglikelihood)
-            print()
+        if shardpath is not None:
+            twmatrix = outofcore.train(corpus, twmatrix, numiterations, numprocesses, settings,
+                monitor, collector, workerstates, shufflerng, stopper, tracker)
+            tracker.close()
 
-    # We have completed all iterations
+            # Doctopics and keys are written by a child process (see
+            # snapshots.py); the assignments were saved in place, so
+            # the directory is the model.
 
-    outfields = ['bookorchar', 'docid', 'fraction']
-    outfields.extend(["theme" + str(i) for i in range(0, numthemes)])
-    outfields.extend(["role" + str(i) for i in range(numthemes, numtopics)])
+            writer = snapshots.SnapshotWriter()
+            writer.submit('output', write_outputs, corpus.iterbooks(), twmatrix,
+                vocabulary_list, modelname, numthemes, numtopics)
 
-    print()
-    print('Writing doctopics ...')
-    with open(modelname + "_doctopics.tsv", mode = 'w', encoding = 'utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames = outfields, delimiter = '\t')
-        writer.writeheader()
-        for book in booklist:
-            charvectors = []
-            for char in book.characters:
-                vector = np.zeros(numtopics)
-                for assign in char.topicassigns:
-                    vector[assign] += 1
-                out = dict()
-                out['bookorchar'] = 'char'
-                out['docid'] = char.name
-                for i in range(numthemes):
-                    out['theme' + str(i)] = vector[i]
-                for i in range(numthemes, numtopics):
-                    out['role' + str(i)] = vector[i]
-                writer.writerow(out)
-                charvectors.append(vector)
+            print()
+            print('Model state is in ' + shardpath + '.')
+            outofcore.save_rngstates(shardpath, workerstates + [shufflerng.bit_generator.state])
 
-            bookvector = np.sum(charvectors, axis = 0)
-            out = dict()
-            out['bookorchar'] = 'book'
-            out['docid'] = book.name
-            for i in range(0, numthemes):
-                out['theme' + str(i)] = bookvector[i]
-            for i in range(numthemes, numtopics):
-                out['role' + str(i)] = bookvector[i]
-            writer.writerow(out)
+            writer.wait()
+            monitor.checkpoint('output', twmatrix)
 
-    print()
-    print('Writing keys ...')
-    with open(modelname + '_keys.tsv', mode = 'w', encoding = 'utf-8') as f:
-        writer = csv.writer(f, delimiter = '\t')
-        for r in range(numtopics):
-            alltopiccounts = list(twmatrix[ : , r])
-            decorated = [x for x in zip(alltopiccounts, vocabulary_list)]
-            decorated.sort(reverse = True)
-            topn = [x[1] for x in decorated[0: 100]]
-            line = str(r) + '\t' + str(np.sum(twmatrix[ : , r])) + '\t' + '\t'.join(topn) + '\n'
-            f.write(line)
+        else:
 
-    print()
-    print('Pickling state ...')
+            # Book shards live on worker processes, possibly on other hosts,
+            # and a coordinator in this process holds the global twmatrix.
+            # See paramserver.py.
 
-    saveobject = dict()
+            booklist, twmatrix = paramserver.coordinate(booklist, twmatrix, constants,
+                vocabulary_list, numiterations, distributed, address, authkey,
+                syncevery, staleness, settings, monitor, collector, workerstates, shufflerng,
+                stopper, tracker)
+            tracker.close()
 
-    saveobject['booklist'] = booklist
-    saveobject['constants'] = constants
-    saveobject['vocabulary_list'] = vocabulary_list
+            if coherenceindex is not None:
+                npmi, umass = coherenceindex.report(twmatrix, numthemes, coherencewords)
+                coherence.write_coherence(npmi, umass, modelname, numthemes)
 
-    f = open(modelname + '.pickle', 'wb')
-    pickle.dump(saveobject, f)
-    f.close()
+            trainer.save_model(modelname, booklist, twmatrix, constants, vocabulary_list,
+                workerstates + [shufflerng.bit_generator.state], monitor)
 
     print()
     print('Done.')
     print()
     print('The maximum value in the twmatrix is ' + str(np.max(twmatrix)) + '.')
-    print('The booklist size is: ', get_size(booklist))
-    print('The twmatrix size is: ', get_size(twmatrix))
-
-
-
-
-
-
-
+    monitor.report()
+    collector.report()
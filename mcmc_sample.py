@@ -18,13 +18,13 @@
 # of the model.
 
 import random, csv, pickle, math, sys
-import gibbs
+import gibbs, memplan, memprofile, snapshots, evaluate, sources, trainer
 import pandas as pd
 import numpy as np
 from collections import Counter
 from multiprocessing import Pool
 
-def get_vocab(vocabpath, maxwords, maxlines):
+def get_vocab(vocabpath, maxwords, maxlines, survey = None):
     '''
     Makes a pass through the data to create a vocabulary.
     The vocabulary is limited to maxwords.
@@ -32,6 +32,9 @@ def get_vocab(vocabpath, maxwords, maxlines):
     running the script in a small-scale test way on large
     files.
 
+    If survey, a memplan.CorpusSurvey, is given, every line is
+    counted in it too.
+
     Returns a vocabulary_list that contains the words in order
     of frequency, and a "lexicon"--a dictionary that rapidly
     hash-maps each word to its index in the list.
@@ -39,21 +42,17 @@ def get_vocab(vocabpath, maxwords, maxlines):
 
     vocab = Counter()
 
-    sofar = 0
-
-    with open(vocabpath, encoding = 'utf-8') as f:
-        for line in f:
-            sofar += 1
-            if sofar > maxlines:
-                break
+    for line in sources.read_lines(vocabpath, maxlines):
+        fields = line.strip().split()
+        charid = fields[0]
+        label = fields[1]
+        words = fields[2 : ]
+        for w in set(words):
+            vocab[w] += 1
+            # notice adding only once per character
 
-            fields = line.strip().split()
-            charid = fields[0]
-            label = fields[1]
-            words = fields[2 : ]
-            for w in set(words):
-                vocab[w] += 1
-                # notice adding only once per character
+        if survey is not None:
+            survey.add(charid, words)
 
     selected_vocab = vocab.most_common(maxwords)
     with open('selectedvocab.txt', mode = 'w', encoding = 'utf-8') as f:
@@ -68,7 +67,8 @@ def get_vocab(vocabpath, maxwords, maxlines):
     return vocabulary_list, lexicon
 
 class Character:
-    def __init__(self, charname, wordseq, book, numthemes, numroles, numtopics):
+    def __init__(self, charname, wordseq, book, numthemes, numroles, numtopics, label = '',
+        dtypes = None, rng = None):
 
         '''
         I organize data hierarchically in "Character" objects that are owned by
@@ -90,30 +90,50 @@ class Character:
 
         The ordinality of a topic determines whether it is a role or theme. Topics
         up to "numthemes" are themes; beyond that they are interpreted as roles.
+
+        If dtypes is given (see memplan.py), it decides the dtypes of the arrays;
+        rolecounts still get the smallest dtype that fits this character's words.
+
+        If rng, a numpy Generator, is given, it draws the random initial
+        topics; otherwise they come from the random module.
         '''
 
         self.name = charname
+        self.label = label
         self.numwords = len(wordseq)
-        self.wordtypes = np.zeros(self.numwords, dtype = 'int32')
 
-        if numtopics < 251:
-            self.topicassigns = np.zeros(self.numwords, dtype = 'uint8')
-        else:
-            self.topicassigns = np.zeros(self.numwords, dtype = 'int16')
+        if dtypes is not None:
+            self.wordtypes = np.zeros(self.numwords, dtype = dtypes['wordtypes'])
+            self.topicassigns = np.zeros(self.numwords, dtype = dtypes['topicassigns'])
+            self.rolecounts = np.zeros(numroles, dtype = memplan.smallest_unsigned(self.numwords))
 
-        if self.numwords < 251:
-            self.rolecounts = np.zeros(numroles, dtype = 'uint8')
         else:
-            self.rolecounts = np.zeros(numroles, dtype = 'int16')
+            self.wordtypes = np.zeros(self.numwords, dtype = 'int32')
+
+            if numtopics < 251:
+                self.topicassigns = np.zeros(self.numwords, dtype = 'uint8')
+            else:
+                self.topicassigns = np.zeros(self.numwords, dtype = 'int16')
+
+            if self.numwords < 251:
+                self.rolecounts = np.zeros(numroles, dtype = 'uint8')
+            else:
+                self.rolecounts = np.zeros(numroles, dtype = 'int16')
 
         self.book = book
         self.numthemes = numthemes
 
         topicroulette = [x for x in range(numtopics)]
 
+        if rng is not None:
+            topics = rng.integers(numtopics, size = self.numwords)
+
         for idx, wordid in enumerate(wordseq):
             self.wordtypes[idx] = wordid
-            topic = random.sample(topicroulette, 1)[0]
+            if rng is None:
+                topic = random.sample(topicroulette, 1)[0]
+            else:
+                topic = int(topics[idx])
             self.topicassigns[idx] = topic
 
             if topic < self.numthemes:
@@ -156,10 +176,14 @@ class Book:
     in all the characters that belong to it.
     '''
 
-    def __init__(self, bookname, numthemes, numroles, numtopics):
+    def __init__(self, bookname, numthemes, numroles, numtopics, dtypes = None):
         self.name = bookname
         self.numthemes = numthemes
-        self.themecounts = np.zeros(self.numthemes, dtype = 'int32')
+
+        if dtypes is not None:
+            self.themecounts = np.zeros(self.numthemes, dtype = dtypes['themecounts'])
+        else:
+            self.themecounts = np.zeros(self.numthemes, dtype = 'int32')
 
         for i in range(numthemes):
             self.themecounts[i] = 0
@@ -175,7 +199,7 @@ class Book:
     def increment_decrement(self, topicnum, change):
         self.themecounts[topicnum] = self.themecounts[topicnum] + change
 
-def load_characters(path, lexicon, numthemes, numroles, maxlines):
+def load_characters(path, lexicon, numthemes, numroles, maxlines, dtypes = None, rng = None):
     '''
     Initializes the data for LDA:
 
@@ -184,57 +208,56 @@ def load_characters(path, lexicon, numthemes, numroles, maxlines):
     numthemes: number of book-level "themes"
     numroles: number of character-level "roles"
     maxlines: how far to read into the data file
+    dtypes: optional dictionary of dtypes planned by memplan.plan
+    rng: optional numpy Generator for the initial topics
 
     Returns a dictionary of books and a topic-word matrix.
     '''
 
     numtopics = numthemes + numroles
 
-    twmatrix = np.zeros((len(lexicon), numtopics), dtype = 'int32')
+    if dtypes is not None:
+        twmatrix = np.zeros((len(lexicon), numtopics), dtype = dtypes['twmatrix'])
+    else:
+        twmatrix = np.zeros((len(lexicon), numtopics), dtype = 'int32')
 
     allbooks = dict()
 
-    sofar = 0
-
-    with open(path, encoding = 'utf-8') as f:
-        for line in f:
-            sofar += 1
-            if sofar > maxlines:
-                break
-
-            fields = line.strip().split()
-            charname = fields[0]
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        charname = fields[0]
 
-            label = fields[1]
-            words = fields[2 : ]
-            wordtypes = []
+        label = fields[1]
+        words = fields[2 : ]
+        wordtypes = []
 
-            for w in words:
-                if w in lexicon:
-                    wordtypes.append(lexicon[w])
+        for w in words:
+            if w in lexicon:
+                wordtypes.append(lexicon[w])
 
-            if len(wordtypes) > 32700:
-                print("Skipping ", charname, " because too long.")
-                # I'm using int16, so numbers above 32767 would be problematic
+        if len(wordtypes) > 32700:
+            print("Skipping ", charname, " because too long.")
+            # I'm using int16, so numbers above 32767 would be problematic
 
-            elif len(wordtypes) > 9:
+        elif len(wordtypes) > 9:
 
-                bookname = charname.split('|')[0]
+            bookname = charname.split('|')[0]
 
-                if bookname not in allbooks:
-                    thisbook = Book(bookname, numthemes, numroles, numtopics)
-                    allbooks[bookname] = thisbook
+            if bookname not in allbooks:
+                thisbook = Book(bookname, numthemes, numroles, numtopics, dtypes)
+                allbooks[bookname] = thisbook
 
-                else:
-                    thisbook = allbooks[bookname]
+            else:
+                thisbook = allbooks[bookname]
 
-                thischaracter = Character(charname, wordtypes, thisbook, numthemes, numroles, numtopics)
-                thisbook.accept_character(thischaracter)
+            thischaracter = Character(charname, wordtypes, thisbook, numthemes, numroles, numtopics,
+                label, dtypes, rng)
+            thisbook.accept_character(thischaracter)
 
-                # Build the topic-word matrix.
+            # Build the topic-word matrix.
 
-                for wordtype, topic in zip(thischaracter.wordtypes, thischaracter.topicassigns):
-                    twmatrix[wordtype, topic] += 1
+            for wordtype, topic in zip(thischaracter.wordtypes, thischaracter.topicassigns):
+                twmatrix[wordtype, topic] += 1
 
     return allbooks, twmatrix
 
@@ -262,72 +285,6 @@ def recreate_matrix(booklist, numwords, numtopics):
     return newmat
 
 
-def onepass(allbooks, twmatrix, constants):
-    '''
-    This is getting toward being deprecated, but I'm keeping
-    it for now. Basically, a local version of the code in the
-    gibbs module for the case where we run sampling without
-    multiprocessing.
-    '''
-    numthemes, numtopics, alpha, beta = constants
-
-    topicroulette  = [int(x) for x in range(numtopics)]
-
-    same = 0
-    different = 0
-
-    for bookname, book in allbooks.items():
-
-        topicnormalizer = np.sum(twmatrix, axis = 0)
-        # I should technically update this after each iteration
-        # but that seems likely to slow things
-
-        for char in book.characters:
-
-            for idx in range(char.numwords):
-                w = char.wordtypes[idx]
-                z = char.topicassigns[idx]
-                themearray = book.themecounts.copy()
-                rolearray = char.rolecounts.copy()
-
-                # Decrement the existing topic for this word
-                # whether it be a theme or role
-
-                if z < numthemes:
-                    themearray[z] = themearray[z] - 1
-                else:
-                    rolenum = z - numthemes
-                    rolearray[rolenum] = rolearray[rolenum] - 1
-
-                rolearray = rolearray / char.numwords
-                themearray = themearray / book.totalwords
-
-                topicarray = np.append(themearray, rolearray)
-
-                # Also decrement the wordarray.
-                # Note that numpy slices are mutable so this also changes
-                # the original twmatrix.
-
-                wordarray = twmatrix[w, : ]
-                wordarray[z] -= 1
-                topicnormalizer[z] -= 1
-                thiswordintopics = (wordarray + beta) / topicnormalizer
-
-                distribution = (topicarray + alpha) * thiswordintopics
-                probabilities = distribution / np.sum(distribution)
-                choice = np.random.choice(topicroulette, p = probabilities)
-
-                if choice == z:
-                    same += 1
-                else:
-                    different += 1
-
-                char.assignword(idx, choice)
-                twmatrix[w, choice] += 1
-                topicnormalizer[choice] += 1
-
-    print(different / same)
-
 def print_topicwords(twmatrix, r, vocabulary_list, n):
     '''
     Simply a function that prints the top n words in a topic.
@@ -339,13 +296,17 @@ def print_topicwords(twmatrix, r, vocabulary_list, n):
     line = str(r) + ': ' + ' '.join(topn) + "   " + str(np.sum(twmatrix[ : , r]))
     print(line)
 
-def shuffledivide(booklist, n):
+def shuffledivide(booklist, n, rng = None):
     '''
     After each iteration, we reshuffle and divide the
-    list of Books into n (numprocesses) chunks.
+    list of Books into n (numprocesses) chunks. If a
+    numpy Generator is given, it does the shuffling.
     '''
 
-    random.shuffle(booklist)
+    if rng is None:
+        random.shuffle(booklist)
+    else:
+        rng.shuffle(booklist)
 
     booksequences = [booklist[i::n] for i in range(n)]
 
@@ -399,30 +360,10 @@ def load_model(modelpath):
     numwords = len(vocabulary_list)
     twmatrix = recreate_matrix(booklist, numwords, numtopics)
 
-    return booklist, constants, vocabulary_list, twmatrix
-
-def get_size(obj, seen=None):
-    """Recursively finds size of objects"""
-    # from https://goshippo.com/blog/measure-real-size-any-python-object/
-
-    size = sys.getsizeof(obj)
-    if seen is None:
-        seen = set()
-    obj_id = id(obj)
-    if obj_id in seen:
-        return 0
-    # Important mark as seen *before* entering recursion to gracefully handle
-    # self-referential objects
-    seen.add(obj_id)
-    if isinstance(obj, dict):
-        size += sum([get_size(v, seen) for v in obj.values()])
-        size += sum([get_size(k, seen) for k in obj.keys()])
-    elif hasattr(obj, '__dict__'):
-        size += get_size(obj.__dict__, seen)
-    elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
-        size += sum([get_size(i, seen) for i in obj])
-    return size
+    # models saved before we kept random streams have none
+    rngstates = savedmodel.get('rngstates', None)
 
+    return booklist, constants, vocabulary_list, twmatrix, rngstates
 
 def write_doctopics(thismodelname, outfields, booklist, numthemes, numtopics):
     '''
@@ -460,6 +401,35 @@ def write_doctopics(thismodelname, outfields, booklist, numthemes, numtopics):
                 out['role' + str(i)] = bookvector[i]
             writer.writerow(out)
 
+def write_keys(modelname, twmatrix, vocabulary_list, numtopics):
+    print()
+    print('Writing keys ...')
+    with open(modelname + '_keys.tsv', mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.writer(f, delimiter = '\t')
+        for r in range(numtopics):
+            alltopiccounts = list(twmatrix[ : , r])
+            decorated = [x for x in zip(alltopiccounts, vocabulary_list)]
+            decorated.sort(reverse = True)
+            topn = [x[1] for x in decorated[0: 100]]
+            line = str(r) + '\t' + str(np.sum(twmatrix[ : , r])) + '\t' + '\t'.join(topn) + '\n'
+            f.write(line)
+
+def write_sample(thismodelname, outfields, booklist, numthemes, numtopics, twmatrix,
+    vocabulary_list):
+    '''
+    Writes a sample's doctopic file, and the same counts as arrays
+    that evaluate.py and align.py can read quickly.
+    '''
+
+    write_doctopics(thismodelname, outfields, booklist, numthemes, numtopics)
+    evaluate.save_arrays(thismodelname + '_doctopics.npz', booklist, numthemes, numtopics,
+        twmatrix, vocabulary_list)
+
+def write_outputs(modelname, outfields, booklist, twmatrix, vocabulary_list, numthemes,
+    numtopics):
+    write_doctopics(modelname, outfields, booklist, numthemes, numtopics)
+    write_keys(modelname, twmatrix, vocabulary_list, numtopics)
+
 if __name__ == '__main__':
 
     # There are several ways to run this script. You can pass in command-line
@@ -475,6 +445,8 @@ if __name__ == '__main__':
     numiterations = 300
     modelname = 'noneyet'
     maxlines = 500000
+    runseed = None
+    membudget = None
 
     for odd in range(1, len(args), 2):
         even = odd + 1
@@ -509,11 +481,36 @@ if __name__ == '__main__':
             modelpath = args[even]
             savedmodel = True
 
+        elif args[odd] == '-seed':
+            runseed = int(args[even])
+
+        elif args[odd] == '-membudget':
+            membudget = memplan.parse_bytes(args[even])
+
         else:
             print("I don't recognize the option " + args[odd])
 
+    # Records RSS at each phase of the run; see memprofile.py.
+
+    monitor = memprofile.MemoryMonitor(verbose = False)
+
+    # A saved model keeps the dtypes it was trained with; see memplan.py.
+
+    if membudget is not None and savedmodel:
+        print('-membudget only applies to runs that read a -source.')
+        sys.exit(1)
+
+    # Everything random in the run follows from one seed; print it
+    # so the run can be repeated with -seed.
+
+    if runseed is None:
+        runseed = np.random.SeedSequence().entropy
+        print('Run seed: ' + str(runseed))
+
+    rngstates = None
+
     if savedmodel:
-        booklist, constants, vocabulary_list, twmatrix = load_model(modelpath)
+        booklist, constants, vocabulary_list, twmatrix, rngstates = load_model(modelpath)
         numthemes = constants[0]
         numtopics = constants[1]
         alpha = constants[2]
@@ -533,22 +530,48 @@ if __name__ == '__main__':
 
         # sourcepath = '../biographies/topicmodel/data/malletficchars.txt'
 
-        vocabulary_list, lexicon = get_vocab(sourcepath,numwords, maxlines)
+        survey = memplan.CorpusSurvey()
+        vocabulary_list, lexicon = get_vocab(sourcepath,numwords, maxlines, survey)
+        monitor.checkpoint('vocab')
+
+        # Choose the smallest safe dtypes and check the projected RAM
+        # against membudget before allocating anything.
+
+        dtypes = memplan.plan(survey.stats(lexicon), numthemes, numroles, numprocesses,
+            membudget)
+        del survey
 
         allbooks, twmatrix = load_characters(sourcepath, lexicon,
-            numthemes, numroles, maxlines)
+            numthemes, numroles, maxlines, dtypes, gibbs.init_generator(runseed))
 
         booklist = []
         for bookname, book in allbooks.items():
             booklist.append(book)
 
+    monitor.set_corpus(booklist)
+    monitor.checkpoint('load', twmatrix)
+
+    # Each worker keeps its own random stream, spawned from the run
+    # seed, and another stream shuffles books among them. A saved
+    # model's streams pick up where they left off; see trainer.py.
+
+    workerstates, shufflerng = trainer.random_streams(runseed, max(numprocesses, 1),
+        rngstates)
+
     if numprocesses > 1:
-        booksequences = shuffledivide(booklist, numprocesses)
+        booksequences = shuffledivide(booklist, numprocesses, shufflerng)
         print("Sequences: ", len(booksequences))
 
+    monitor.checkpoint('init', twmatrix)
+
     
     samplenum = 0
 
+    # Samples are written in the background from a snapshot of the
+    # books (see snapshots.py), while sampling goes on.
+
+    writer = snapshots.SnapshotWriter()
+
     outfields = ['bookorchar', 'docid', 'fraction']
     outfields.extend(["theme" + str(i) for i in range(0, numthemes)])
     outfields.extend(["role" + str(i) for i in range(numthemes, numtopics)])
@@ -558,19 +581,15 @@ if __name__ == '__main__':
 
         if iteration % 20 == 1:
             thismodelname = modelname + str(samplenum)
-            write_doctopics(thismodelname, outfields, booklist, numthemes, numtopics)
+            writer.submit(thismodelname, write_sample, thismodelname, outfields, booklist,
+                numthemes, numtopics, twmatrix, vocabulary_list)
             samplenum += 1
 
         if numprocesses > 1:
 
             quadruplets = []
-            random_seeds = [((i + 1) * (iteration + 1)) for i in range(numprocesses)]
-            for i in range(numprocesses):
-                random_seeds[i] = (random_seeds[i] + random.choice([0, 100, 200, 300, 400])) % 499
-            print(random_seeds)
-            # create a different random state for each process
 
-            for seq, seed in zip(booksequences, random_seeds):
+            for seq, seed in zip(booksequences, workerstates):
                 # matrixcopy = twmatrix.copy()
                 # deep copy, no data sharing!
                 # otherwise parallelism does bad things
@@ -584,17 +603,26 @@ if __name__ == '__main__':
             pool.close()
             pool.join()
 
+            # Each worker was sent the twmatrix and its books, and sent
+            # back its books and a changematrix.
+
+            ipcbytes = numprocesses * twmatrix.nbytes + 2 * monitor.corpusbytes
+            ipcbytes += sum([x[0].nbytes for x in resultlist])
+            monitor.checkpoint('sweep ' + str(iteration), twmatrix, ipcbytes,
+                [x[3] for x in resultlist])
+
             booklist = []
             changeratios = []
-            for changematrix, bookseq, changeratio in resultlist:
+            for i, (changematrix, bookseq, changeratio, workerstats) in enumerate(resultlist):
                 # twmatrix = twmatrix + changematrix
                 booklist.extend(bookseq)
                 twmatrix = twmatrix + changematrix
                 changeratios.append(changeratio)
+                workerstates[i] = workerstats['rngstate']
 
             print('Ratio of changed to unchanged topic assignments: ', np.mean(changeratios))
 
-            booksequences = shuffledivide(booklist, numprocesses)
+            booksequences = shuffledivide(booklist, numprocesses, shufflerng)
 
             # if iteration % 100 == 1:
             #     altmatrix = recreate_matrix(booklist, twmatrix)
@@ -605,7 +633,16 @@ if __name__ == '__main__':
 
         else:
 
-            onepass(allbooks, twmatrix, constants)
+            # The sweep updates the books and twmatrix in place, so its
+            # changematrix has nothing left to merge.
+
+            changematrix, booklist, changeratio, workerstats = gibbs.onepass((booklist,
+                twmatrix, constants, workerstates[0]))
+            del changematrix
+            workerstates[0] = workerstats['rngstate']
+
+            print('Ratio of changed to unchanged topic assignments: ', changeratio)
+            monitor.checkpoint('sweep ' + str(iteration), twmatrix)
 
         if iteration % 10 == 1:
             loglikelihood = get_loglikelihood(booklist, twmatrix, numthemes)
@@ -614,48 +651,12 @@ if __name__ == '__main__':
 
     # We have completed all iterations
 
-    print()
-    print('Writing doctopics ...')
-    with open(modelname + "_doctopics.tsv", mode = 'w', encoding = 'utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames = outfields, delimiter = '\t')
-        writer.writeheader()
-        for book in booklist:
-            charvectors = []
-            for char in book.characters:
-                vector = np.zeros(numtopics)
-                for assign in char.topicassigns:
-                    vector[assign] += 1
-                out = dict()
-                out['bookorchar'] = 'char'
-                out['docid'] = char.name
-                for i in range(numthemes):
-                    out['theme' + str(i)] = vector[i]
-                for i in range(numthemes, numtopics):
-                    out['role' + str(i)] = vector[i]
-                writer.writerow(out)
-                charvectors.append(vector)
-
-            bookvector = np.sum(charvectors, axis = 0)
-            out = dict()
-            out['bookorchar'] = 'book'
-            out['docid'] = book.name
-            for i in range(0, numthemes):
-                out['theme' + str(i)] = bookvector[i]
-            for i in range(numthemes, numtopics):
-                out['role' + str(i)] = bookvector[i]
-            writer.writerow(out)
+    # Nothing is left to sample, so the final writes can only overlap
+    # each other: doctopics and keys are written by a child process
+    # while we pickle the state here.
 
-    print()
-    print('Writing keys ...')
-    with open(modelname + '_keys.tsv', mode = 'w', encoding = 'utf-8') as f:
-        writer = csv.writer(f, delimiter = '\t')
-        for r in range(numtopics):
-            alltopiccounts = list(twmatrix[ : , r])
-            decorated = [x for x in zip(alltopiccounts, vocabulary_list)]
-            decorated.sort(reverse = True)
-            topn = [x[1] for x in decorated[0: 100]]
-            line = str(r) + '\t' + str(np.sum(twmatrix[ : , r])) + '\t' + '\t'.join(topn) + '\n'
-            f.write(line)
+    writer.submit('final', write_outputs, modelname, outfields, booklist, twmatrix,
+        vocabulary_list, numthemes, numtopics)
 
     print()
     print('Pickling state ...')
@@ -665,17 +666,22 @@ if __name__ == '__main__':
     saveobject['booklist'] = booklist
     saveobject['constants'] = constants
     saveobject['vocabulary_list'] = vocabulary_list
+    saveobject['rngstates'] = workerstates + [shufflerng.bit_generator.state]
 
     f = open(modelname + '.pickle', 'wb')
     pickle.dump(saveobject, f)
     f.close()
+    monitor.checkpoint('pickle', twmatrix)
+
+    writer.wait()
+    monitor.checkpoint('output', twmatrix)
 
     print()
     print('Done.')
     print()
     print('The maximum value in the twmatrix is ' + str(np.max(twmatrix)) + '.')
-    print('The booklist size is: ', get_size(booklist))
-    print('The twmatrix size is: ', get_size(twmatrix))
+
+    monitor.report()
 
 
 
@@ -0,0 +1,239 @@
+# memplan.py
+
+# Plans the memory used by a run before anything is allocated.
+
+# The dtypes of the arrays that hold the corpus and the counts used
+# to be chosen ad hoc (uint8 topic assignments when there are fewer
+# than 251 topics, int16 changematrix, and so on). Here we collect
+# the statistics that bound every counter while the vocabulary is
+# chosen (see CorpusSurvey), pick the smallest dtype that can't
+# overflow for each array, and project how much RAM the run will need.
+
+import sys
+import numpy as np
+from collections import Counter
+
+# Rough per-object overhead of the Python side of the data structure:
+# an instance, its __dict__, and the headers of the numpy arrays
+# it owns. Measured with sys.getsizeof under CPython 3.
+
+CHARACTER_OVERHEAD = 56 + 296 + 3 * 112 + 8 + 100
+BOOK_OVERHEAD = 56 + 296 + 112 + 100
+
+def smallest_unsigned(maxvalue):
+    '''
+    The smallest unsigned integer dtype that can hold maxvalue.
+    '''
+
+    for dtype in ['uint8', 'uint16', 'uint32', 'uint64']:
+        if maxvalue <= np.iinfo(dtype).max:
+            return dtype
+
+def smallest_signed(maxvalue):
+    '''
+    The smallest signed integer dtype that can hold values
+    between -maxvalue and maxvalue.
+    '''
+
+    for dtype in ['int8', 'int16', 'int32', 'int64']:
+        if maxvalue <= np.iinfo(dtype).max:
+            return dtype
+
+class CorpusSurvey:
+    '''
+    Collects the statistics we need to bound every counter during
+    get_vocab's pass through the data, so the survey costs no pass of
+    its own. The lexicon isn't chosen until that pass ends, so every
+    word counts toward a character's length; the statistics are
+    upper bounds on what load_characters will keep, which is all a
+    choice of dtypes needs.
+    '''
+
+    def __init__(self, maxcharwords = 32700, mincharwords = 10):
+        self.maxcharwords = maxcharwords
+        self.mincharwords = mincharwords
+        self.tokenfreqs = Counter()
+        self.bookwords = dict()
+        self.numchars = 0
+        self.totalwords = 0
+        self.longest = 0
+
+        # the number of characters whose role counts fit in uint8,
+        # uint16 and uint32 respectively
+
+        self.charsbysize = [0, 0, 0]
+
+    def add(self, charname, words):
+        '''
+        Counts one line of the source: its character name and words.
+        '''
+
+        self.tokenfreqs.update(words)
+
+        # load_characters skips characters with fewer than
+        # mincharwords words in the lexicon, and those can't have
+        # more words than this
+
+        if len(words) < self.mincharwords:
+            return
+
+        numwords = min(len(words), self.maxcharwords)
+        bookname = charname.split('|')[0]
+        self.bookwords[bookname] = self.bookwords.get(bookname, 0) + numwords
+
+        self.numchars += 1
+        self.totalwords += numwords
+        self.longest = max(self.longest, numwords)
+
+        if numwords < 256:
+            self.charsbysize[0] += 1
+        elif numwords < 65536:
+            self.charsbysize[1] += 1
+        else:
+            self.charsbysize[2] += 1
+
+    def stats(self, lexicon):
+        '''
+        Returns the dictionary of statistics for the chosen lexicon.
+        '''
+
+        stats = dict()
+        stats['numchars'] = self.numchars
+        stats['totalwords'] = self.totalwords
+        stats['maxcharwords'] = self.longest
+        stats['charsbysize'] = list(self.charsbysize)
+        stats['numbooks'] = len(self.bookwords)
+        stats['maxbookwords'] = max(self.bookwords.values(), default = 0)
+        stats['maxwordfreq'] = max([self.tokenfreqs[w] for w in lexicon], default = 0)
+        stats['vocabsize'] = len(lexicon)
+
+        return stats
+
+def plan_dtypes(stats, numthemes, numroles):
+    '''
+    Chooses the smallest safe dtype for every array.
+
+    wordtypes: must hold the largest word id
+    topicassigns: must hold the largest topic number
+    rolecounts: chosen per character, since a character can't
+        have more words in a role than it has words (see
+        Character.__init__); here we record the widest needed
+    themecounts: must hold the words in the largest book
+    twmatrix: no cell can exceed the corpus frequency of its word
+    changematrix: no cell can move by more than the frequency of
+        its word, in either direction
+
+    The themecounts are kept signed because Book.increment_decrement
+    adds a negative change to them; the twmatrix and changematrix
+    because they are added to and subtracted from each other.
+    '''
+
+    numtopics = numthemes + numroles
+
+    dtypes = dict()
+    dtypes['wordtypes'] = smallest_unsigned(max(stats['vocabsize'] - 1, 0))
+    dtypes['topicassigns'] = smallest_unsigned(max(numtopics - 1, 0))
+    dtypes['rolecounts'] = smallest_unsigned(stats['maxcharwords'])
+    dtypes['themecounts'] = smallest_signed(stats['maxbookwords'])
+    dtypes['twmatrix'] = smallest_signed(stats['maxwordfreq'])
+    dtypes['changematrix'] = smallest_signed(stats['maxwordfreq'])
+
+    return dtypes
+
+def project_memory(stats, dtypes, numthemes, numroles, numprocesses):
+    '''
+    Projects the peak RAM of a run, broken down by array.
+
+    With multiprocessing each worker receives a pickled copy of
+    its books and of the twmatrix, and sends back its books plus
+    a changematrix; the coordinator meanwhile still holds its own
+    copies. So the corpus is counted roughly three times (our copy,
+    the workers' copies, and the pickle buffers in flight), and the
+    twmatrix once per worker plus two for the coordinator (the
+    matrix and the sum produced by merging).
+
+    Returns a list of (label, bytes) pairs.
+    '''
+
+    numtopics = numthemes + numroles
+    size = lambda dtype: np.dtype(dtype).itemsize
+
+    rolecountbytes = numroles * (stats['charsbysize'][0] * 1 +
+        stats['charsbysize'][1] * 2 + stats['charsbysize'][2] * 4)
+
+    corpus = [('wordtypes', stats['totalwords'] * size(dtypes['wordtypes'])),
+        ('topicassigns', stats['totalwords'] * size(dtypes['topicassigns'])),
+        ('rolecounts', rolecountbytes),
+        ('themecounts', stats['numbooks'] * numthemes * size(dtypes['themecounts'])),
+        ('Python object overhead', stats['numchars'] * CHARACTER_OVERHEAD +
+            stats['numbooks'] * BOOK_OVERHEAD)]
+
+    corpusbytes = sum([x[1] for x in corpus])
+    matrixbytes = stats['vocabsize'] * numtopics * size(dtypes['twmatrix'])
+    changebytes = stats['vocabsize'] * numtopics * size(dtypes['changematrix'])
+
+    breakdown = list(corpus)
+
+    if numprocesses > 1:
+        breakdown.append(('twmatrix (coordinator)', 2 * matrixbytes))
+        breakdown.append(('twmatrix (workers)', numprocesses * matrixbytes))
+        breakdown.append(('changematrix (workers)', numprocesses * changebytes))
+        breakdown.append(('corpus copies (workers)', corpusbytes))
+        breakdown.append(('pickle buffers', corpusbytes))
+    else:
+        breakdown.append(('twmatrix', matrixbytes))
+
+    return breakdown
+
+def parse_bytes(text):
+    '''
+    Reads sizes like "64G", "512M" or a plain number of bytes.
+    '''
+
+    multipliers = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    text = text.strip().upper().rstrip('B')
+
+    if text[-1] in multipliers:
+        return int(float(text[ : -1]) * multipliers[text[-1]])
+    else:
+        return int(text)
+
+def format_bytes(numbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if numbytes < 1024:
+            return str(round(numbytes, 1)) + ' ' + unit
+        numbytes = numbytes / 1024
+    return str(round(numbytes, 1)) + ' TB'
+
+def plan(stats, numthemes, numroles, numprocesses, membudget = None):
+    '''
+    Chooses dtypes for the statistics of a CorpusSurvey, and prints
+    the projected RAM breakdown. If membudget (in bytes) is given and
+    the run would exceed it, we refuse to start.
+
+    Returns the dictionary of dtypes for load_characters.
+    '''
+
+    dtypes = plan_dtypes(stats, numthemes, numroles)
+    breakdown = project_memory(stats, dtypes, numthemes, numroles, numprocesses)
+
+    print()
+    print('Memory plan for at most ' + str(stats['numchars']) + ' characters in ' +
+        str(stats['numbooks']) + ' books, ' + str(stats['totalwords']) + ' tokens:')
+    for name, dtype in dtypes.items():
+        print('    ' + name + ': ' + dtype)
+    print()
+
+    total = 0
+    for label, numbytes in breakdown:
+        print('    ' + label + ': ' + format_bytes(numbytes))
+        total += numbytes
+    print('Projected peak RAM: ' + format_bytes(total))
+    print()
+
+    if membudget is not None and total > membudget:
+        print('This run would exceed the memory budget of ' + format_bytes(membudget) +
+            '. Try fewer processes, words, or topics.')
+        sys.exit(1)
+
+    return dtypes
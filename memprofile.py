@@ -0,0 +1,183 @@
+# memprofile.py
+
+# Memory instrumentation for training runs.
+
+# We used to call a recursive get_size on the whole booklist at the
+# end of a run. That walked millions of objects, took a long time,
+# and undercounted numpy buffers anyway. Instead we record resident
+# set size (current and peak) at each phase of the run, optionally
+# with tracemalloc snapshots, and attribute bytes to the main
+# consumers using the nbytes of the arrays themselves.
+
+import os, sys, resource, tracemalloc
+import numpy as np
+from memplan import format_bytes
+
+def current_rss():
+    '''
+    Current resident set size of this process in bytes. Read from
+    /proc where it exists; elsewhere we fall back on the peak.
+    '''
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+def peak_rss(who = resource.RUSAGE_SELF):
+    '''
+    Peak resident set size in bytes. For RUSAGE_CHILDREN this is
+    the peak of the largest child that has been waited for.
+    '''
+
+    peak = resource.getrusage(who).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return peak
+    else:
+        return peak * 1024
+
+def worker_memory():
+    '''
+    Called inside a worker at the end of its pass; see
+    gibbs.onepass, which returns this with its other results.
+    '''
+
+    return {'pid': os.getpid(), 'rss': current_rss(), 'peakrss': peak_rss()}
+
+def measure_corpus(booklist):
+    '''
+    Bytes held by the corpus arrays, and a shallow estimate of the
+    Python objects that own them. This is one loop over characters,
+    not a recursive walk, and it only needs to run once because
+    the arrays never change size.
+    '''
+
+    arraybytes = 0
+    objectbytes = sys.getsizeof(booklist)
+
+    for book in booklist:
+        arraybytes += book.themecounts.nbytes
+        objectbytes += sys.getsizeof(book) + sys.getsizeof(book.__dict__)
+        objectbytes += sys.getsizeof(book.characters) + sys.getsizeof(book.name)
+
+        for char in book.characters:
+            arraybytes += char.wordtypes.nbytes + char.topicassigns.nbytes
+            arraybytes += char.rolecounts.nbytes
+            objectbytes += sys.getsizeof(char) + sys.getsizeof(char.__dict__)
+            objectbytes += sys.getsizeof(char.name)
+            objectbytes += 3 * sys.getsizeof(np.zeros(0))
+
+    return arraybytes, objectbytes
+
+class MemoryMonitor:
+    '''
+    Records memory at named phases of a run: vocab, load, each sweep,
+    merge, output, pickle. Cheap enough to leave on; tracemalloc is
+    only used if tracing is True, since it slows allocation down.
+
+    Worker processes report their own RSS through gibbs.onepass,
+    and we hand those reports to checkpoint().
+    '''
+
+    def __init__(self, tracing = False, verbose = True):
+        self.tracing = tracing
+        self.verbose = verbose
+        self.records = []
+        self.corpusbytes = 0
+        self.objectbytes = 0
+
+        if tracing:
+            tracemalloc.start()
+
+    def set_corpus(self, booklist):
+        self.corpusbytes, self.objectbytes = measure_corpus(booklist)
+
+    def checkpoint(self, phase, twmatrix = None, ipcbytes = 0, workers = None):
+        '''
+        Records memory at the end of a phase.
+
+        twmatrix: the coordinator's topic-word matrix, if any
+        ipcbytes: bytes pickled between processes during the phase
+        workers: a list of dictionaries from memprofile.worker_memory
+        '''
+
+        record = dict()
+        record['phase'] = phase
+        record['rss'] = current_rss()
+        record['peakrss'] = max(peak_rss(), record['rss'])
+        record['corpus'] = self.corpusbytes
+        record['objects'] = self.objectbytes
+        record['ipc'] = ipcbytes
+
+        if twmatrix is not None:
+            record['twmatrix'] = twmatrix.nbytes
+        else:
+            record['twmatrix'] = 0
+
+        if workers:
+            record['workerrss'] = sum([w['rss'] for w in workers])
+            record['workerpeak'] = max([w['peakrss'] for w in workers])
+        else:
+            record['workerrss'] = 0
+            record['workerpeak'] = 0
+
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            record['traced'] = current
+            record['tracedpeak'] = peak
+            snapshot = tracemalloc.take_snapshot()
+            top = snapshot.statistics('lineno')[0 : 5]
+            record['top'] = [str(stat) for stat in top]
+            tracemalloc.reset_peak()
+
+        self.records.append(record)
+
+        if self.verbose:
+            line = 'Memory [' + phase + ']: RSS ' + format_bytes(record['rss'])
+            line += ' (peak ' + format_bytes(record['peakrss']) + ')'
+            if workers:
+                line += ', workers ' + format_bytes(record['workerrss'])
+                line += ' (largest peak ' + format_bytes(record['workerpeak']) + ')'
+            if self.tracing:
+                line += ', traced peak ' + format_bytes(record['tracedpeak'])
+            print(line)
+
+        return record
+
+    def report(self):
+        '''
+        Prints a summary: the phase with the highest RSS, and how the
+        bytes at that point divide among the corpus arrays, twmatrix,
+        IPC buffers and Python object overhead. Whatever is left of
+        the RSS is the interpreter, libraries and allocator slack.
+        '''
+
+        if len(self.records) == 0:
+            return
+
+        print()
+        print('Memory report')
+        print('-------------')
+
+        worst = max(self.records, key = lambda r: r['rss'])
+        print('Peak RSS of this process: ' + format_bytes(max([r['peakrss'] for r in self.records])))
+        print('Largest peak RSS of a worker: ' + format_bytes(max([r['workerpeak'] for r in self.records])))
+        print('Highest current RSS was after phase "' + worst['phase'] + '": ' + format_bytes(worst['rss']))
+
+        attributed = worst['corpus'] + worst['twmatrix'] + worst['ipc'] + worst['objects']
+        print('    corpus arrays: ' + format_bytes(worst['corpus']))
+        print('    twmatrix: ' + format_bytes(worst['twmatrix']))
+        print('    IPC buffers: ' + format_bytes(worst['ipc']))
+        print('    Python object overhead: ' + format_bytes(worst['objects']))
+        print('    unattributed: ' + format_bytes(max(worst['rss'] - attributed, 0)))
+
+        if self.tracing:
+            print()
+            print('Largest allocations traced after phase "' + worst['phase'] + '":')
+            for line in worst['top']:
+                print('    ' + line)
+
+        print()
@@ -0,0 +1,535 @@
+# outofcore.py
+
+# Gibbs sampling for corpora larger than RAM.
+
+# Instead of holding every Character in memory, we write the corpus
+# once to a directory of flat arrays: the word ids and the topic
+# assignments of all tokens, with characters grouped by book and
+# books grouped into blocks of roughly -blockwords tokens. Those two
+# arrays are memory-mapped. Each iteration the blocks are shuffled
+# and dealt out to workers the way shuffledivide deals out books; a
+# worker pages in one block at a time, rebuilds its Books, sweeps
+# them with gibbs.sweep, writes the new assignments back to its
+# region of the map, and lets the block go before taking the next.
+
+# So a worker holds the twmatrix, its changematrix, and one block.
+# Role and theme counts aren't stored at all: they are recomputed
+# from the assignments whenever a block is paged in.
+
+# The directory looks like this:
+#
+#     meta.pickle        vocabulary_list, dtypes
+#     wordtypes.npy      word id of every token
+#     charstarts.npy     token offset of each character (plus the end)
+#     bookstarts.npy     character offset of each book (plus the end)
+#     blockstarts.npy    book offset of each block (plus the end)
+#     charnames.txt      one character name per line, in the same order
+#     booknames.txt      one book name per line
+#
+# plus the state of a model:
+#
+#     state.pickle       constants, dtypes
+#     topicassigns.npy   topic of every token
+#     stability.npy      sweeps each token has kept its topic, with -skipafter
+#     rngstates.pickle   the random streams, written at the end of a run
+#
+# Since the assignments are updated in place, the directory is also
+# the saved state of the model: running again with the same -shards
+# directory resumes where the last run stopped.
+
+# The state can also live in a directory of its own, so that several
+# models share one copy of the tokens; see hypersweep.py.
+
+#     python3 infer_roles.py -source bestfic.txt -themes 60 -roles 180 -words 72000 -alpha .0005 -iterations 300 -numprocesses 18 -shards bestfic_shards -name bigmodel
+
+import os, pickle, time
+import gibbs, convergence, memplan, memprofile, infer_roles, sources
+import numpy as np
+from multiprocessing import Pool
+from progress import Progress
+
+def build_shards(path, lexicon, vocabulary_list, constants, maxlines, directory,
+    dtypes, blockwords, seed = None):
+    '''
+    Writes the corpus to directory, with random initial assignments
+    (see init_state) in the same directory. Returns the twmatrix.
+    '''
+
+    write_tokens(path, lexicon, vocabulary_list, maxlines, directory, dtypes, blockwords)
+    return init_state(directory, directory, constants, dtypes, seed)
+
+def write_tokens(path, lexicon, vocabulary_list, maxlines, directory, dtypes, blockwords):
+    '''
+    Writes the tokens of the corpus and the index to directory. Uses
+    the same rules as load_characters for which characters are kept.
+    Characters of a book need not be adjacent in the source; we make
+    one pass to lay out the arrays and a second to fill them.
+    '''
+
+    os.makedirs(directory, exist_ok = True)
+
+    # First pass: the book and length of every character we keep.
+
+    booknums = dict()
+    charbooks = []
+    charlengths = []
+    charnames = []
+
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        numwords = len([w for w in fields[2 : ] if w in lexicon])
+
+        if numwords > 32700 or numwords < 10:
+            continue
+
+        bookname = fields[0].split('|')[0]
+        if bookname not in booknums:
+            booknums[bookname] = len(booknums)
+
+        charbooks.append(booknums[bookname])
+        charlengths.append(numwords)
+        charnames.append(fields[0])
+
+    # Lay characters out grouped by book, in the order books first
+    # appeared; a stable sort keeps characters in source order.
+
+    charbooks = np.array(charbooks, dtype = 'int64')
+    charlengths = np.array(charlengths, dtype = 'int64')
+    order = np.argsort(charbooks, kind = 'stable')
+
+    charstarts = np.zeros(len(order) + 1, dtype = 'int64')
+    charstarts[1 : ] = np.cumsum(charlengths[order])
+
+    # where each character (in source order) begins
+    offsets = np.zeros(len(order), dtype = 'int64')
+    offsets[order] = charstarts[ : -1]
+
+    bookstarts = np.searchsorted(charbooks[order], np.arange(len(booknums) + 1))
+
+    blockstarts = [0]
+    for b in range(len(booknums)):
+        tokens = charstarts[bookstarts[b + 1]] - charstarts[bookstarts[blockstarts[-1]]]
+        if tokens >= blockwords:
+            blockstarts.append(b + 1)
+    if blockstarts[-1] != len(booknums):
+        blockstarts.append(len(booknums))
+
+    numtokens = int(charstarts[-1])
+
+    wordtypes = np.lib.format.open_memmap(os.path.join(directory, 'wordtypes.npy'),
+        mode = 'w+', dtype = dtypes['wordtypes'], shape = (numtokens,))
+
+    # Second pass: the tokens themselves.
+
+    charnum = 0
+
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        words = [lexicon[w] for w in fields[2 : ] if w in lexicon]
+
+        if len(words) > 32700 or len(words) < 10:
+            continue
+
+        start = offsets[charnum]
+        wordtypes[start : start + len(words)] = words
+        charnum += 1
+
+    wordtypes.flush()
+    del wordtypes
+
+    np.save(os.path.join(directory, 'charstarts.npy'), charstarts)
+    np.save(os.path.join(directory, 'bookstarts.npy'), bookstarts)
+    np.save(os.path.join(directory, 'blockstarts.npy'), np.array(blockstarts, dtype = 'int64'))
+
+    with open(os.path.join(directory, 'charnames.txt'), mode = 'w', encoding = 'utf-8') as f:
+        for i in order:
+            f.write(charnames[i] + '\n')
+
+    with open(os.path.join(directory, 'booknames.txt'), mode = 'w', encoding = 'utf-8') as f:
+        for bookname in booknums:
+            f.write(bookname + '\n')
+
+    meta = dict()
+    meta['vocabulary_list'] = vocabulary_list
+    meta['dtypes'] = dtypes
+    with open(os.path.join(directory, 'meta.pickle'), 'wb') as f:
+        pickle.dump(meta, f)
+
+def init_state(directory, statedir, constants, dtypes, seed = None):
+    '''
+    Starts a model on the tokens in directory: writes random topic
+    assignments to statedir, a block at a time. dtypes must hold
+    topicassigns, themecounts and twmatrix dtypes wide enough for
+    constants. The topics are drawn from the stream that
+    gibbs.init_generator spawns from seed, the run seed. Returns the
+    twmatrix.
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+    os.makedirs(statedir, exist_ok = True)
+
+    state = dict()
+    state['constants'] = constants
+    state['dtypes'] = dtypes
+    with open(os.path.join(statedir, 'state.pickle'), 'wb') as f:
+        pickle.dump(state, f)
+
+    corpus = ShardedCorpus(directory, statedir)
+    wordtypes = np.load(os.path.join(directory, 'wordtypes.npy'), mmap_mode = 'r')
+    topicassigns = np.lib.format.open_memmap(os.path.join(statedir, 'topicassigns.npy'),
+        mode = 'w+', dtype = dtypes['topicassigns'], shape = wordtypes.shape)
+
+    twmatrix = np.zeros((len(corpus.vocabulary_list), numtopics), dtype = dtypes['twmatrix'])
+    rng = gibbs.init_generator(seed)
+
+    for blocknum in range(corpus.numblocks):
+        start, end = corpus.block_tokens(blocknum)
+        topics = rng.integers(0, numtopics, size = end - start)
+        topicassigns[start : end] = topics
+        np.add.at(twmatrix, (wordtypes[start : end].astype('int64'), topics), 1)
+
+    topicassigns.flush()
+    del wordtypes, topicassigns
+
+    return twmatrix
+
+class ShardedCorpus:
+    '''
+    A corpus directory written by write_tokens, and the state of a
+    model in statedir (by default the same directory). Only the small
+    index arrays are opened here, and they are memory-mapped too; the
+    token arrays are mapped block by block.
+    '''
+
+    def __init__(self, directory, statedir = None):
+        self.directory = directory
+
+        if statedir is None:
+            self.statedir = directory
+        else:
+            self.statedir = statedir
+
+        with open(os.path.join(directory, 'meta.pickle'), 'rb') as f:
+            meta = pickle.load(f)
+
+        self.vocabulary_list = meta['vocabulary_list']
+
+        with open(os.path.join(self.statedir, 'state.pickle'), 'rb') as f:
+            state = pickle.load(f)
+
+        self.constants = state['constants']
+        self.dtypes = state['dtypes']
+
+        self.charstarts = np.load(os.path.join(directory, 'charstarts.npy'), mmap_mode = 'r')
+        self.bookstarts = np.load(os.path.join(directory, 'bookstarts.npy'), mmap_mode = 'r')
+        self.blockstarts = np.load(os.path.join(directory, 'blockstarts.npy'))
+        self.numblocks = len(self.blockstarts) - 1
+
+    def block_tokens(self, blocknum):
+        '''
+        The range of token offsets covered by a block.
+        '''
+
+        firstbook, endbook = self.blockstarts[blocknum], self.blockstarts[blocknum + 1]
+        return self.charstarts[self.bookstarts[firstbook]], self.charstarts[self.bookstarts[endbook]]
+
+    def map_tokens(self, mode = 'r'):
+        wordtypes = np.load(os.path.join(self.directory, 'wordtypes.npy'), mmap_mode = 'r')
+        topicassigns = np.load(os.path.join(self.statedir, 'topicassigns.npy'), mmap_mode = mode)
+        return wordtypes, topicassigns
+
+    def has_stability(self):
+        return os.path.exists(os.path.join(self.statedir, 'stability.npy'))
+
+    def init_stability(self):
+        '''
+        Creates the stability counts that gibbs.sweep keeps with
+        -skipafter (all zero), unless the state already has them.
+        Called by the coordinator, before any worker needs them.
+        '''
+
+        if self.has_stability():
+            return
+
+        stability = np.lib.format.open_memmap(os.path.join(self.statedir, 'stability.npy'),
+            mode = 'w+', dtype = 'uint8', shape = (int(self.charstarts[-1]), ))
+        stability.flush()
+        del stability
+
+    def map_stability(self, mode = 'r'):
+        return np.load(os.path.join(self.statedir, 'stability.npy'), mmap_mode = mode)
+
+    def load_block(self, blocknum, charnames = None, booknames = None):
+        '''
+        Pages in a block and rebuilds its Books and Characters, with
+        role and theme counts recomputed from the assignments.
+
+        charnames and booknames are optional iterators over the name
+        files, positioned at this block; without them the objects
+        are left unnamed, which is all a worker needs.
+        '''
+
+        numthemes, numtopics, alpha, beta = self.constants
+        numroles = numtopics - numthemes
+
+        wordtypes, topicassigns = self.map_tokens()
+        stability = self.map_stability() if self.has_stability() else None
+        books = []
+
+        for b in range(self.blockstarts[blocknum], self.blockstarts[blocknum + 1]):
+            bookname = next(booknames).rstrip('\n') if booknames is not None else ''
+            book = infer_roles.Book(bookname, numthemes, numroles, numtopics, self.dtypes)
+
+            for c in range(self.bookstarts[b], self.bookstarts[b + 1]):
+                start, end = self.charstarts[c], self.charstarts[c + 1]
+                charname = next(charnames).rstrip('\n') if charnames is not None else ''
+
+                char = infer_roles.Character(charname, wordtypes[start : end], book,
+                    numthemes, numroles, numtopics, self.dtypes, randomize = False)
+                char.topicassigns[ : ] = topicassigns[start : end]
+                if stability is not None:
+                    char.stability = np.array(stability[start : end])
+
+                roles = char.topicassigns[char.topicassigns >= numthemes].astype('int64') - numthemes
+                char.rolecounts[ : ] = np.bincount(roles, minlength = numroles)
+                themes = char.topicassigns[char.topicassigns < numthemes]
+                book.themecounts += np.bincount(themes, minlength = numthemes).astype(book.themecounts.dtype)
+
+                book.accept_character(char)
+
+            books.append(book)
+
+        del wordtypes, topicassigns, stability
+        return books
+
+    def save_block(self, blocknum, books):
+        '''
+        Writes the assignments of a block's Books back to its region
+        of the map.
+        '''
+
+        wordtypes, topicassigns = self.map_tokens(mode = 'r+')
+        start, end = self.block_tokens(blocknum)
+
+        topicassigns[start : end] = np.concatenate([char.topicassigns for book in books
+            for char in book.characters])
+
+        topicassigns.flush()
+        del wordtypes, topicassigns
+
+        # Tokens that gibbs.sweep has been tracking keep their counts
+        # for the next time the block is paged in.
+
+        characters = [char for book in books for char in book.characters]
+        if self.has_stability() and all([hasattr(char, 'stability') for char in characters]):
+            stability = self.map_stability(mode = 'r+')
+            stability[start : end] = np.concatenate([char.stability for char in characters])
+            stability.flush()
+            del stability
+
+    def iterbooks(self):
+        '''
+        All the books, one block at a time, with names.
+        '''
+
+        with open(os.path.join(self.directory, 'charnames.txt'), encoding = 'utf-8') as charnames:
+            with open(os.path.join(self.directory, 'booknames.txt'), encoding = 'utf-8') as booknames:
+                for blocknum in range(self.numblocks):
+                    for book in self.load_block(blocknum, charnames, booknames):
+                        yield book
+
+    def recreate_matrix(self):
+        '''
+        Rebuilds the twmatrix from the assignments, a block at a time,
+        as when resuming from a directory.
+        '''
+
+        numtopics = self.constants[1]
+        twmatrix = np.zeros((len(self.vocabulary_list), numtopics), dtype = self.dtypes['twmatrix'])
+        wordtypes, topicassigns = self.map_tokens()
+
+        for blocknum in range(self.numblocks):
+            start, end = self.block_tokens(blocknum)
+            np.add.at(twmatrix, (wordtypes[start : end].astype('int64'),
+                topicassigns[start : end].astype('int64')), 1)
+
+        return twmatrix
+
+def sweep_blocks(arguments):
+    '''
+    The function we map across a Pool: like gibbs.onepass, but the
+    worker is sent block numbers rather than books. Each block is
+    paged in, swept, written back and released in turn.
+
+    Returns the changematrix, the ratio of changed to unchanged
+    assignments, and the worker's statistics, which include the
+    state of its random stream.
+    '''
+
+    directory, statedir, blocknums, twmatrix, constants, theseed, settings = arguments
+
+    start = time.perf_counter()
+    rng = gibbs.make_generator(theseed)
+    corpus = ShardedCorpus(directory, statedir)
+    changematrix = np.zeros(twmatrix.shape, dtype = settings.get('changedtype', 'int16'))
+    tally = dict()
+
+    changeratios = []
+    for blocknum in blocknums:
+        books = corpus.load_block(blocknum)
+        changeratios.append(gibbs.sweep(books, twmatrix, changematrix, constants, settings,
+            rng = rng, tally = tally))
+        corpus.save_block(blocknum, books)
+        del books
+
+    if len(changeratios) == 0:
+        changeratios = [0]
+
+    workerstats = memprofile.worker_memory()
+    workerstats['rngstate'] = rng.bit_generator.state
+    workerstats['skipped'] = tally
+    workerstats['seconds'] = time.perf_counter() - start
+
+    return changematrix, np.mean(changeratios), workerstats
+
+def load_rngstates(directory):
+    path = os.path.join(directory, 'rngstates.pickle')
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def save_rngstates(directory, rngstates):
+    with open(os.path.join(directory, 'rngstates.pickle'), 'wb') as f:
+        pickle.dump(rngstates, f)
+
+def exists(directory):
+    return os.path.exists(os.path.join(directory, 'state.pickle'))
+
+def prepare(directory, sourcepath, numwords, constants, maxlines, blockwords, seed = None):
+    '''
+    Chooses a vocabulary and dtypes for the source, and writes it to
+    directory, with initial assignments drawn from seed (see
+    init_state). Returns the corpus and its twmatrix.
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+
+    survey = memplan.CorpusSurvey()
+    vocabulary_list, lexicon = infer_roles.get_vocab(sourcepath, numwords, maxlines, survey)
+    stats = survey.stats(lexicon)
+    del survey
+    dtypes = memplan.plan_dtypes(stats, numthemes, numtopics - numthemes)
+
+    print('Writing up to ' + str(stats['totalwords']) + ' tokens to ' + directory + ' ...')
+    twmatrix = build_shards(sourcepath, lexicon, vocabulary_list, constants, maxlines,
+        directory, dtypes, blockwords, seed)
+
+    return ShardedCorpus(directory), twmatrix
+
+def loglikelihood(corpus, twmatrix):
+    '''
+    get_loglikelihood over the whole corpus, a block at a time.
+    '''
+
+    logsum = 0
+    n = 0
+
+    for blocknum in range(corpus.numblocks):
+        books = corpus.load_block(blocknum)
+        blockwords = sum([book.totalwords for book in books])
+        logsum += infer_roles.get_loglikelihood(books, twmatrix, corpus.constants[0]) * blockwords
+        n += blockwords
+
+    return logsum / n
+
+def train(corpus, twmatrix, numiterations, numprocesses, settings, monitor, collector,
+    workerstates, shufflerng, stopper = None, progress = None):
+    '''
+    The counterpart of the Pool loop in infer_roles.py. Blocks are
+    reshuffled among the workers every iteration by shufflerng, and
+    workerstates (see gibbs.spawn_states) are updated in place. If
+    stopper (a convergence.StoppingRule) says so, we stop early.
+    progress, a progress.Progress, is updated every iteration.
+    Returns twmatrix.
+    '''
+
+    if stopper is None:
+        stopper = convergence.StoppingRule()
+
+    if progress is None:
+        progress = Progress(corpus.directory, numiterations, int(corpus.charstarts[-1]))
+
+    constants = corpus.constants
+    numtopics = constants[1]
+    blocknums = list(range(corpus.numblocks))
+    numprocesses = max(min(numprocesses, corpus.numblocks), 1)
+
+    print(str(corpus.numblocks) + ' blocks among ' + str(numprocesses) + ' processes.')
+
+    # With -skipafter, how long each token has kept its topic is saved
+    # with the state, since a block's Characters only last one sweep.
+
+    if 'skipstable' in settings:
+        corpus.init_stability()
+
+    for iteration in range(numiterations):
+        print("ITERATION: " + str(iteration))
+        collector.start(iteration)
+        progress.start(iteration)
+
+        if iteration % 50 == 10:
+            for r in range(numtopics):
+                infer_roles.print_topicwords(twmatrix, r, corpus.vocabulary_list, 16)
+            print()
+
+        blocksequences = infer_roles.shuffledivide(blocknums, numprocesses, shufflerng)
+
+        itersettings = dict(settings)
+        itersettings['profile'] = collector.wants(iteration)
+        itersettings['revisit'] = iteration % settings['revisitevery'] == 0
+
+        arguments = []
+        for i, seq in enumerate(blocksequences):
+            arguments.append((corpus.directory, corpus.statedir, seq, twmatrix, constants,
+                workerstates[i], itersettings))
+
+        pool = Pool(processes = numprocesses)
+        resultlist = pool.map(sweep_blocks, arguments)
+        pool.close()
+        pool.join()
+
+        ipcbytes = numprocesses * twmatrix.nbytes + sum([x[0].nbytes for x in resultlist])
+        monitor.checkpoint('sweep ' + str(iteration), twmatrix, ipcbytes,
+            [x[2] for x in resultlist])
+
+        gibbs.report_skipped([x[2] for x in resultlist])
+        progress.finish(iteration, np.mean([x[1] for x in resultlist]), [x[2] for x in resultlist])
+
+        changeratios = []
+        for i, (changematrix, changeratio, workerstats) in enumerate(resultlist):
+            twmatrix = twmatrix + changematrix
+            changeratios.append(changeratio)
+            collector.add_worker(iteration, i, workerstats)
+            workerstates[i] = workerstats['rngstate']
+
+        del resultlist, changematrix
+        monitor.checkpoint('merge ' + str(iteration), twmatrix)
+
+        print('Ratio of changed to unchanged topic assignments: ', np.mean(changeratios))
+        stopper.record_ratio(np.mean(changeratios))
+
+        if iteration % 20 == 1:
+            score = loglikelihood(corpus, twmatrix)
+            print("Log-likelihood per token: ", score)
+            print()
+            stopper.record_likelihood(score)
+            progress.likelihood(score)
+
+        collector.stop(iteration)
+
+        if stopper.should_stop(iteration):
+            break
+
+    return twmatrix
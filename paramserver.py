@@ -0,0 +1,583 @@
+# paramserver.py
+
+# Distributed sampling across several hosts. A coordinator process
+# holds the global topic-word matrix (twmatrix) and acts as a simple
+# parameter server; the books are divided into shards that live on
+# worker processes, which can be on this machine or on other hosts.
+
+# Each iteration a worker pulls fresh counts from the coordinator,
+# runs the usual conditional in gibbs.onepass over its shard, and
+# pushes back a sparse delta describing the changes it made. This
+# replaces the Pool.map_async step in infer_roles.py, which has to
+# fit on a single box.
+
+# Workers on other hosts are started with
+#
+#     python3 paramserver.py -connect coordinatorhost:6000 -authkey secret
+#
+# after the coordinator has been started with
+#
+#     python3 infer_roles.py ... -distributed 36 -address 0.0.0.0:6000 -authkey secret
+#
+# If no -address is given, the coordinator listens on localhost and
+# spawns the workers itself, which is also the way to test all this
+# on one machine.
+
+# There is also an asynchronous mode (-syncevery M). Instead of
+# waiting for each other at the end of every sweep, workers publish
+# their changes and refresh their view of twmatrix every M tokens.
+# The only thing that holds a worker back is the staleness bound:
+# it may not start a sweep more than -staleness sweeps ahead of the
+# slowest worker.
+
+import sys, time
+import gibbs, convergence, infer_roles, memprofile, profiling, trainer
+import numpy as np
+from multiprocessing import Process
+from multiprocessing.connection import Listener, Client, wait
+from progress import Progress
+
+def delta_bytes(delta):
+    return sum([x.nbytes for x in delta])
+
+def sparse_delta(changematrix):
+    '''
+    Turns a dense matrix of changes into a triplet of
+    (rows, columns, values) for the nonzero cells. After
+    the first few iterations most cells of a changematrix
+    are zero, so this is much cheaper to send over TCP.
+    '''
+
+    rows, cols = np.nonzero(changematrix)
+    values = changematrix[rows, cols].astype('int32')
+
+    return rows.astype('int32'), cols.astype('int32'), values
+
+def apply_delta(matrix, delta, sign = 1):
+    '''
+    Adds a sparse delta to a matrix in place. Each (row, column)
+    pair occurs only once in a delta, so fancy-indexed addition
+    is safe here.
+    '''
+
+    rows, cols, values = delta
+    matrix[rows, cols] += sign * values
+
+def merge_deltas(deltas, numtopics):
+    '''
+    Sums a list of sparse deltas into a single sparse delta,
+    so that each (row, column) pair occurs only once.
+    '''
+
+    rows = np.concatenate([d[0] for d in deltas] + [np.zeros(0, dtype = 'int32')])
+    cols = np.concatenate([d[1] for d in deltas] + [np.zeros(0, dtype = 'int32')])
+    values = np.concatenate([d[2] for d in deltas] + [np.zeros(0, dtype = 'int32')])
+
+    cells = rows.astype('int64') * numtopics + cols
+    cells, inverse = np.unique(cells, return_inverse = True)
+    values = np.bincount(inverse, weights = values, minlength = len(cells)).astype('int32')
+
+    nonzero = values != 0
+    cells = cells[nonzero]
+
+    return (cells // numtopics).astype('int32'), (cells % numtopics).astype('int32'), values[nonzero]
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+def run_worker(address, authkey):
+    '''
+    The worker side of the protocol. A worker receives its shard of
+    books once, then loops: pull counts, sweep the shard, push the
+    changes. At the end it sends the books back so the coordinator
+    can write the usual outputs.
+
+    The worker's copy of twmatrix is kept in step with the
+    coordinator by subtracting its own changes after each push;
+    the next pull then adds the merged changes from every worker.
+    '''
+
+    conn = Client(address, authkey = authkey)
+    conn.send(('hello',))
+
+    message = conn.recv()
+    assert message[0] == 'shard'
+    booksequence, constants, syncevery, settings, rngstate = message[1 : 6]
+    numthemes = constants[0]
+    twmatrix = None
+
+    shardwords = 0
+    for book in booksequence:
+        shardwords += book.totalwords
+
+    if syncevery > 0:
+        run_async_worker(conn, booksequence, constants, syncevery, shardwords, settings,
+            rngstate)
+        return
+
+    clock = 0
+
+    while True:
+        conn.send(('pull', clock))
+        message = conn.recv()
+
+        if message[0] == 'done':
+            break
+
+        command, counts, isdense, score = message
+
+        if isdense:
+            twmatrix = counts
+        else:
+            apply_delta(twmatrix, counts)
+
+        if score:
+            loglikelihood = infer_roles.get_loglikelihood(booksequence, twmatrix, numthemes)
+            scored = (loglikelihood, shardwords)
+        else:
+            scored = None
+
+        itersettings = dict(settings)
+        itersettings['profile'] = clock in settings.get('profileiterations', ())
+        itersettings['revisit'] = clock % settings['revisitevery'] == 0
+
+        changematrix, booksequence, changeratio, workerstats = gibbs.onepass((booksequence,
+            twmatrix, constants, rngstate, itersettings))
+        rngstate = workerstats['rngstate']
+
+        # onepass changed twmatrix in place; undo that so our copy
+        # matches the coordinator's until the next pull
+
+        twmatrix -= changematrix
+
+        conn.send(('push', clock, sparse_delta(changematrix), changeratio, scored,
+            workerstats))
+        clock += 1
+
+    conn.send(('books', booksequence))
+    conn.close()
+
+def run_async_worker(conn, booksequence, constants, syncevery, shardwords, settings,
+    rngstate):
+    '''
+    The worker side of the asynchronous mode. Every syncevery tokens
+    the worker pushes the changes it has made since the last push and
+    gets back whatever other workers have pushed in the meantime, so
+    its copy of twmatrix is never more than a few thousand tokens out
+    of date. At the end of a sweep it reports its clock and waits
+    until the staleness bound lets it start the next one.
+    '''
+
+    numthemes = constants[0]
+    clock = 0
+
+    conn.send(('pull', clock))
+    command, twmatrix, isdense, score = conn.recv()
+    rng = gibbs.make_generator(rngstate)
+
+    changematrix = np.zeros(twmatrix.shape, dtype = settings.get('changedtype', 'int16'))
+
+    def sync(changematrix):
+        conn.send(('push', sparse_delta(changematrix)))
+        changematrix[ : , : ] = 0
+        command, delta = conn.recv()
+        apply_delta(twmatrix, delta)
+        return twmatrix
+
+    while True:
+        if score:
+            loglikelihood = infer_roles.get_loglikelihood(booksequence, twmatrix, numthemes)
+            scored = (loglikelihood, shardwords)
+        else:
+            scored = None
+
+        itersettings = dict(settings)
+        itersettings['revisit'] = clock % settings['revisitevery'] == 0
+        tally = dict()
+        start = time.perf_counter()
+
+        if clock in settings.get('profileiterations', ()):
+            changeratio, profile = profiling.run_profiled(gibbs.sweep, booksequence,
+                twmatrix, changematrix, constants, itersettings, syncevery, sync, rng, tally)
+        else:
+            changeratio = gibbs.sweep(booksequence, twmatrix, changematrix, constants,
+                itersettings, syncevery, sync, rng, tally)
+            profile = None
+
+        workerstats = memprofile.worker_memory()
+        workerstats['rngstate'] = rng.bit_generator.state
+        workerstats['skipped'] = tally
+        workerstats['seconds'] = time.perf_counter() - start
+        if profile is not None:
+            workerstats['profile'] = profile
+
+        conn.send(('tick', clock, sparse_delta(changematrix), changeratio, scored,
+            workerstats))
+        changematrix[ : , : ] = 0
+        clock += 1
+
+        message = conn.recv()
+        if message[0] == 'done':
+            break
+
+        command, delta, score = message
+        apply_delta(twmatrix, delta)
+
+    conn.send(('books', booksequence))
+    conn.close()
+
+def spawn_local_workers(numworkers, address, authkey):
+    workers = []
+    for i in range(numworkers):
+        p = Process(target = run_worker, args = (address, authkey))
+        p.start()
+        workers.append(p)
+
+    return workers
+
+def coordinate(booklist, twmatrix, constants, vocabulary_list, numiterations,
+    numworkers, address = None, authkey = b'roles', syncevery = 0, staleness = 1,
+    settings = None, monitor = None, collector = None, workerstates = None, shufflerng = None,
+    stopper = None, progress = None):
+    '''
+    Runs the coordinator for numiterations iterations, or until
+    stopper says to stop, and returns the updated booklist and twmatrix.
+
+    booklist: the books to divide among workers
+    twmatrix: the global topic-word matrix; it lives only here
+    constants: (numthemes, numtopics, alpha, beta)
+    address: a "host:port" string to listen on; if None we listen
+        on a free localhost port and spawn the workers ourselves
+    syncevery: if positive, run asynchronously, with workers
+        exchanging changes every syncevery tokens
+    staleness: in asynchronous mode, how many sweeps the fastest
+        worker may get ahead of the slowest
+    settings: passed on to gibbs.onepass; see trainer.worker_settings
+    monitor: a memprofile.MemoryMonitor that records each sweep
+    collector: a profiling.ProfileCollector for the -profile option
+    workerstates: the state of each worker's random stream (see
+        gibbs.spawn_states); updated in place as workers report
+    shufflerng: the Generator that divides books among workers
+    stopper: a convergence.StoppingRule for early stopping
+    progress: a progress.Progress, updated every iteration
+    '''
+
+    if settings is None:
+        settings = trainer.worker_settings(twmatrix)
+
+    if monitor is None:
+        monitor = memprofile.MemoryMonitor(verbose = False)
+
+    if collector is None:
+        collector = profiling.ProfileCollector('', set())
+
+    if workerstates is None:
+        workerstates = gibbs.spawn_states(None, numworkers)
+
+    if stopper is None:
+        stopper = convergence.StoppingRule()
+
+    if progress is None:
+        progress = Progress('', numiterations, sum([book.totalwords for book in booklist]))
+
+    if address is None:
+        listener = Listener(('localhost', 0), authkey = authkey)
+        workers = spawn_local_workers(numworkers, listener.address, authkey)
+    else:
+        listener = Listener(parse_address(address), authkey = authkey)
+        workers = []
+
+    print('Coordinator listening on ' + str(listener.address))
+
+    conns = []
+    while len(conns) < numworkers:
+        conn = listener.accept()
+        assert conn.recv()[0] == 'hello'
+        conns.append(conn)
+        print('Worker ' + str(len(conns)) + ' of ' + str(numworkers) + ' connected.')
+
+    booksequences = infer_roles.shuffledivide(booklist, numworkers, shufflerng)
+    for conn, seq, rngstate in zip(conns, booksequences, workerstates):
+        conn.send(('shard', seq, constants, syncevery, settings, rngstate))
+
+    del booklist, booksequences
+
+    if syncevery > 0:
+        booklist = run_asynchronous(conns, twmatrix, constants, vocabulary_list,
+            numiterations, staleness, monitor, collector, workerstates, stopper, progress)
+    else:
+        booklist = run_synchronous(conns, twmatrix, constants, vocabulary_list,
+            numiterations, monitor, collector, workerstates, stopper, progress)
+
+    listener.close()
+    for p in workers:
+        p.join()
+
+    return booklist, twmatrix
+
+def run_synchronous(conns, twmatrix, constants, vocabulary_list, numiterations,
+    monitor, collector, workerstates, stopper, progress):
+    '''
+    Bulk-synchronous iterations: every worker pulls the same counts,
+    sweeps, and pushes; the merged changes become the next pull.
+    twmatrix is updated in place. Returns the collected books.
+    '''
+
+    numtopics = constants[1]
+    iterdelta = None
+
+    for iteration in range(numiterations):
+        print("ITERATION: " + str(iteration))
+        collector.start(iteration)
+        progress.start(iteration)
+
+        if iteration % 50 == 10:
+            for r in range(numtopics):
+                infer_roles.print_topicwords(twmatrix, r, vocabulary_list, 16)
+            print()
+
+        # Scoring happens at the start of the following iteration,
+        # against the counts produced by the iteration we want to score.
+
+        score = (iteration % 20 == 2)
+
+        for i, conn in enumerate(conns):
+            command, clock = conn.recv()
+            assert command == 'pull' and clock == iteration
+            if iterdelta is None:
+                conn.send(('counts', twmatrix, True, score))
+                ipcbytes = len(conns) * twmatrix.nbytes
+            else:
+                conn.send(('counts', iterdelta, False, score))
+                ipcbytes = len(conns) * delta_bytes(iterdelta)
+
+        merged = np.zeros(twmatrix.shape, dtype = 'int32')
+        changeratios = []
+        allstats = []
+        logsum = 0
+        scoredwords = 0
+
+        for i, conn in enumerate(conns):
+            command, clock, delta, changeratio, scored, workerstats = conn.recv()
+            assert command == 'push' and clock == iteration
+            apply_delta(merged, delta)
+            changeratios.append(changeratio)
+            collector.add_worker(iteration, i, workerstats)
+            workerstates[i] = workerstats['rngstate']
+            allstats.append(workerstats)
+            ipcbytes += delta_bytes(delta)
+            if scored is not None:
+                logsum += scored[0] * scored[1]
+                scoredwords += scored[1]
+
+        monitor.checkpoint('sweep ' + str(iteration), twmatrix, ipcbytes, allstats)
+
+        twmatrix += merged
+        iterdelta = sparse_delta(merged)
+        del merged
+
+        monitor.checkpoint('merge ' + str(iteration), twmatrix)
+
+        print('Ratio of changed to unchanged topic assignments: ', np.mean(changeratios))
+        stopper.record_ratio(np.mean(changeratios))
+        gibbs.report_skipped(allstats)
+        progress.finish(iteration, np.mean(changeratios), allstats)
+
+        if scoredwords > 0:
+            print("Log-likelihood per token: ", logsum / scoredwords)
+            print()
+            stopper.record_likelihood(logsum / scoredwords)
+            progress.likelihood(logsum / scoredwords)
+
+        collector.stop(iteration)
+
+        if stopper.should_stop(iteration):
+            break
+
+    booklist = []
+    for conn in conns:
+        command, clock = conn.recv()
+        assert command == 'pull'
+        conn.send(('done',))
+        command, booksequence = conn.recv()
+        assert command == 'books'
+        booklist.extend(booksequence)
+        conn.close()
+
+    return booklist
+
+def run_asynchronous(conns, twmatrix, constants, vocabulary_list, numiterations,
+    staleness, monitor, collector, workerstates, stopper, progress):
+    '''
+    Asynchronous iterations with bounded staleness. There is no
+    barrier: the coordinator simply answers whichever worker is
+    talking to it.
+
+    Every push is kept in a log, and each worker has a cursor into
+    the log; when it pushes, it gets back the merged changes other
+    workers have logged since its last visit. Entries are dropped
+    once every cursor has passed them.
+
+    An "iteration" here is complete when every worker has finished
+    that many sweeps of its shard, and that is when we report it.
+    Since the coordinator has no iteration boundaries of its own,
+    -profile only profiles the workers in this mode.
+
+    If stopper says to stop, no worker starts a sweep beyond the
+    furthest any worker has reached, so the others catch up to it.
+    '''
+
+    numtopics = constants[1]
+    numworkers = len(conns)
+
+    log = []
+    logstart = 0
+    cursors = [0] * numworkers
+    clocks = [0] * numworkers
+    waiting = set()
+    reported = 0
+    stopping = False
+
+    changeratios = dict()
+    scores = dict()
+    workerstats = [None] * numworkers
+    ipcbytes = 0
+    booklist = []
+
+    def catch_up(i):
+        delta = merge_deltas([d for author, d in log[cursors[i] - logstart : ]
+            if author != i], numtopics)
+        cursors[i] = logstart + len(log)
+        return delta
+
+    def record(i, delta):
+        nonlocal log, logstart
+        apply_delta(twmatrix, delta)
+        log.append((i, delta))
+        oldest = min([c for c in cursors if c is not None], default = logstart + len(log))
+        if oldest > logstart:
+            log = log[oldest - logstart : ]
+            logstart = oldest
+
+    for i, conn in enumerate(conns):
+        command, clock = conn.recv()
+        assert command == 'pull' and clock == 0
+        conn.send(('counts', twmatrix, True, False))
+
+    print("ITERATION: 0")
+
+    active = list(conns)
+    while len(active) > 0:
+
+        for conn in wait(active):
+            i = conns.index(conn)
+            message = conn.recv()
+
+            if message[0] == 'push':
+                record(i, message[1])
+                refresh = catch_up(i)
+                conn.send(('refresh', refresh))
+                ipcbytes += delta_bytes(message[1]) + delta_bytes(refresh)
+
+            elif message[0] == 'tick':
+                command, clock, delta, changeratio, scored, workerstats[i] = message
+                collector.add_worker(clock, i, workerstats[i])
+                workerstates[i] = workerstats[i]['rngstate']
+                record(i, delta)
+                ipcbytes += delta_bytes(delta)
+                clocks[i] = clock + 1
+                changeratios.setdefault(clock, []).append(changeratio)
+                if scored is not None:
+                    scores.setdefault(clock, []).append(scored)
+
+                if clocks[i] == numiterations:
+                    conn.send(('done',))
+                    cursors[i] = None
+                else:
+                    waiting.add(i)
+
+            elif message[0] == 'books':
+                booklist.extend(message[1])
+                conn.close()
+                active.remove(conn)
+
+        # Report iterations that every worker has now finished.
+
+        while reported < min(clocks):
+            ratio = np.mean(changeratios.pop(reported))
+            print('Ratio of changed to unchanged topic assignments: ', ratio)
+            stopper.record_ratio(ratio)
+            progress.finish(reported, ratio, [w for w in workerstats if w is not None])
+
+            if reported in scores:
+                scored = scores.pop(reported)
+                logsum = sum([x[0] * x[1] for x in scored])
+                print("Log-likelihood per token: ", logsum / sum([x[1] for x in scored]))
+                print()
+                stopper.record_likelihood(logsum / sum([x[1] for x in scored]))
+                progress.likelihood(logsum / sum([x[1] for x in scored]))
+
+            if not stopping and stopper.should_stop(reported):
+                stopping = True
+                numiterations = max(clocks)
+                for j in list(waiting):
+                    if clocks[j] >= numiterations:
+                        waiting.remove(j)
+                        conns[j].send(('done',))
+                        cursors[j] = None
+
+            monitor.checkpoint('sweep ' + str(reported), twmatrix, ipcbytes,
+                [w for w in workerstats if w is not None])
+            ipcbytes = 0
+
+            reported += 1
+            progress.start(reported)
+            if reported < numiterations:
+                print("ITERATION: " + str(reported))
+                print('Sweeps completed by each worker: ', clocks)
+
+                if reported % 50 == 10:
+                    for r in range(numtopics):
+                        infer_roles.print_topicwords(twmatrix, r, vocabulary_list, 16)
+                    print()
+
+        # Release workers that are within the staleness bound.
+
+        for i in list(waiting):
+            if clocks[i] - min(clocks) <= staleness:
+                waiting.remove(i)
+                score = (clocks[i] % 20 == 2)
+                conns[i].send(('refresh', catch_up(i), score))
+
+    return booklist
+
+if __name__ == '__main__':
+
+    # Books pickled by a coordinator that runs infer_roles.py as a script
+    # refer to __main__.Book and __main__.Character, so those names have
+    # to exist here too.
+
+    from infer_roles import Book, Character
+
+    args = sys.argv
+
+    address = None
+    authkey = b'roles'
+
+    for odd in range(1, len(args), 2):
+        even = odd + 1
+        if args[odd] == '-connect':
+            address = parse_address(args[even])
+
+        elif args[odd] == '-authkey':
+            authkey = args[even].encode('utf-8')
+
+        else:
+            print("I don't recognize the option " + args[odd])
+
+    if address is None:
+        print('Usage: python3 paramserver.py -connect host:port [-authkey key]')
+        sys.exit(1)
+
+    run_worker(address, authkey)
@@ -0,0 +1,133 @@
+# profiling.py
+
+# Optional profiling of the coordinator and of the Gibbs workers.
+
+# With -profile 10,50-52 we run cProfile in the coordinator and in
+# every worker during iterations 10, 50, 51 and 52. Workers send their
+# stats back with their other results (see gibbs.onepass), so this
+# also works for workers on other hosts. Each worker's stats are
+# dumped to a file, and at the end all of them are merged into one
+# report sorted by cumulative time.
+
+# When the option is off, the only cost is one dictionary lookup per
+# worker per iteration.
+
+import cProfile, pstats, marshal, os, io
+
+def parse_iterations(text):
+    '''
+    Reads a list like "10,50-52" into a set of iteration numbers.
+    '''
+
+    iterations = set()
+
+    for part in text.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            iterations.update(range(int(start), int(end) + 1))
+        elif part.strip():
+            iterations.add(int(part))
+
+    return iterations
+
+def run_profiled(function, *args):
+    '''
+    Calls function(*args) under cProfile. Returns the result, plus
+    the stats marshalled to bytes in the same format that
+    Profile.dump_stats writes, so they can cross a pipe or socket.
+    '''
+
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args)
+    profiler.create_stats()
+
+    return result, marshal.dumps(profiler.stats)
+
+class ProfileCollector:
+    '''
+    Lives in the coordinator. Profiles the coordinator's own work
+    for the selected iterations, writes out the stats that workers
+    send back, and merges everything at the end.
+
+    Files go in a directory named after the model:
+    modelname_profile/iteration10_worker0.prof and so on.
+    '''
+
+    def __init__(self, modelname, iterations):
+        self.iterations = iterations
+        self.directory = modelname + '_profile'
+        self.workerfiles = []
+        self.coordinatorfiles = []
+        self.profiler = None
+
+        if len(iterations) > 0:
+            os.makedirs(self.directory, exist_ok = True)
+
+    def wants(self, iteration):
+        return iteration in self.iterations
+
+    def start(self, iteration):
+        if self.wants(iteration):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self, iteration):
+        if self.profiler is not None:
+            self.profiler.disable()
+            path = os.path.join(self.directory, 'iteration' + str(iteration) + '_coordinator.prof')
+            self.profiler.dump_stats(path)
+            self.coordinatorfiles.append(path)
+            self.profiler = None
+
+    def add_worker(self, iteration, workernum, workerstats):
+        '''
+        workerstats is the statistics dictionary returned by
+        gibbs.onepass; if the worker was profiled it carries
+        marshalled stats under 'profile'.
+        '''
+
+        if 'profile' not in workerstats:
+            return
+
+        path = os.path.join(self.directory, 'iteration' + str(iteration) + '_worker' +
+            str(workernum) + '.prof')
+        with open(path, 'wb') as f:
+            f.write(workerstats.pop('profile'))
+        self.workerfiles.append(path)
+
+    def report(self, numlines = 30):
+        '''
+        Merges the coordinator's stats and the workers' stats into
+        two aggregated reports, sorted by cumulative time. Prints the
+        top lines of each and writes the full text to
+        modelname_profile/report.txt.
+        '''
+
+        if len(self.coordinatorfiles) + len(self.workerfiles) == 0:
+            return
+
+        out = io.StringIO()
+
+        for label, files in [('Coordinator', self.coordinatorfiles), ('Workers', self.workerfiles)]:
+            if len(files) == 0:
+                continue
+
+            out.write(label + ' (' + str(len(files)) + ' profiles merged)\n\n')
+            stats = pstats.Stats(files[0], stream = out)
+            for path in files[1 : ]:
+                stats.add(path)
+            stats.sort_stats('cumulative').print_stats()
+
+        fulltext = out.getvalue()
+        with open(os.path.join(self.directory, 'report.txt'), mode = 'w', encoding = 'utf-8') as f:
+            f.write(fulltext)
+
+        print()
+        print('Profile report (full text in ' + os.path.join(self.directory, 'report.txt') + ')')
+        for label, files in [('Coordinator', self.coordinatorfiles), ('Workers', self.workerfiles)]:
+            if len(files) == 0:
+                continue
+            print()
+            print(label + ', ' + str(len(files)) + ' profiles merged:')
+            stats = pstats.Stats(*files)
+            stats.sort_stats('cumulative').print_stats(numlines)
@@ -0,0 +1,144 @@
+# progress.py
+
+# A small HTTP endpoint that reports how a long run is going, in the
+# Prometheus text format, so several jobs on one machine can be
+# watched (or scraped) without reading their logs.
+
+# With -metricsport 9100, infer_roles.py serves
+# http://localhost:9100/metrics from a daemon thread. Port 0 picks a
+# free port, which is printed. Every metric carries a model label, so
+# one scraper can tell concurrent jobs apart. The metrics are:
+#
+#     roles_iteration               last completed iteration
+#     roles_iterations_total        iterations requested
+#     roles_tokens_per_second       over the last iteration
+#     roles_iteration_seconds       wall time of the last iteration
+#     roles_worker_seconds          time each worker spent sweeping
+#     roles_change_ratio            changed / unchanged assignments
+#     roles_loglikelihood           last log-likelihood per token
+#     roles_rss_bytes               RSS of this process and its workers
+#     roles_eta_seconds             at the average pace so far
+#
+# Without -metricsport nothing is served and updates just set a few
+# attributes.
+
+import threading, time
+import memprofile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Progress:
+    '''
+    Lives in the coordinator. The loop calls start at the top of each
+    iteration and finish at the end, and likelihood whenever it
+    scores the model.
+    '''
+
+    def __init__(self, modelname, numiterations, numtokens, port = None):
+        self.modelname = modelname
+        self.numiterations = numiterations
+        self.numtokens = numtokens
+
+        self.iteration = -1
+        self.starttime = time.time()
+        self.iterationstart = self.starttime
+        self.iterationseconds = 0.0
+        self.changeratio = float('nan')
+        self.loglikelihood = float('nan')
+        self.workerseconds = []
+        self.workerrss = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+        if port is not None:
+            self.serve(port)
+
+    def serve(self, port):
+        progress = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+
+                body = progress.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+
+        print('Metrics at http://localhost:' + str(self.server.server_address[1]) + '/metrics')
+
+    def start(self, iteration):
+        self.iterationstart = time.time()
+
+    def finish(self, iteration, changeratio, allstats = ()):
+        '''
+        allstats are the worker statistics returned with each worker's
+        results; see gibbs.onepass.
+        '''
+
+        with self.lock:
+            self.iteration = iteration
+            self.iterationseconds = time.time() - self.iterationstart
+            self.changeratio = changeratio
+            self.workerseconds = [x.get('seconds', 0.0) for x in allstats]
+            self.workerrss = [x.get('rss', 0) for x in allstats]
+
+    def likelihood(self, loglikelihood):
+        with self.lock:
+            self.loglikelihood = loglikelihood
+
+    def eta(self):
+        done = self.iteration + 1
+        if done == 0:
+            return float('nan')
+
+        pace = (time.time() - self.starttime) / done
+        return pace * max(self.numiterations - done, 0)
+
+    def render(self):
+        label = '{model="' + self.modelname + '"}'
+        lines = []
+
+        def metric(name, value):
+            lines.append('# TYPE roles_' + name + ' gauge')
+            lines.append('roles_' + name + label + ' ' + str(value))
+
+        with self.lock:
+            if self.iterationseconds > 0:
+                tokenspersec = self.numtokens / self.iterationseconds
+            else:
+                tokenspersec = 0.0
+
+            metric('iteration', self.iteration)
+            metric('iterations_total', self.numiterations)
+            metric('tokens_per_second', round(tokenspersec, 1))
+            metric('iteration_seconds', round(self.iterationseconds, 3))
+            metric('change_ratio', self.changeratio)
+            metric('loglikelihood', self.loglikelihood)
+            metric('rss_bytes', memprofile.current_rss() + sum(self.workerrss))
+            metric('eta_seconds', round(self.eta(), 1))
+
+            lines.append('# TYPE roles_worker_seconds gauge')
+            for i, seconds in enumerate(self.workerseconds):
+                lines.append('roles_worker_seconds{model="' + self.modelname + '",worker="' +
+                    str(i) + '"} ' + str(round(seconds, 3)))
+
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
@@ -0,0 +1,115 @@
+# snapshots.py
+
+# Writes output files from a child process. The samples mcmc_sample.py
+# writes every 20 iterations go to disk while the sweeps after them
+# run. At the end of a run there is nothing left to sample, so the
+# most we gain is overlapping the final writes with one another: a
+# child writes the doctopics and keys while the parent pickles the
+# state.
+
+# On systems with fork, the writer forks a child that does the
+# writing. The child sees the books and twmatrix exactly as they were
+# at the moment of the fork. Memory is shared copy-on-write, so the
+# snapshot is cheap only as long as the parent doesn't write to it:
+# pickling the same state at the end of a run costs very little, but
+# a sampler that goes on training while the child writes copies every
+# page it touches. The Trainer updates the twmatrix in place, and the
+# threaded sampler the packed corpus as well (see trainer.py and
+# threadsweep.py), so a snapshot taken mid-run can cost up to a full
+# copy of both. At most one snapshot is in flight: submitting another
+# waits for the previous child to finish.
+
+# Only the thread that forks exists in the child, so a lock another
+# thread held at the fork (in the allocator, or in logging, say) could
+# never be released there. We therefore only fork while this is the
+# process's only thread. Close the progress server and any thread
+# pool first (Trainer.close, Progress.close); otherwise, or where fork
+# isn't available, writes simply happen in the foreground.
+
+import os, sys, threading, time, traceback
+
+class SnapshotWriter:
+
+    def __init__(self):
+        self.child = None
+        self.label = None
+
+    def submit(self, label, function, *args):
+        '''
+        Calls function(*args) in a child process, after waiting for
+        any snapshot already in flight. Returns immediately. If other
+        threads are running, calls it here instead.
+        '''
+
+        self.wait()
+
+        if not hasattr(os, 'fork'):
+            function(*args)
+            return
+
+        if threading.active_count() > 1:
+            print('Other threads are running, so snapshot ' + label +
+                ' is written in the foreground.')
+            function(*args)
+            return
+
+        # Anything still buffered would otherwise be printed twice.
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+
+        if pid == 0:
+            status = 0
+            try:
+                function(*args)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        self.child = pid
+        self.label = label
+
+    def busy(self):
+        '''
+        True if a snapshot is still being written.
+        '''
+
+        if self.child is None:
+            return False
+
+        pid, status = os.waitpid(self.child, os.WNOHANG)
+        if pid == 0:
+            return True
+
+        self.finish(status)
+        return False
+
+    def wait(self):
+        '''
+        Blocks until the snapshot in flight, if any, is written.
+        '''
+
+        if self.child is None:
+            return
+
+        start = time.time()
+        pid, status = os.waitpid(self.child, 0)
+        waited = time.time() - start
+
+        if waited > 1:
+            print('Waited ' + str(round(waited, 1)) + ' seconds for snapshot ' + self.label + '.')
+
+        self.finish(status)
+
+    def finish(self, status):
+        if os.waitstatus_to_exitcode(status) != 0:
+            print('Writing snapshot ' + self.label + ' failed.')
+
+        self.child = None
+        self.label = None
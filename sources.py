@@ -0,0 +1,135 @@
+# sources.py
+
+# Reads character lines from one source or several, plain or
+# compressed.
+
+# A source can be a path, a glob ("bestbio*.txt.gz"), a comma-
+# separated list of either, or a Python list of them, so
+# bestbiofic.txt no longer has to be built by concatenating files by
+# hand. Files ending in .gz are read with gzip, and files ending in
+# .zst with the zstandard package if it is installed. maxlines
+# counts lines across all the files together.
+
+# Compressed files are decompressed and split into lines by a
+# background thread, which hands batches of lines to the parser
+# through a bounded queue. zlib and zstandard release the GIL while
+# they work, so decompression overlaps with parsing. Plain files are
+# read directly with a large buffer.
+
+import glob, gzip, io, queue, threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFERSIZE = 2 ** 22
+BATCHLINES = 4096
+
+def expand(source):
+    '''
+    Turns a source into a list of paths, in order. Globs are sorted;
+    a pattern that matches nothing is kept as a path, so that opening
+    it raises the usual error.
+    '''
+
+    if isinstance(source, (list, tuple)):
+        parts = source
+    else:
+        parts = source.split(',')
+
+    paths = []
+    for part in parts:
+        part = part.strip()
+        matches = sorted(glob.glob(part))
+        if len(matches) > 0:
+            paths.extend(matches)
+        elif part:
+            paths.append(part)
+
+    return paths
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(path, 'rb'), BUFFERSIZE),
+            encoding = 'utf-8')
+
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('Reading ' + path + ' needs the zstandard package.')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd = True)
+        return io.TextIOWrapper(io.BufferedReader(reader, BUFFERSIZE), encoding = 'utf-8')
+
+    else:
+        return open(path, encoding = 'utf-8', buffering = BUFFERSIZE)
+
+def background_lines(path):
+    '''
+    Yields the lines of a compressed file, decompressed by a
+    separate thread.
+    '''
+
+    batches = queue.Queue(maxsize = 16)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            with open_text(path) as f:
+                batch = []
+                for line in f:
+                    batch.append(line)
+                    if len(batch) == BATCHLINES:
+                        batches.put(batch)
+                        batch = []
+                        if stop.is_set():
+                            return
+                batches.put(batch)
+        except Exception as error:
+            batches.put(error)
+        finally:
+            batches.put(None)
+
+    thread = threading.Thread(target = produce, daemon = True)
+    thread.start()
+
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            elif isinstance(batch, Exception):
+                raise batch
+            for line in batch:
+                yield line
+    finally:
+        # If the caller stopped early, let the thread finish quietly.
+
+        stop.set()
+        while thread.is_alive():
+            try:
+                batches.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+
+def read_lines(source, maxlines = None):
+    '''
+    Yields lines from every file in source in turn, stopping after
+    maxlines lines in all.
+    '''
+
+    sofar = 0
+
+    for path in expand(source):
+        if path.endswith('.gz') or path.endswith('.zst'):
+            lines = background_lines(path)
+        else:
+            lines = open_text(path)
+
+        try:
+            for line in lines:
+                sofar += 1
+                if maxlines is not None and sofar > maxlines:
+                    return
+                yield line
+        finally:
+            lines.close()
@@ -0,0 +1,125 @@
+# splitbooks.py
+
+# Lets the characters of one very large book be swept by several
+# workers at once.
+
+# shuffledivide deals out whole books, because themecounts live on the
+# Book. So a book with thousands of characters is swept by a single
+# worker while the others wait for it. With -splitwords n, every book
+# with more than n words is cut, between characters, into pieces of
+# about n words, and the pieces are dealt out like books.
+
+# Each piece carries its own copy of the book's theme counts, and the
+# characters in it point to the piece rather than the book, so a
+# worker updates the piece's counts just as it would a book's. After
+# the sweep, each piece's change to its theme counts is added back to
+# the book, in the same way workers' changematrices are added to the
+# twmatrix. As with the twmatrix, a worker doesn't see the changes
+# other workers make to the same book until the next iteration.
+
+#     python3 infer_roles.py -source bestfic.txt -themes 60 -roles 180 -words 72000 -alpha .0005 -iterations 300 -numprocesses 18 -splitwords 200000
+
+import numpy as np
+
+class BookPiece:
+    '''
+    Stands in for a Book in gibbs.sweep, covering a run of its
+    characters. totalwords is the length of the whole book, since
+    that is what theme proportions are relative to; basecounts are
+    the book's theme counts when the piece was cut.
+    '''
+
+    def __init__(self, book, characters, index):
+        self.name = book.name
+        self.numthemes = book.numthemes
+        self.index = index
+        self.totalwords = book.totalwords
+        self.basecounts = book.themecounts.copy()
+        self.themecounts = book.themecounts.copy()
+        self.characters = characters
+
+        for char in characters:
+            char.book = self
+
+    def increment_decrement(self, topicnum, change):
+        self.themecounts[topicnum] = self.themecounts[topicnum] + change
+
+def cut(characters, maxwords):
+    '''
+    Splits a list of characters into consecutive runs of about
+    maxwords words each (but at least one character).
+    '''
+
+    runs = []
+    run = []
+    runwords = 0
+
+    for char in characters:
+        if len(run) > 0 and runwords + char.numwords > maxwords:
+            runs.append(run)
+            run = []
+            runwords = 0
+        run.append(char)
+        runwords += char.numwords
+
+    if len(run) > 0:
+        runs.append(run)
+
+    return runs
+
+def split_books(booklist, maxwords):
+    '''
+    Returns the units to deal out to workers (books of at most
+    maxwords words, and pieces of larger ones) and a dictionary of
+    the books that were split, by name, to pass to rejoin.
+    '''
+
+    units = []
+    wholes = dict()
+
+    for book in booklist:
+        if book.totalwords <= maxwords or len(book.characters) < 2:
+            units.append(book)
+            continue
+
+        wholes[book.name] = book
+        for index, run in enumerate(cut(book.characters, maxwords)):
+            units.append(BookPiece(book, run, index))
+
+    return units, wholes
+
+def rejoin(units, wholes):
+    '''
+    Turns the units workers sent back into a list of books. The
+    characters of each split book are put back in order and pointed
+    at the book, and its theme counts get every piece's change.
+    '''
+
+    booklist = []
+    pieces = dict()
+
+    for unit in units:
+        if isinstance(unit, BookPiece):
+            if unit.name not in pieces:
+                pieces[unit.name] = []
+                booklist.append(wholes[unit.name])
+            pieces[unit.name].append(unit)
+        else:
+            booklist.append(unit)
+
+    for name, bookpieces in pieces.items():
+        book = wholes[name]
+        bookpieces.sort(key = lambda piece: piece.index)
+
+        change = np.zeros(len(book.themecounts), dtype = 'int64')
+        characters = []
+        for piece in bookpieces:
+            change += piece.themecounts.astype('int64') - piece.basecounts
+            characters.extend(piece.characters)
+
+        book.themecounts = (book.themecounts + change).astype(book.themecounts.dtype)
+        book.characters = characters
+        for char in characters:
+            char.book = book
+
+    return booklist
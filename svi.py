@@ -0,0 +1,386 @@
+# svi.py
+
+# Stochastic variational inference for the same two-level model of
+# book-level "themes" and character-level "roles."
+
+# Collapsed Gibbs sampling (gibbs.py) has to keep every token's topic
+# assignment in RAM. This trainer instead streams minibatches of books
+# from disk, fits their local parameters, and nudges the global
+# topic-word parameters (lambda) toward what the minibatch implies,
+# with a step size that decays as (tau0 + t) ** -kappa. Nothing about
+# a book is kept after its minibatch, so memory scales with
+# vocabulary x topics rather than with the size of the corpus.
+
+# The local parameters mirror the data structure in infer_roles.py:
+# each book has a vector over themes, and each of its characters has
+# a vector over roles. As in the Gibbs conditional, a word's weight
+# for theme t is roughly the fraction of the book's words in t, and
+# its weight for role r the fraction of the character's words in r,
+# each plus alpha.
+
+# Books are recognized as runs of consecutive lines whose ids share
+# the same prefix before '|', so the source should be grouped by book
+# (as bestfic.txt is).
+
+# Usage:
+#
+#     python3 svi.py -source bestfic.txt -themes 60 -roles 180 -words 72000 -alpha .0005 -batchsize 256 -epochs 2 -name sviA
+
+import csv, sys, time
+import sources
+import numpy as np
+from scipy.special import psi
+from infer_roles import get_vocab
+
+def stream_books(path, lexicon, maxlines):
+    '''
+    Yields one book at a time as (bookname, characters), where each
+    character is (charname, wordids, counts) with the unique word ids
+    in the character and how often each occurs. Applies the same
+    length limits as load_characters.
+    '''
+
+    bookname = None
+    characters = []
+
+    for line in sources.read_lines(path, maxlines):
+        fields = line.strip().split()
+        charname = fields[0]
+        wordtypes = [lexicon[w] for w in fields[2 : ] if w in lexicon]
+
+        if len(wordtypes) > 32700 or len(wordtypes) < 10:
+            continue
+
+        thisbook = charname.split('|')[0]
+        if thisbook != bookname:
+            if len(characters) > 0:
+                yield bookname, characters
+            bookname = thisbook
+            characters = []
+
+        wordids, counts = np.unique(np.array(wordtypes, dtype = 'int32'), return_counts = True)
+        characters.append((charname, wordids, counts))
+
+    if len(characters) > 0:
+        yield bookname, characters
+
+def count_books(path, lexicon, maxlines):
+    numbooks = 0
+    for bookname, characters in stream_books(path, lexicon, maxlines):
+        numbooks += 1
+    return numbooks
+
+def minibatches(path, lexicon, maxlines, batchsize):
+    batch = []
+    for book in stream_books(path, lexicon, maxlines):
+        batch.append(book)
+        if len(batch) == batchsize:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+class OnlineRoleModel:
+    '''
+    Holds the global variational parameters, lambda (words x topics),
+    and fits the local parameters of one book at a time.
+
+    Topics are numbered as everywhere else: themes first, then roles.
+    lambda starts from a random draw seeded by seed, an int or anything
+    else SeedSequence accepts.
+    '''
+
+    def __init__(self, numwords, numthemes, numroles, alpha, eta, numbooks,
+        tau0 = 64, kappa = 0.7, seed = None):
+
+        self.numthemes = numthemes
+        self.numroles = numroles
+        self.numtopics = numthemes + numroles
+        self.alpha = alpha
+        self.eta = eta
+        self.numbooks = numbooks
+        self.tau0 = tau0
+        self.kappa = kappa
+        self.updates = 0
+
+        rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed)))
+        self.lam = rng.gamma(100, 1 / 100, (numwords, self.numtopics))
+        self.refresh_beta()
+
+    def refresh_beta(self):
+        self.topictotals = np.sum(self.lam, axis = 0)
+        elogbeta = psi(self.lam) - psi(self.topictotals)
+        self.expelogbeta = np.exp(elogbeta)
+
+    def fit_book(self, characters, maxiter = 100, tolerance = 0.001):
+        '''
+        Fits the local parameters of one book, with every character
+        handled at once: the (character, word) pairs of the whole book
+        are stacked into one array.
+
+        Returns the book's theme pseudo-counts (numthemes), the roles'
+        pseudo-counts (characters x numroles), the expected topic
+        counts for each (character, word) pair, the pairs' word ids,
+        and the log-likelihood of the book's words (see loglikelihood).
+        '''
+
+        T = self.numthemes
+        numchars = len(characters)
+
+        wordids = np.concatenate([c[1] for c in characters])
+        counts = np.concatenate([c[2] for c in characters]).astype('float64')
+        sizes = np.array([len(c[1]) for c in characters])
+        starts = np.concatenate([[0], np.cumsum(sizes)[ : -1]])
+        charindex = np.repeat(np.arange(numchars), sizes)
+
+        charwords = np.add.reduceat(counts, starts)
+        bookwords = np.sum(charwords)
+
+        # The Gibbs sampler adds alpha to fractions of the book or
+        # character, so in pseudo-counts the prior scales with length.
+
+        themeprior = self.alpha * bookwords
+        roleprior = self.alpha * charwords[ : , np.newaxis]
+        themenorm = psi(bookwords * (1 + T * self.alpha))
+        rolenorm = psi(charwords * (1 + self.numroles * self.alpha))[ : , np.newaxis]
+
+        themegamma = np.full(T, themeprior + bookwords / self.numtopics)
+        rolegamma = np.tile(roleprior + charwords[ : , np.newaxis] / self.numtopics, (1, self.numroles))
+
+        wordbeta = self.expelogbeta[wordids]
+
+        for i in range(maxiter):
+            exptheme = np.exp(psi(themegamma) - themenorm)
+            exprole = np.exp(psi(rolegamma) - rolenorm)
+
+            weights = np.concatenate([np.tile(exptheme, (numchars, 1)), exprole], axis = 1)
+            responsibility = weights[charindex] * wordbeta
+            normalizer = np.sum(responsibility, axis = 1) + 1e-100
+            expected = responsibility * (counts / normalizer)[ : , np.newaxis]
+
+            newtheme = themeprior + np.sum(expected[ : , : T], axis = 0)
+            newrole = roleprior + np.add.reduceat(expected[ : , T : ], starts, axis = 0)
+
+            # Either level can be empty, and the mean of nothing is nan.
+
+            change = 0.0
+            if T > 0:
+                change += np.mean(np.abs(newtheme - themegamma))
+            if self.numroles > 0:
+                change += np.mean(np.abs(newrole - rolegamma))
+            themegamma, rolegamma = newtheme, newrole
+
+            if change < tolerance:
+                break
+
+        booklog = self.loglikelihood(expected, wordids, counts, charindex, starts, charwords)
+
+        return themegamma, rolegamma, expected, wordids, booklog
+
+    def loglikelihood(self, expected, wordids, counts, charindex, starts, charwords):
+        '''
+        The log-likelihood of one book's words given point estimates,
+        as in infer_roles.get_loglikelihood: a character draws topic k
+        in proportion to the fraction of its book (for a theme) or of
+        itself (for a role) expected in k, plus alpha, and a topic
+        draws words by topicwords(). Unlike the Gibbs version we sum
+        over topics rather than take each token's sampled topic, so
+        this runs a little higher than Gibbs on the same model.
+        '''
+
+        T = self.numthemes
+        bookwords = np.sum(charwords)
+
+        themefraction = np.sum(expected[ : , : T], axis = 0) / bookwords
+        rolefraction = np.add.reduceat(expected[ : , T : ], starts, axis = 0) / charwords[ : , np.newaxis]
+
+        weights = np.concatenate([np.tile(themefraction, (len(charwords), 1)), rolefraction],
+            axis = 1) + self.alpha
+        weights = weights / np.sum(weights, axis = 1, keepdims = True)
+
+        wordprobs = self.lam[wordids] / self.topictotals
+        pairprobs = np.sum(weights[charindex] * wordprobs, axis = 1)
+
+        return np.sum(counts * np.log(pairprobs + 1e-100))
+
+    def update(self, batch):
+        '''
+        One stochastic step on a minibatch of books. Returns the
+        log-likelihood per token of the minibatch under the parameters
+        before the step (see loglikelihood).
+        '''
+
+        sstats = np.zeros(self.lam.shape)
+        logsum = 0
+        numtokens = 0
+
+        for bookname, characters in batch:
+            themegamma, rolegamma, expected, wordids, booklog = self.fit_book(characters)
+            np.add.at(sstats, wordids, expected)
+            logsum += booklog
+            numtokens += np.sum(expected)
+
+        # The sufficient statistics of a minibatch, scaled up as if the
+        # whole corpus looked like it, times the responsibilities'
+        # missing factor of expelogbeta (folded into expected already).
+
+        rho = (self.tau0 + self.updates) ** -self.kappa
+        target = self.eta + sstats * (self.numbooks / len(batch))
+        self.lam = (1 - rho) * self.lam + rho * target
+        self.refresh_beta()
+        self.updates += 1
+
+        return logsum / max(numtokens, 1)
+
+    def topicwords(self):
+        '''
+        The expected topic-word matrix, normalized by topic.
+        '''
+
+        return self.lam / np.sum(self.lam, axis = 0)
+
+def write_keys(model, vocabulary_list, modelname):
+    '''
+    Writes keys in the same format as infer_roles.py, with the
+    estimated number of words in each topic as the second column.
+    '''
+
+    expectedcounts = model.lam - model.eta
+
+    with open(modelname + '_keys.tsv', mode = 'w', encoding = 'utf-8') as f:
+        for r in range(model.numtopics):
+            order = np.argsort(-model.lam[ : , r])[0 : 100]
+            topn = [vocabulary_list[i] for i in order]
+            line = str(r) + '\t' + str(int(np.sum(expectedcounts[ : , r]))) + '\t' + '\t'.join(topn) + '\n'
+            f.write(line)
+
+def write_doctopics(model, path, lexicon, maxlines, modelname):
+    '''
+    A final streaming pass that fits each book against the trained
+    lambda and writes doctopics in the same format as infer_roles.py:
+    expected words per topic for each character, then for the book.
+    '''
+
+    numthemes, numtopics = model.numthemes, model.numtopics
+
+    outfields = ['bookorchar', 'docid', 'fraction']
+    outfields.extend(["theme" + str(i) for i in range(0, numthemes)])
+    outfields.extend(["role" + str(i) for i in range(numthemes, numtopics)])
+
+    with open(modelname + "_doctopics.tsv", mode = 'w', encoding = 'utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames = outfields, delimiter = '\t')
+        writer.writeheader()
+
+        for bookname, characters in stream_books(path, lexicon, maxlines):
+            themegamma, rolegamma, expected, wordids, booklog = model.fit_book(characters)
+            sizes = [len(c[1]) for c in characters]
+            starts = np.concatenate([[0], np.cumsum(sizes)[ : -1]])
+            vectors = np.add.reduceat(expected, starts, axis = 0)
+
+            for (charname, ids, counts), vector in zip(characters, vectors):
+                writer.writerow(vector_row('char', charname, vector, numthemes, numtopics))
+
+            bookvector = np.sum(vectors, axis = 0)
+            writer.writerow(vector_row('book', bookname, bookvector, numthemes, numtopics))
+
+def vector_row(bookorchar, docid, vector, numthemes, numtopics):
+    out = dict()
+    out['bookorchar'] = bookorchar
+    out['docid'] = docid
+    for i in range(numthemes):
+        out['theme' + str(i)] = vector[i]
+    for i in range(numthemes, numtopics):
+        out['role' + str(i)] = vector[i]
+    return out
+
+if __name__ == '__main__':
+
+    args = sys.argv
+
+    modelname = 'noneyet'
+    maxlines = 500000
+    batchsize = 256
+    numepochs = 1
+    tau0 = 64
+    kappa = 0.7
+    eta = 0.1
+    runseed = None
+
+    for odd in range(1, len(args), 2):
+        even = odd + 1
+        if args[odd] == '-themes':
+            numthemes = int(args[even])
+
+        elif args[odd] == '-roles':
+            numroles = int(args[even])
+
+        elif args[odd] == '-words':
+            numwords = int(args[even])
+
+        elif args[odd] == '-alpha':
+            alphamean = float(args[even])
+
+        elif args[odd] == '-source':
+            sourcepath = args[even]
+
+        elif args[odd] == '-name':
+            modelname = args[even]
+
+        elif args[odd] == '-maxlines':
+            maxlines = int(args[even])
+
+        elif args[odd] == '-batchsize':
+            batchsize = int(args[even])
+
+        elif args[odd] == '-epochs':
+            numepochs = int(args[even])
+
+        elif args[odd] == '-tau0':
+            tau0 = float(args[even])
+
+        elif args[odd] == '-kappa':
+            kappa = float(args[even])
+
+        elif args[odd] == '-seed':
+            runseed = int(args[even])
+
+        else:
+            print("I don't recognize the option " + args[odd])
+
+    # Print the seed so the run can be repeated with -seed.
+
+    if runseed is None:
+        runseed = np.random.SeedSequence().entropy
+        print('Run seed: ' + str(runseed))
+
+    vocabulary_list, lexicon = get_vocab(sourcepath, numwords, maxlines)
+    numbooks = count_books(sourcepath, lexicon, maxlines)
+    print('Streaming ' + str(numbooks) + ' books in minibatches of ' + str(batchsize) + '.')
+
+    model = OnlineRoleModel(len(vocabulary_list), numthemes, numroles, alphamean, eta,
+        numbooks, tau0, kappa, runseed)
+
+    for epoch in range(numepochs):
+        print("EPOCH: " + str(epoch))
+        start = time.time()
+
+        for batchnum, batch in enumerate(minibatches(sourcepath, lexicon, maxlines, batchsize)):
+            loglikelihood = model.update(batch)
+            if batchnum % 20 == 0:
+                print('Batch ' + str(batchnum) + ', log-likelihood per token: ', loglikelihood)
+
+        print('Epoch took ' + str(round(time.time() - start, 1)) + ' seconds.')
+
+    print()
+    print('Writing keys ...')
+    write_keys(model, vocabulary_list, modelname)
+
+    print()
+    print('Writing doctopics ...')
+    write_doctopics(model, sourcepath, lexicon, maxlines, modelname)
+
+    np.savez(modelname + '_svi.npz', lam = model.lam, vocabulary = np.array(vocabulary_list),
+        constants = np.array([numthemes, numroles, alphamean, eta]))
+
+    print()
+    print('Done.')
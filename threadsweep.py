@@ -0,0 +1,257 @@
+# threadsweep.py
+
+# Gibbs sampling with threads in one process, rather than a Pool.
+
+# With a Pool, every iteration pickles the twmatrix out to each
+# worker and the books out and back. Here the corpus is packed once
+# into flat arrays (word ids and assignments of all tokens, a row of
+# role counts per character and a row of theme counts per book) and
+# every Character and Book is rebound to views of them, so there is
+# one copy of the corpus and nothing is ever serialized.
+
+# Each iteration the books are dealt out with shuffledivide, as in
+# the Pool loop, and each thread sweeps its shard with a kernel
+# compiled by numba, which releases the GIL. Threads all read the
+# same twmatrix and none of them writes it: each accumulates its
+# changes in a delta matrix of its own and sees twmatrix + delta, as
+# a Pool worker sees its own copy. The deltas are added to twmatrix
+# once every thread has finished, so the model is exactly the one a
+# Pool with the same shards would produce.
+
+# numba is optional; without it -threads is ignored. The kernel does
+# not implement -wordorder or -skipafter.
+
+#     python3 infer_roles.py -source bestfic.txt -themes 60 -roles 180 -words 72000 -alpha .0005 -iterations 300 -threads 18
+
+import time
+import gibbs, memplan, infer_roles
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Each thread hands the kernel about this many tokens at a time,
+# with as many uniforms drawn from its stream.
+
+CHUNKTOKENS = 2 ** 20
+
+def available():
+    return numba is not None
+
+def compiled(function):
+    if numba is None:
+        return function
+    return numba.njit(nogil = True, cache = True, error_model = 'numpy')(function)
+
+class SharedCorpus:
+    '''
+    The flat arrays behind every Character and Book in booklist.
+    Characters are numbered in booklist order, so the characters of
+    book b are bookstarts[b] up to bookstarts[b + 1], and the tokens
+    of character c are charstarts[c] up to charstarts[c + 1].
+    '''
+
+    def __init__(self, booklist, constants):
+        numthemes, numtopics = constants[0 : 2]
+        numroles = numtopics - numthemes
+
+        characters = [char for book in booklist for char in book.characters]
+        lengths = np.array([char.numwords for char in characters], dtype = 'int64')
+        charsperbook = np.array([len(book.characters) for book in booklist], dtype = 'int64')
+
+        self.numbooks = len(booklist)
+        self.charstarts = np.concatenate([[0], np.cumsum(lengths)])
+        self.bookstarts = np.concatenate([[0], np.cumsum(charsperbook)])
+        self.booktokens = np.diff(self.charstarts[self.bookstarts])
+
+        # Characters loaded at different times (see incremental.py)
+        # can have different dtypes, so take the widest.
+
+        self.wordtypes = np.zeros(self.charstarts[-1],
+            dtype = np.result_type(*[char.wordtypes.dtype for char in characters]))
+        self.topicassigns = np.zeros(self.charstarts[-1],
+            dtype = np.result_type(*[char.topicassigns.dtype for char in characters]))
+        self.rolecounts = np.zeros((len(characters), numroles),
+            dtype = memplan.smallest_unsigned(np.max(lengths, initial = 0)))
+        self.themecounts = np.zeros((len(booklist), numthemes),
+            dtype = np.result_type(*[book.themecounts.dtype for book in booklist]))
+
+        for c, char in enumerate(characters):
+            start, stop = self.charstarts[c], self.charstarts[c + 1]
+            self.wordtypes[start : stop] = char.wordtypes
+            self.topicassigns[start : stop] = char.topicassigns
+            self.rolecounts[c] = char.rolecounts
+            char.wordtypes = self.wordtypes[start : stop]
+            char.topicassigns = self.topicassigns[start : stop]
+            char.rolecounts = self.rolecounts[c]
+
+        for b, book in enumerate(booklist):
+            self.themecounts[b] = book.themecounts
+            book.themecounts = self.themecounts[b]
+
+@compiled
+def sweep_kernel(books, bookstarts, charstarts, wordtypes, topicassigns, rolecounts,
+    themecounts, twmatrix, delta, topicnormalizer, alpha, beta, numthemes, uniforms):
+    '''
+    The conditional of gibbs.sweep, written out token by token so
+    that numba can compile it. twmatrix is only read; this thread's
+    changes go to delta and to its own topicnormalizer.
+
+    Returns the numbers of unchanged and changed assignments.
+    '''
+
+    numtopics = twmatrix.shape[1]
+    cumulative = np.zeros(numtopics)
+    position = 0
+    same = 0
+    different = 0
+
+    for b in books:
+        firstchar = bookstarts[b]
+        lastchar = bookstarts[b + 1]
+        totalwords = charstarts[lastchar] - charstarts[firstchar]
+
+        for c in range(firstchar, lastchar):
+            numwords = charstarts[c + 1] - charstarts[c]
+
+            for idx in range(charstarts[c], charstarts[c + 1]):
+                w = wordtypes[idx]
+                z = topicassigns[idx]
+
+                if z < numthemes:
+                    themecounts[b, z] -= 1
+                else:
+                    rolecounts[c, z - numthemes] -= 1
+                delta[w, z] -= 1
+                topicnormalizer[z] -= 1
+
+                total = 0.0
+                for t in range(numtopics):
+                    if t < numthemes:
+                        docprob = themecounts[b, t] / totalwords
+                    else:
+                        docprob = rolecounts[c, t - numthemes] / numwords
+                    wordprob = (twmatrix[w, t] + delta[w, t] + beta) / topicnormalizer[t]
+                    total += (docprob + alpha[t]) * wordprob
+                    cumulative[t] = total
+
+                # the first topic whose cumulative weight exceeds the
+                # draw, as searchsorted(side = 'right') finds it
+
+                threshold = uniforms[position] * total
+                position += 1
+                chosentopic = 0
+                while chosentopic < numtopics - 1 and cumulative[chosentopic] <= threshold:
+                    chosentopic += 1
+
+                if chosentopic == z:
+                    same += 1
+                else:
+                    different += 1
+
+                topicassigns[idx] = chosentopic
+                if chosentopic < numthemes:
+                    themecounts[b, chosentopic] += 1
+                else:
+                    rolecounts[c, chosentopic - numthemes] += 1
+                delta[w, chosentopic] += 1
+                topicnormalizer[chosentopic] += 1
+
+    return same, different
+
+def sweep_shard(corpus, books, twmatrix, constants, theseed, changedtype):
+    '''
+    Runs in a thread: sweeps the books numbered in books, a chunk of
+    about CHUNKTOKENS tokens at a time. Returns the delta, the ratio
+    of changed to unchanged assignments, and worker statistics like
+    those of gibbs.onepass.
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+
+    rng = gibbs.make_generator(theseed)
+    start = time.perf_counter()
+
+    delta = np.zeros(twmatrix.shape, dtype = changedtype)
+    topicnormalizer = np.sum(twmatrix, axis = 0, dtype = 'int64')
+    alpha = np.asarray(alpha, dtype = 'float64')
+
+    same = 0
+    different = 0
+    first = 0
+
+    while first < len(books):
+        last = first
+        numtokens = 0
+        while last < len(books) and (numtokens < CHUNKTOKENS or last == first):
+            numtokens += corpus.booktokens[books[last]]
+            last += 1
+
+        uniforms = rng.random(numtokens)
+        chunksame, chunkdifferent = sweep_kernel(books[first : last], corpus.bookstarts,
+            corpus.charstarts, corpus.wordtypes, corpus.topicassigns, corpus.rolecounts,
+            corpus.themecounts, twmatrix, delta, topicnormalizer, alpha, float(beta),
+            numthemes, uniforms)
+        same += chunksame
+        different += chunkdifferent
+        first = last
+
+    workerstats = dict()
+    workerstats['rngstate'] = rng.bit_generator.state
+    workerstats['skipped'] = {'visited': same + different, 'skipped': 0}
+    workerstats['seconds'] = time.perf_counter() - start
+
+    return delta, (different + 1) / (same + 1), workerstats
+
+class ThreadSampler:
+    '''
+    Packs booklist into a SharedCorpus and keeps a pool of numthreads
+    threads for the run. changedtype is the dtype of each thread's
+    delta; see memplan.py.
+    '''
+
+    def __init__(self, booklist, constants, numthreads, changedtype = 'int32'):
+        self.corpus = SharedCorpus(booklist, constants)
+        self.numthreads = max(min(numthreads, len(booklist)), 1)
+        self.changedtype = changedtype
+        self.executor = ThreadPoolExecutor(max_workers = self.numthreads)
+
+        print('Packed ' + str(len(self.corpus.wordtypes)) + ' tokens for ' +
+            str(self.numthreads) + ' threads.')
+
+    def sweep(self, twmatrix, constants, workerstates, shufflerng):
+        '''
+        One pass over every book. workerstates (see
+        gibbs.spawn_states) are updated in place, and twmatrix has
+        every thread's delta added to it.
+
+        Returns twmatrix, the change ratio of each thread, and the
+        statistics of each thread.
+        '''
+
+        booknums = list(range(self.corpus.numbooks))
+        booksequences = infer_roles.shuffledivide(booknums, self.numthreads, shufflerng)
+
+        futures = []
+        for i, seq in enumerate(booksequences):
+            futures.append(self.executor.submit(sweep_shard, self.corpus,
+                np.array(seq, dtype = 'int64'), twmatrix, constants, workerstates[i],
+                self.changedtype))
+
+        results = [future.result() for future in futures]
+
+        changeratios = []
+        allstats = []
+        for i, (delta, changeratio, workerstats) in enumerate(results):
+            twmatrix += delta
+            changeratios.append(changeratio)
+            allstats.append(workerstats)
+            workerstates[i] = workerstats['rngstate']
+
+        return twmatrix, changeratios, allstats
+
+    def close(self):
+        self.executor.shutdown()
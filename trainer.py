@@ -0,0 +1,659 @@
+# trainer.py
+
+# Training driven from Python rather than the command line, so that a
+# notebook or a sweep tool can run a model a few iterations at a time
+# and read its counts without going through TSVs and a pickle.
+
+#     import trainer
+#
+#     model = trainer.Trainer.from_source('bestfic.txt', 60, 180, 72000, 0.0005,
+#         numprocesses = 18, modelname = 'sixthmodel')
+#     model.add_callback(lambda model: print(model.iteration, model.changeratio))
+#     model.step(50)
+#
+#     model.topic_word()      # words x topics
+#     model.role_counts()     # characters x roles
+#     model.theme_counts()    # books x themes
+#
+#     model.train(300)
+#     model.save()
+
+# A Trainer holds the books and the twmatrix in this process, and
+# sweeps them with a Pool, with threads (see threadsweep.py) or, with
+# one process, in this process. infer_roles.py builds one for every
+# run that doesn't use -shards or -distributed.
+
+# The count arrays are views of flat arrays that every Character and
+# Book shares (see threadsweep.SharedCorpus), packed the first time
+# they are asked for. With threads, or in one process, they stay live
+# as training goes on. A Pool sends back new books each iteration, so
+# there they are packed afresh after every step. topic_word is the
+# twmatrix itself, which is always updated in place.
+
+import pickle
+import numpy as np
+from multiprocessing import Pool
+import gibbs, memplan, memprofile, profiling, incremental, snapshots, infer_roles
+import hyperopt, convergence, warmstart, coherence, progress, threadsweep, splitbooks, evaluate
+
+def worker_settings(twmatrix, wordorder = False, skipafter = 0, skipprob = 0.1,
+    revisitevery = 10, profileiterations = ()):
+    '''
+    The settings every worker gets with its books; see gibbs.onepass.
+    '''
+
+    settings = dict()
+
+    # No cell of a worker's changematrix can move by more than the
+    # frequency of its word.
+
+    settings['changedtype'] = memplan.smallest_signed(np.max(np.sum(twmatrix, axis = 1,
+        dtype = 'int64'), initial = 0))
+
+    # With -profile, run cProfile here and in the workers during the
+    # selected iterations.
+
+    settings['profileiterations'] = set(profileiterations)
+
+    # With -wordorder true, workers visit each character's tokens
+    # grouped by word id, which keeps rows of twmatrix in cache.
+
+    settings['wordorder'] = wordorder
+
+    # With -skipafter k, tokens that have kept their topic for k sweeps
+    # are resampled only with probability -skipprob, except that every
+    # token is resampled every -revisitevery iterations. See gibbs.sweep.
+    # Every sampler reads revisitevery from here, so local, out-of-core
+    # and distributed runs revisit at the same rate.
+
+    if revisitevery < 1:
+        raise ValueError('revisitevery must be at least 1, not ' + str(revisitevery))
+
+    if skipafter > 0:
+        settings['skipstable'] = (min(skipafter, 255), skipprob)
+    settings['revisitevery'] = revisitevery
+
+    return settings
+
+def random_streams(runseed, numworkers, rngstates = None):
+    '''
+    Each worker gets its own random stream, spawned from the run
+    seed, and the last stream shuffles books among workers. Their
+    states are saved with the model, so resuming picks up the same
+    streams where they left off (if the number of workers is the same).
+
+    Returns the workers' states and the shuffling Generator.
+    '''
+
+    numstreams = numworkers + 1
+    if rngstates is None or len(rngstates) != numstreams:
+        rngstates = gibbs.spawn_states(runseed, numstreams)
+
+    return list(rngstates[ : -1]), gibbs.make_generator(rngstates[-1])
+
+def load_source(sourcepath, numthemes, numroles, numwords, alphamean, maxlines,
+    membudget = None, numworkers = 1, monitor = None, seed = None):
+    '''
+    Reads a corpus and gives every word a random topic, drawn from a
+    stream spawned from seed (see gibbs.init_generator).
+
+    Returns booklist, twmatrix, constants and vocabulary_list.
+    '''
+
+    numtopics = numthemes + numroles
+    beta = 0.1
+    alpha = np.array([alphamean] * numtopics)
+
+    constants = (numthemes, numtopics, alpha, beta)
+
+    survey = memplan.CorpusSurvey()
+    vocabulary_list, lexicon = infer_roles.get_vocab(sourcepath, numwords, maxlines, survey)
+    if monitor is not None:
+        monitor.checkpoint('vocab')
+
+    # Choose the smallest safe dtypes and check the projected RAM
+    # against membudget before allocating anything.
+
+    dtypes = memplan.plan(survey.stats(lexicon), numthemes, numroles, numworkers, membudget)
+    del survey
+
+    allbooks, twmatrix = infer_roles.load_characters(sourcepath, lexicon,
+        numthemes, numroles, maxlines, dtypes, gibbs.init_generator(seed))
+
+    booklist = []
+    for bookname, book in allbooks.items():
+        booklist.append(book)
+
+    if monitor is not None:
+        monitor.set_corpus(booklist)
+        monitor.checkpoint('load', twmatrix)
+
+    return booklist, twmatrix, constants, vocabulary_list
+
+def load_saved(modelpath, numthemes = None, numroles = None, addsource = None,
+    numwords = None, maxlines = 500000, foldinsweeps = 2, seed = None, monitor = None):
+    '''
+    Loads a pickled model. If numthemes or numroles differ from the
+    saved model, its assignments are carried over into the new topic
+    space (see warmstart.py); if addsource is given, its new
+    characters are folded in (see incremental.py). seed drives both.
+
+    Returns booklist, twmatrix, constants, vocabulary_list and the
+    saved random streams.
+    '''
+
+    booklist, constants, vocabulary_list, twmatrix, rngstates = infer_roles.load_model(modelpath)
+
+    if numthemes is None:
+        numthemes = constants[0]
+    if numroles is None:
+        numroles = constants[1] - constants[0]
+
+    if (numthemes, numroles) != (constants[0], constants[1] - constants[0]):
+        print('Resizing to ' + str(numthemes) + ' themes and ' + str(numroles) + ' roles.')
+        booklist, twmatrix, constants = warmstart.resize_model(booklist, twmatrix,
+            constants, numthemes, numroles, np.random.default_rng(seed))
+
+    if addsource is not None:
+
+        # Unless numwords says otherwise, the vocabulary may grow by 10%.
+
+        if numwords is None:
+            numwords = int(len(vocabulary_list) * 1.1)
+
+        booklist, twmatrix, vocabulary_list = incremental.grow_model(booklist,
+            twmatrix, constants, vocabulary_list, addsource, numwords, maxlines,
+            foldinsweeps, np.random.default_rng(seed))
+
+    if monitor is not None:
+        monitor.set_corpus(booklist)
+        monitor.checkpoint('load', twmatrix)
+
+    return booklist, twmatrix, constants, vocabulary_list, rngstates
+
+def save_model(modelname, booklist, twmatrix, constants, vocabulary_list, rngstates,
+    monitor = None):
+    '''
+    Writes doctopics and keys (in a child process; see snapshots.py)
+    while the state is pickled to modelname.pickle. Sampling is over
+    by then, so the two writes overlap only each other.
+    '''
+
+    numthemes, numtopics = constants[0 : 2]
+
+    writer = snapshots.SnapshotWriter()
+    writer.submit('output', infer_roles.write_outputs, booklist, twmatrix, vocabulary_list,
+        modelname, numthemes, numtopics)
+
+    print()
+    print('Pickling state ...')
+
+    saveobject = dict()
+
+    saveobject['booklist'] = booklist
+    saveobject['constants'] = constants
+    saveobject['vocabulary_list'] = vocabulary_list
+    saveobject['rngstates'] = rngstates
+
+    with open(modelname + '.pickle', 'wb') as f:
+        pickle.dump(saveobject, f)
+
+    if monitor is not None:
+        monitor.checkpoint('pickle', twmatrix)
+
+    writer.wait()
+
+    if monitor is not None:
+        monitor.checkpoint('output', twmatrix)
+
+class Trainer:
+    '''
+    Samples a model held in memory, an iteration at a time.
+
+    booklist, twmatrix, constants and vocabulary_list are what
+    infer_roles.load_characters and load_model produce. The keyword
+    arguments are the options of infer_roles.py with the same names:
+
+    numprocesses, numthreads, splitwords: how to parallelize
+    seed, rngstates: the run seed, and saved streams to resume
+    wordorder, skipafter, skipprob, revisitevery: see gibbs.sweep
+    optimizeevery, optimizeafter: see hyperopt.py
+    coherencewords: see coherence.py
+    profileiterations: see profiling.py
+    stopper: a convergence.StoppingRule for train
+    numiterations: the length of the run, for train and for the ETA
+    metricsport: see progress.py
+    monitor: a memprofile.MemoryMonitor, if the caller has one
+    '''
+
+    def __init__(self, booklist, twmatrix, constants, vocabulary_list, modelname = 'noneyet',
+        numprocesses = 1, numthreads = 0, splitwords = 0, seed = None, rngstates = None,
+        wordorder = False, skipafter = 0, skipprob = 0.1, revisitevery = 10,
+        optimizeevery = 0, optimizeafter = 20, coherencewords = 0, profileiterations = (),
+        stopper = None, numiterations = 300, metricsport = None, monitor = None):
+
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+            print('Run seed: ' + str(seed))
+
+        self.booklist = booklist
+        self.twmatrix = twmatrix
+        self.constants = constants
+        self.vocabulary_list = vocabulary_list
+        self.modelname = modelname
+        self.numprocesses = numprocesses
+        self.splitwords = splitwords
+        self.optimizeevery = optimizeevery
+        self.optimizeafter = optimizeafter
+        self.coherencewords = coherencewords
+        self.numiterations = numiterations
+
+        self.iteration = 0
+        self.changeratio = float('nan')
+        self.loglikelihood = float('nan')
+        self.callbacks = []
+        self.stopped = False
+        self.packed = None
+
+        if monitor is None:
+            monitor = memprofile.MemoryMonitor(verbose = False)
+            monitor.set_corpus(booklist)
+        self.monitor = monitor
+
+        if stopper is None:
+            stopper = convergence.StoppingRule()
+        self.stopper = stopper
+
+        self.settings = worker_settings(twmatrix, wordorder, skipafter, skipprob,
+            revisitevery, profileiterations)
+        self.collector = profiling.ProfileCollector(modelname, self.settings['profileiterations'])
+
+        # With coherencewords n, score the top n words of every topic
+        # against a word-by-character index built now.
+
+        self.coherenceindex = None
+        if coherencewords > 0:
+            self.coherenceindex = coherence.CoherenceIndex(booklist, len(vocabulary_list))
+            monitor.checkpoint('coherence index', twmatrix)
+
+        # With numthreads n, n threads in this process sweep one shared
+        # copy of the corpus with a compiled kernel.
+
+        self.sampler = None
+        if numthreads > 0 and not threadsweep.available():
+            print('Threads need numba; ignoring -threads and using -numprocesses.')
+            numthreads = 0
+        elif numthreads > 0:
+            if wordorder or skipafter > 0:
+                print('The threaded kernel ignores -wordorder and -skipafter.')
+            self.sampler = threadsweep.ThreadSampler(booklist, constants, numthreads,
+                self.settings['changedtype'])
+            monitor.checkpoint('pack', twmatrix)
+
+        if splitwords > 0 and (numprocesses < 2 or self.sampler is not None):
+            print('Books are only split for local multiprocessing; ignoring -splitwords.')
+            self.splitwords = 0
+
+        self.workerstates, self.shufflerng = random_streams(seed,
+            max(numprocesses, numthreads, 1), rngstates)
+
+        numtokens = sum([book.totalwords for book in booklist])
+        self.tracker = progress.Progress(modelname, numiterations, numtokens, metricsport)
+
+        # Books are dealt out to the Pool at the end of every iteration
+        # (unless they are being split; see pool_pass).
+
+        if self.sampler is None and numprocesses > 1 and self.splitwords == 0:
+            self.booksequences = infer_roles.shuffledivide(booklist, numprocesses,
+                self.shufflerng)
+            print("Sequences: ", len(self.booksequences))
+
+    @classmethod
+    def from_source(cls, sourcepath, numthemes, numroles, numwords, alphamean,
+        maxlines = 500000, membudget = None, **options):
+        '''
+        Reads a corpus (see sources.py for what sourcepath can be) and
+        starts a model on it with random assignments. options are
+        passed to the constructor.
+        '''
+
+        if options.get('seed', None) is None:
+            options['seed'] = np.random.SeedSequence().entropy
+            print('Run seed: ' + str(options['seed']))
+
+        numworkers = max(options.get('numprocesses', 1), options.get('numthreads', 0))
+        booklist, twmatrix, constants, vocabulary_list = load_source(sourcepath, numthemes,
+            numroles, numwords, alphamean, maxlines, membudget, numworkers,
+            options.get('monitor', None), options['seed'])
+
+        return cls(booklist, twmatrix, constants, vocabulary_list, **options)
+
+    @classmethod
+    def from_saved(cls, modelpath, numthemes = None, numroles = None, addsource = None,
+        numwords = None, maxlines = 500000, foldinsweeps = 2, **options):
+        '''
+        Resumes a model pickled by save; see load_saved.
+        '''
+
+        if options.get('seed', None) is None:
+            options['seed'] = np.random.SeedSequence().entropy
+            print('Run seed: ' + str(options['seed']))
+
+        booklist, twmatrix, constants, vocabulary_list, rngstates = load_saved(modelpath,
+            numthemes, numroles, addsource, numwords, maxlines, foldinsweeps,
+            options['seed'], options.get('monitor', None))
+
+        options.setdefault('rngstates', rngstates)
+
+        return cls(booklist, twmatrix, constants, vocabulary_list, **options)
+
+    def add_callback(self, function):
+        '''
+        function(trainer) is called after every iteration. If it
+        returns True, step and train stop after that iteration.
+        '''
+
+        self.callbacks.append(function)
+
+    def step(self, n = 1):
+        '''
+        Runs n more iterations, or fewer if a callback asks to stop.
+        Returns the last ratio of changed to unchanged assignments.
+        '''
+
+        self.stopped = False
+
+        for i in range(n):
+            self.sweep()
+            if self.stopped:
+                break
+
+        return self.changeratio
+
+    def train(self, numiterations = None):
+        '''
+        Steps until numiterations iterations have run in all (by
+        default, the numiterations the trainer was made with), or until
+        the stopping rule or a callback says to stop.
+        '''
+
+        if numiterations is None:
+            numiterations = self.numiterations
+
+        while self.iteration < numiterations:
+            self.step()
+            if self.stopped or self.stopper.should_stop(self.iteration - 1):
+                break
+
+        return self.changeratio
+
+    def sweep(self):
+        iteration = self.iteration
+        numthemes, numtopics, alpha, beta = self.constants
+
+        print("ITERATION: " + str(iteration))
+        self.collector.start(iteration)
+        self.tracker.start(iteration)
+
+        optimizing = self.optimizeevery > 0 and iteration >= self.optimizeafter and \
+            (iteration - self.optimizeafter) % self.optimizeevery == 0
+
+        if iteration % 50 == 10:
+            for r in range(numtopics):
+                infer_roles.print_topicwords(self.twmatrix, r, self.vocabulary_list, 16)
+            print()
+
+            if self.coherenceindex is not None:
+                self.coherenceindex.report(self.twmatrix, numthemes, self.coherencewords)
+
+        if self.sampler is not None:
+            histograms = self.threaded_pass(iteration, optimizing)
+        elif self.numprocesses > 1:
+            histograms = self.pool_pass(iteration, optimizing)
+        else:
+            histograms = self.local_pass(iteration, optimizing)
+
+        if optimizing:
+            # Workers reduced their books to count histograms, so
+            # the fixed point runs on those rather than on the books.
+
+            alpha = hyperopt.update_alpha(alpha, numthemes, histograms)
+            self.constants = (numthemes, numtopics, alpha, beta)
+            print(hyperopt.describe(alpha, numthemes))
+
+        if iteration % 20 == 1:
+            self.loglikelihood = infer_roles.get_loglikelihood(self.booklist, self.twmatrix,
+                numthemes)
+            print("Log-likelihood per token: ", self.loglikelihood)
+            print()
+            self.stopper.record_likelihood(self.loglikelihood)
+            self.tracker.likelihood(self.loglikelihood)
+
+        self.collector.stop(iteration)
+        self.iteration += 1
+
+        for function in self.callbacks:
+            if function(self):
+                self.stopped = True
+
+    def threaded_pass(self, iteration, optimizing):
+        self.twmatrix, changeratios, allstats = self.sampler.sweep(self.twmatrix, self.constants,
+            self.workerstates, self.shufflerng)
+        self.monitor.checkpoint('sweep ' + str(iteration), self.twmatrix)
+        self.tracker.finish(iteration, np.mean(changeratios), allstats)
+
+        self.changeratio = np.mean(changeratios)
+        print('Ratio of changed to unchanged topic assignments: ', self.changeratio)
+        self.stopper.record_ratio(self.changeratio)
+
+        if optimizing:
+            return hyperopt.count_histograms(self.booklist)
+
+    def iteration_settings(self, iteration, histograms):
+        '''
+        The worker settings for this iteration; see gibbs.onepass.
+        '''
+
+        itersettings = dict(self.settings)
+        itersettings['profile'] = self.collector.wants(iteration)
+        itersettings['histograms'] = histograms
+        itersettings['revisit'] = iteration % self.settings['revisitevery'] == 0
+
+        return itersettings
+
+    def local_pass(self, iteration, optimizing):
+        '''
+        One iteration in this process, through gibbs.onepass with the
+        first worker's stream, so it samples exactly as a Pool worker
+        would. Returns the count histograms if optimizing.
+        '''
+
+        itersettings = self.iteration_settings(iteration, optimizing)
+
+        # The collector already profiles this process, and cProfile
+        # can't run inside another profiler.
+
+        itersettings['profile'] = False
+
+        # The sweep updates the books and twmatrix in place, so its
+        # changematrix has nothing left to merge.
+
+        changematrix, books, changeratio, workerstats = gibbs.onepass((self.booklist,
+            self.twmatrix, self.constants, self.workerstates[0], itersettings))
+        del changematrix
+
+        self.workerstates[0] = workerstats['rngstate']
+        self.collector.add_worker(iteration, 0, workerstats)
+        self.monitor.checkpoint('sweep ' + str(iteration), self.twmatrix)
+
+        gibbs.report_skipped([workerstats])
+        self.tracker.finish(iteration, changeratio, [workerstats])
+
+        self.changeratio = changeratio
+        print('Ratio of changed to unchanged topic assignments: ', self.changeratio)
+        self.stopper.record_ratio(self.changeratio)
+
+        if optimizing:
+            return workerstats['histograms']
+
+    def pool_pass(self, iteration, optimizing):
+        '''
+        One iteration with a Pool. Returns the merged count histograms
+        if optimizing.
+        '''
+
+        monitor = self.monitor
+        numprocesses = self.numprocesses
+
+        # The characters of a split book point to its pieces until
+        # rejoin, so books are cut afresh every iteration.
+
+        if self.splitwords > 0:
+            units, wholes = splitbooks.split_books(self.booklist, self.splitwords)
+            self.booksequences = infer_roles.shuffledivide(units, numprocesses, self.shufflerng)
+
+        quadruplets = []
+
+        itersettings = self.iteration_settings(iteration, optimizing and self.splitwords == 0)
+
+        for seq, seed in zip(self.booksequences, self.workerstates):
+            quadruplets.append((seq, self.twmatrix, self.constants, seed, itersettings))
+
+        print('Multiprocessing ...')
+        pool = Pool(processes = numprocesses)
+        res = pool.map_async(gibbs.onepass, quadruplets)
+        res.wait()
+        resultlist = res.get()
+        pool.close()
+        pool.join()
+
+        # Each worker was sent the twmatrix and its books, and sent
+        # back its books and a changematrix.
+
+        ipcbytes = numprocesses * self.twmatrix.nbytes + 2 * monitor.corpusbytes
+        ipcbytes += sum([x[0].nbytes for x in resultlist])
+        monitor.checkpoint('sweep ' + str(iteration), self.twmatrix, ipcbytes,
+            [x[3] for x in resultlist])
+
+        # The twmatrix is updated in place, so that views of it stay live.
+
+        booklist = []
+        changeratios = []
+        for i, (changematrix, bookseq, changeratio, workerstats) in enumerate(resultlist):
+            booklist.extend(bookseq)
+            self.twmatrix += changematrix
+            changeratios.append(changeratio)
+            self.collector.add_worker(iteration, i, workerstats)
+            self.workerstates[i] = workerstats['rngstate']
+
+        gibbs.report_skipped([x[3] for x in resultlist])
+        self.tracker.finish(iteration, np.mean(changeratios), [x[3] for x in resultlist])
+
+        if self.splitwords > 0:
+            booklist = splitbooks.rejoin(booklist, wholes)
+            del units, wholes
+
+        self.booklist = booklist
+        self.packed = None
+
+        # A worker holding pieces of a book can't count its
+        # themes, so with split books we count the whole corpus.
+
+        histograms = None
+        if optimizing and self.splitwords > 0:
+            histograms = hyperopt.count_histograms(booklist)
+        elif optimizing:
+            histograms = hyperopt.merge_histograms([x[3]['histograms'] for x in resultlist])
+
+        del resultlist, changematrix
+        monitor.checkpoint('merge ' + str(iteration), self.twmatrix)
+
+        self.changeratio = np.mean(changeratios)
+        print('Ratio of changed to unchanged topic assignments: ', self.changeratio)
+        self.stopper.record_ratio(self.changeratio)
+
+        if self.splitwords == 0:
+            self.booksequences = infer_roles.shuffledivide(booklist, numprocesses,
+                self.shufflerng)
+
+        return histograms
+
+    def corpus(self):
+        '''
+        The threadsweep.SharedCorpus behind the books, packed now if
+        it isn't already.
+        '''
+
+        if self.sampler is not None:
+            return self.sampler.corpus
+
+        if self.packed is None:
+            self.packed = threadsweep.SharedCorpus(self.booklist, self.constants)
+
+        return self.packed
+
+    def topic_word(self):
+        '''
+        The twmatrix: words by topics, themes first.
+        '''
+
+        return self.twmatrix
+
+    def role_counts(self):
+        '''
+        Characters by roles, in booklist order.
+        '''
+
+        return self.corpus().rolecounts
+
+    def theme_counts(self):
+        '''
+        Books by themes, in booklist order.
+        '''
+
+        return self.corpus().themecounts
+
+    def topic_assigns(self):
+        '''
+        The topic of every token, characters in booklist order; see
+        SharedCorpus for the offsets.
+        '''
+
+        return self.corpus().topicassigns
+
+    def arrays(self):
+        '''
+        Names, labels, books and topic counts of every character, as
+        evaluate.py and align.py use them. These are copies.
+        '''
+
+        return evaluate.arrays_from_books(self.booklist, self.constants[0], self.constants[1])
+
+    def rngstates(self):
+        return self.workerstates + [self.shufflerng.bit_generator.state]
+
+    def save(self, modelname = None):
+        '''
+        Writes doctopics, keys and (with coherencewords) coherence, and
+        pickles the model to modelname.pickle. Outputs are only written
+        in a forked child once close has stopped this trainer's
+        threads; before that they are written here (see snapshots.py).
+        '''
+
+        if modelname is None:
+            modelname = self.modelname
+
+        numthemes = self.constants[0]
+
+        if self.coherenceindex is not None:
+            npmi, umass = self.coherenceindex.report(self.twmatrix, numthemes,
+                self.coherencewords)
+            coherence.write_coherence(npmi, umass, modelname, numthemes)
+
+        save_model(modelname, self.booklist, self.twmatrix, self.constants,
+            self.vocabulary_list, self.rngstates(), self.monitor)
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.close()
+        self.tracker.close()
@@ -0,0 +1,140 @@
+# warmstart.py
+
+# Starts a model with new numbers of themes and roles from a saved
+# model, instead of from random assignments.
+
+# Themes and roles are resized separately. Existing topics keep
+# their words. If a level grows, we repeatedly split its largest
+# topic: each word type in it goes, with all its tokens, to one half
+# or the other, so the two halves start with different words and
+# drift apart under sampling. If a level shrinks, its largest topics
+# are kept and the tokens of the others are folded back in, one
+# token at a time, with the conditional from gibbs.sweep (see
+# gibbs.foldin). Tokens of removed themes can land in roles and vice
+# versa. Each new topic inherits the alpha of the topic it came from.
+
+# Used through infer_roles.py, by naming new counts with a saved model:
+#
+#     python3 infer_roles.py -savedmodel sixthmodel.pickle -themes 60 -roles 180 -iterations 100
+
+import gibbs, memplan
+import numpy as np
+
+def plan_level(twmatrix, oldtopics, newcount, offset, newtw, newalpha, alpha, rng):
+    '''
+    Places one level (themes or roles) of the old model in the new
+    topic space, starting at column offset of newtw.
+
+    oldtopics: the old topic numbers at this level
+    newtw: the new topic-word matrix, filled in here
+
+    Returns a mapping from old topic numbers (-1 for removed) and a
+    list of splits, each (source, slot, wordmask), to be applied in
+    order.
+    '''
+
+    if len(oldtopics) == 0 and newcount > 0:
+        raise ValueError('The saved model has no topics at this level to split; start ' +
+            'from scratch instead.')
+
+    mapping = dict()
+    totals = np.sum(twmatrix[ : , oldtopics], axis = 0, dtype = 'int64')
+
+    # the largest topics survive, in their old order
+
+    kept = sorted([oldtopics[i] for i in np.argsort(-totals, kind = 'stable')[ : newcount]])
+
+    for topic in oldtopics:
+        mapping[topic] = -1
+    for i, topic in enumerate(kept):
+        mapping[topic] = offset + i
+        newtw[ : , offset + i] = twmatrix[ : , topic]
+        newalpha[offset + i] = alpha[topic]
+
+    splits = []
+
+    for slot in range(offset + len(kept), offset + newcount):
+        sizes = np.sum(newtw[ : , offset : slot], axis = 0, dtype = 'int64')
+        source = offset + int(np.argmax(sizes))
+
+        wordmask = (rng.random(newtw.shape[0]) < 0.5) & (newtw[ : , source] > 0)
+        newtw[wordmask, slot] = newtw[wordmask, source]
+        newtw[wordmask, source] = 0
+        newalpha[slot] = newalpha[source]
+
+        splits.append((source, slot, wordmask))
+
+    return mapping, splits
+
+def resize_model(booklist, twmatrix, constants, newthemes, newroles, rng = None):
+    '''
+    Moves the assignments of a saved model into a space of newthemes
+    themes and newroles roles. Books and characters are changed in
+    place.
+
+    Returns booklist, the new twmatrix and the new constants.
+    '''
+
+    numthemes, numtopics, alpha, beta = constants
+    alpha = np.broadcast_to(alpha, (numtopics, ))
+    newtopics = newthemes + newroles
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    newtw = np.zeros((twmatrix.shape[0], newtopics), dtype = twmatrix.dtype)
+    newalpha = np.zeros(newtopics)
+
+    thememap, themesplits = plan_level(twmatrix, list(range(numthemes)), newthemes, 0,
+        newtw, newalpha, alpha, rng)
+    rolemap, rolesplits = plan_level(twmatrix, list(range(numthemes, numtopics)), newroles,
+        newthemes, newtw, newalpha, alpha, rng)
+
+    mapping = np.full(numtopics, -1, dtype = 'int64')
+    for oldtopic, newtopic in list(thememap.items()) + list(rolemap.items()):
+        mapping[oldtopic] = newtopic
+
+    splits = themesplits + rolesplits
+    for source, slot, wordmask in splits:
+        print('Splitting topic ' + str(source) + ' into ' + str(source) + ' and ' + str(slot) + '.')
+
+    # Relabel every token; tokens of removed topics are left to fold in.
+
+    topicdtype = memplan.smallest_unsigned(newtopics - 1)
+    newconstants = (newthemes, newtopics, newalpha, beta)
+
+    unplacedchars = []
+    unplacedpositions = []
+
+    for book in booklist:
+        themecounts = np.zeros(newthemes, dtype = 'int64')
+
+        for char in book.characters:
+            assigns = mapping[char.topicassigns]
+            for source, slot, wordmask in splits:
+                assigns[(assigns == source) & wordmask[char.wordtypes]] = slot
+
+            unplaced = np.flatnonzero(assigns < 0)
+            placed = assigns[assigns >= 0]
+
+            themecounts += np.bincount(placed[placed < newthemes], minlength = newthemes)
+            rolecounts = np.bincount(placed[placed >= newthemes] - newthemes, minlength = newroles)
+
+            char.topicassigns = np.maximum(assigns, 0).astype(np.promote_types(
+                char.topicassigns.dtype, topicdtype))
+            char.rolecounts = rolecounts.astype(char.rolecounts.dtype)
+            char.numthemes = newthemes
+
+            if len(unplaced) > 0:
+                unplacedchars.append(char)
+                unplacedpositions.append(unplaced)
+
+        book.themecounts = themecounts.astype(book.themecounts.dtype)
+        book.numthemes = newthemes
+
+    numunplaced = sum([len(x) for x in unplacedpositions])
+    if numunplaced > 0:
+        print('Folding in ' + str(numunplaced) + ' words from removed topics.')
+        gibbs.foldin(unplacedchars, newtw, newconstants, rng, unplacedpositions)
+
+    return booklist, newtw, newconstants